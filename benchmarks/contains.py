@@ -0,0 +1,94 @@
+"""Compare the vectorized point-in-polygon masks against per-node checks
+
+Run from the repository root: python -m benchmarks.contains
+"""
+
+import math
+import timeit
+
+import mercantile
+import numpy as np
+import shapely.geometry
+
+from server.utils import bbox_mask, shape_mask
+
+tile = mercantile.tile(9.19, 45.46, 12)
+bbox = mercantile.Bbox(*mercantile.bounds(tile))
+
+
+def complex_multipolygon(parts=8, vertices=5_000, seed=0):
+    """Jagged blobs, like an administrative boundary"""
+    rng = np.random.default_rng(seed)
+    width, height = bbox.right - bbox.left, bbox.top - bbox.bottom
+    polygons = []
+    for part in range(parts):
+        x = bbox.left + width * (part % 4 + 0.5) / 4
+        y = bbox.bottom + height * (part // 4 + 0.5) / 2
+        angles = np.linspace(0, 2 * math.pi, vertices, endpoint=False)
+        radius = np.clip(
+            0.2 + np.cumsum(rng.normal(0, 0.005, vertices)), 0.05, 0.25
+        )
+        polygons.append(
+            shapely.geometry.Polygon(
+                zip(
+                    x + radius * width * np.cos(angles) / 2,
+                    y + radius * height * np.sin(angles),
+                )
+            ).buffer(0)
+        )
+    return shapely.geometry.MultiPolygon(
+        [
+            polygon
+            for geometry in polygons
+            for polygon in getattr(geometry, "geoms", [geometry])
+        ]
+    )
+
+
+def bbox_reference(bbox, lon, lat):
+    return [
+        bbox.left <= x <= bbox.right and bbox.bottom <= y <= bbox.top
+        for x, y in zip(lon, lat)
+    ]
+
+
+def shape_reference(shape, lon, lat):
+    return [
+        shape.contains(shapely.geometry.Point(x, y)) for x, y in zip(lon, lat)
+    ]
+
+
+def main():
+    rng = np.random.default_rng(0)
+    shape = complex_multipolygon()
+    unprepared = complex_multipolygon()
+    print(f"multipolygon: {shapely.get_num_coordinates(shape)} vertices")
+    print("nodes\tmask\treference (ms)\tvectorized (ms)\tspeedup")
+    for size in (1_000, 10_000, 100_000):
+        lon = rng.uniform(bbox.left, bbox.right, size)
+        lat = rng.uniform(bbox.bottom, bbox.top, size)
+        lists = lon.tolist(), lat.tolist()
+        assert shape_mask(shape, lon, lat).tolist() == shape_reference(
+            unprepared, *lists
+        )
+        for name, reference, vectorized, area, reference_area in (
+            ("bbox", bbox_reference, bbox_mask, bbox, bbox),
+            ("shape", shape_reference, shape_mask, shape, unprepared),
+        ):
+            number = 1 if name == "shape" and size > 1_000 else 3
+            reference = timeit.timeit(
+                lambda: reference(reference_area, *lists), number=number
+            )
+            vectorized = timeit.timeit(
+                lambda: vectorized(area, lon, lat), number=number
+            )
+            print(
+                f"{size}\t{name}\t"
+                f"{reference / number * 1000:.1f}\t"
+                f"{vectorized / number * 1000:.1f}\t"
+                f"{reference / vectorized:.0f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
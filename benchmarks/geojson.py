@@ -0,0 +1,68 @@
+"""Compare the getData GeoJSON serializer against one feature at a time
+
+Run from the repository root: python -m benchmarks.geojson
+"""
+
+import asyncio
+import time
+
+import numpy as np
+
+from server import export, process
+from tests.features import random_features
+
+
+def per_feature(batches):
+    """The previous serializer: small strings, encoded one by one"""
+    chunks = ['{"type": "FeatureCollection", "features": [']
+    first = True
+    for batch in batches:
+        for feature in batch.tolist():
+            if not first:
+                chunks.append(", ")
+            first = False
+            chunks.append(process.feature_to_geojson(feature))
+    chunks.append("]}")
+    return [chunk.encode("utf-8") for chunk in chunks]
+
+
+def templated(batches):
+    async def generate_tiles(*args, **kwargs):
+        for batch in batches:
+            yield None, batch
+
+    async def collect():
+        writer = export.GeoJSON()
+        return [chunk async for chunk in export.export(writer, None, "", "")]
+
+    export.generate_tiles = generate_tiles
+    return asyncio.run(collect())
+
+
+def main():
+    print("nodes\tpath\t\tfeatures/s\tMB/s\tchunks")
+    for size in (10_000, 100_000, 1_000_000):
+        # one batch per Z_TARGET tile
+        batches = np.array_split(
+            random_features(size, ids=(1, 1e10), edits=1e7),
+            max(size // 50_000, 1),
+        )
+        results = {}
+        for name, serialize in (
+            ("per feature", per_feature),
+            ("templated", templated),
+        ):
+            began = time.perf_counter()
+            chunks = serialize(batches)
+            elapsed = time.perf_counter() - began
+            body = b"".join(chunks)
+            results[name] = body
+            print(
+                f"{size}\t{name:<12}\t{size / elapsed:,.0f}\t"
+                f"{len(body) / elapsed / 2**20:.1f}\t{len(chunks)}"
+            )
+        assert results["per feature"] == results["templated"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Tile latency while a large getStats request is running
+
+Tiles are generated and cached beforehand, so that no request reaches
+ohsome. Compare PROCESS_WORKERS=0 (threads) against the process pool:
+
+    PROCESS_WORKERS=0 python -m benchmarks.load --fakeredis
+    PROCESS_WORKERS=2 python -m benchmarks.load --fakeredis
+
+Without --fakeredis, the Redis server at REDIS_HOST is used. The pool is
+off by default: it has to be measured on as many cores as workers plus
+the event loop, as with one core it only adds its overhead.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import time
+
+import mercantile
+import numpy as np
+import simplejson as json
+
+os.environ.setdefault("PREWARM_TILES", "0")
+
+import server  # noqa: E402
+
+START = "2007-10-08T00:00:00Z"
+END = "2024-01-01T00:00:00Z"
+CENTER = 9.19, 45.46
+
+
+def use_fakeredis():
+    import fakeredis
+    import redis
+
+    server.db.connection_pool = redis.ConnectionPool(
+        connection_class=fakeredis.FakeConnection,
+        server=fakeredis.FakeServer(),
+    )
+
+
+def area_tiles(size):
+    center = mercantile.tile(*CENTER, server.Z_TARGET)
+    return [
+        mercantile.Tile(center.x + dx, center.y + dy, center.z)
+        for dx in range(size)
+        for dy in range(size)
+    ]
+
+
+def populate(tiles, nodes, seed=0):
+    from server import codec
+    from server.process import store, tile_cache_key
+    from server.utils import cache_metadata
+
+    rng = np.random.default_rng(seed)
+    for tile in tiles:
+        bounds = mercantile.bounds(tile)
+        features = np.zeros(nodes, dtype=codec.DTYPE)
+        features["lon"] = rng.uniform(bounds.west, bounds.east, nodes)
+        features["lat"] = rng.uniform(bounds.south, bounds.north, nodes)
+        features["id"] = rng.integers(1, 1e10, nodes)
+        features["creation"] = rng.integers(1.2e9, 1.7e9, nodes)
+        features["lastedit"] = features["creation"] + rng.integers(0, 1e7)
+        features["revisions"] = rng.integers(1, 20, nodes)
+        features["frequency"] = rng.exponential(1, nodes)
+        quadkey = mercantile.quadkey(tile)
+        cache_key = tile_cache_key(
+            quadkey, START, END, None, server.DEFAULT_FILTER
+        )
+        store(cache_key, quadkey, features)
+    cache_metadata((START, END))
+
+
+def jagged_polygon(tiles, vertices=20_000, seed=0):
+    """An administrative boundary-like polygon within the given tiles"""
+    west = min(mercantile.bounds(tile).west for tile in tiles)
+    east = max(mercantile.bounds(tile).east for tile in tiles)
+    south = min(mercantile.bounds(tile).south for tile in tiles)
+    north = max(mercantile.bounds(tile).north for tile in tiles)
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * math.pi, vertices, endpoint=False)
+    noise = np.cumsum(rng.normal(0, 0.003, vertices))
+    radius = np.clip(0.35 + noise, 0.2, 0.45)
+    lon = (west + east) / 2 + radius * (east - west) * np.cos(angles)
+    lat = (south + north) / 2 + radius * (north - south) * np.sin(angles)
+    ring = np.column_stack([lon, lat]).tolist()
+    return {"type": "Polygon", "coordinates": [ring + ring[:1]]}
+
+
+def percentiles(latencies):
+    latencies = np.array(latencies) * 1000
+    return (
+        "  ".join(
+            f"p{q}={np.percentile(latencies, q):.1f}ms" for q in (50, 90, 99)
+        )
+        + f"  max={latencies.max():.1f}ms  n={len(latencies)}"
+    )
+
+
+async def fetch_tiles(client, urls, concurrency):
+    latencies = []
+    queue = iter(urls)
+
+    async def worker():
+        for url in queue:
+            began = time.perf_counter()
+            async with client.get(url) as response:
+                await response.read()
+                assert response.status == 200, response.status
+            latencies.append(time.perf_counter() - began)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def main(args):
+    import aiohttp
+    from aiohttp.test_utils import TestClient, TestServer
+
+    from server.app import webapp
+
+    tiles = area_tiles(args.size)
+    began = time.perf_counter()
+    populate(tiles, args.nodes)
+    print(f"cached {len(tiles)} tiles in {time.perf_counter() - began:.1f}s")
+    polygon = json.dumps(jagged_polygon(tiles))
+
+    # distinct tiles, so that the rendered tile cache is never hit, away
+    # from the borders of the cached tiles
+    z = server.Z_TARGET + 5
+    urls = iter(
+        f"/tiles/{z}/{child.x}/{child.y}.png?resolution=64"
+        for tile in tiles
+        for child in mercantile.children(tile, zoom=z)
+        if 0 < child.x % 32 < 31 and 0 < child.y % 32 < 31
+    )
+
+    client = TestClient(TestServer(await webapp()))
+    await client.start_server()
+    try:
+        # start the pool workers
+        await fetch_tiles(client, [next(urls) for _ in range(20)], 4)
+        idle = await fetch_tiles(
+            client, [next(urls) for _ in range(args.tiles)], args.concurrency
+        )
+        print(f"idle     {percentiles(idle)}")
+
+        stats = []
+
+        async def large_stats():
+            while True:
+                form = aiohttp.FormData()
+                form.add_field("geojson", polygon)
+                began = time.perf_counter()
+                async with client.post("/api/getStats", data=form) as resp:
+                    await resp.read()
+                stats.append(time.perf_counter() - began)
+
+        background = asyncio.ensure_future(large_stats())
+        await asyncio.sleep(0.5)
+        loaded = await fetch_tiles(
+            client, [next(urls) for _ in range(args.tiles)], args.concurrency
+        )
+        background.cancel()
+        print(f"getStats {percentiles(loaded)}")
+        if stats:
+            print(f"getStats requests: {percentiles(stats)}")
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fakeredis", action="store_true")
+    parser.add_argument("--size", type=int, default=3, help="tiles per side")
+    parser.add_argument("--nodes", type=int, default=100_000)
+    parser.add_argument("--tiles", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    if args.fakeredis:
+        use_fakeredis()
+    print(f"PROCESS_WORKERS={server.PROCESS_WORKERS}")
+    asyncio.run(main(args))
@@ -0,0 +1,200 @@
+"""A stand-in for the ohsome API, so that benchmarks do not depend on the
+network: full-history responses are replayed from recordings, or
+synthesized with a given number of nodes per tile
+
+    python -m benchmarks.ohsome --port 8765 --density 5000
+    API_SERVER=http://127.0.0.1:8765 gunicorn ...
+
+With --upstream https://api.ohsome.org, the responses missing from
+--recordings are fetched from the real API and recorded, to be replayed
+afterwards.
+"""
+
+import argparse
+import asyncio
+import functools
+import gzip
+import hashlib
+import pathlib
+
+import aiohttp
+import mercantile
+import numpy as np
+from aiohttp import web
+
+START = "2007-10-08T00:00:00Z"
+END = "2024-01-01T00:00Z"
+VALID_TO = "2024-01-01T00:00:00Z"
+ZOOM = 12  # the default Z_TARGET
+SINCE = np.datetime64("2008-01-01T00:00:00").astype(np.int64)
+UNTIL = np.datetime64("2023-12-01T00:00:00").astype(np.int64)
+FEATURE = (
+    '{"type": "Feature", "geometry": {"type": "Point", '
+    '"coordinates": [%r, %r]}, "properties": {"@osmId": "node/%d", '
+    '"@validFrom": "%s", "@validTo": "%s", "@version": %d%s}}'
+)
+TAGS = (
+    "",
+    ', "amenity": "cafe"',
+    ', "amenity": "bench"',
+    ', "shop": "bakery"',
+)
+
+
+def timestamps(seconds):
+    return np.char.add(
+        np.datetime_as_string(seconds.astype("datetime64[s]")), "Z"
+    ).tolist()
+
+
+@functools.lru_cache(maxsize=4096)
+def tile_history(quadkey, density, tagged, deleted):
+    """Versions of density nodes in a ZOOM tile, always the same"""
+    digest = hashlib.sha1(quadkey.encode()).digest()
+    rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+    bounds = mercantile.bounds(mercantile.quadkey_to_tile(quadkey))
+
+    versions = rng.integers(1, 6, density)
+    node = np.repeat(np.arange(density), versions)
+    first = np.cumsum(versions) - versions
+    number = np.arange(len(node)) - first[node] + 1
+    seconds = rng.integers(SINCE, UNTIL, len(node))
+    seconds = seconds[np.lexsort((seconds, node))]
+    valid_to = np.roll(seconds, -1)
+    last = number == versions[node]
+    valid_to[last] = UNTIL
+    # deleted nodes have been valid for a day after their last version
+    gone = last & (rng.random(density) < deleted)[node]
+    valid_to[gone] = seconds[gone] + 60 * 60 * 24
+
+    lon = rng.uniform(bounds.west, bounds.east, density)[node]
+    lat = rng.uniform(bounds.south, bounds.north, density)[node]
+    moved = ~last
+    lon[moved] += rng.normal(0, 1e-5, np.count_nonzero(moved))
+    lat[moved] += rng.normal(0, 1e-5, np.count_nonzero(moved))
+    ids = int.from_bytes(digest[8:11], "little") << 24 | node
+    tags = np.zeros(len(node), dtype=np.intp)
+    if tagged:
+        tags = rng.choice(len(TAGS), len(node), p=(0.85, 0.05, 0.05, 0.05))
+    return lon, lat, ids, seconds, valid_to, number, tags, last & ~gone
+
+
+@functools.lru_cache(maxsize=512)
+def synthesize(bboxes, density, tagged=False, deleted=0.05):
+    """Gzipped full history of the nodes in a bounding box, where there
+    are density nodes in each ZOOM tile: the same nodes are sent for
+    a tile, its parent or its children. The versions of a node are sent
+    one after the other; tagged versions have a single tag, or none."""
+    west, south, east, north = map(float, bboxes.replace("|", ",").split(","))
+    columns = zip(
+        *(
+            tile_history(mercantile.quadkey(tile), density, tagged, deleted)
+            for tile in mercantile.tiles(west, south, east, north, ZOOM)
+        )
+    )
+    lon, lat, ids, seconds, valid_to, number, tags, alive = (
+        np.concatenate(column) for column in columns
+    )
+    inside = (west <= lon) & (lon <= east) & (south <= lat) & (lat <= north)
+    lon, lat, ids, seconds, valid_to, number, tags, alive = (
+        column[inside]
+        for column in (lon, lat, ids, seconds, valid_to, number, tags, alive)
+    )
+
+    valid_to = timestamps(valid_to)
+    for index in np.flatnonzero(alive).tolist():
+        valid_to[index] = VALID_TO
+    features = ", ".join(
+        FEATURE % row
+        for row in zip(
+            np.round(lon, 7).tolist(),
+            np.round(lat, 7).tolist(),
+            ids.tolist(),
+            timestamps(seconds),
+            valid_to,
+            number.tolist(),
+            (TAGS[tag] for tag in tags.tolist()),
+        )
+    )
+    body = f'{{"type": "FeatureCollection", "features": [{features}]}}'
+    return gzip.compress(body.encode(), compresslevel=1)
+
+
+def recording(directory, request):
+    query = "&".join(sorted(f"{k}={v}" for k, v in request.query.items()))
+    digest = hashlib.sha1(f"{request.path}?{query}".encode()).hexdigest()
+    return pathlib.Path(directory) / f"{digest}.json.gz"
+
+
+def gzipped(body):
+    response = web.Response(body=body, content_type="application/json")
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def make_app(density=5000, latency=0, recordings=None, upstream=None):
+    async def metadata(request):
+        temporal_extent = {"fromTimestamp": START, "toTimestamp": END}
+        return web.json_response(
+            {"extractRegion": {"temporalExtent": temporal_extent}}
+        )
+
+    async def replay(request):
+        await asyncio.sleep(latency)
+        if recordings:
+            path = recording(recordings, request)
+            if path.exists():
+                return gzipped(path.read_bytes())
+            if upstream:
+                url = upstream + request.path
+                session = request.app["session"]
+                async with session.get(url, params=request.query) as resp:
+                    resp.raise_for_status()
+                    body = gzip.compress(await resp.read())
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(body)
+                return gzipped(body)
+        if request.path.endswith("/contributions/geometry"):
+            body = '{"type": "FeatureCollection", "features": []}'
+            return web.Response(text=body, content_type="application/json")
+        bboxes = request.query["bboxes"]
+        tagged = "tags" in request.query.get("properties", "")
+        body = await asyncio.to_thread(synthesize, bboxes, density, tagged)
+        return gzipped(body)
+
+    async def client_session(app):
+        async with aiohttp.ClientSession() as session:
+            app["session"] = session
+            yield
+
+    app = web.Application()
+    app.cleanup_ctx.append(client_session)
+    app.add_routes(
+        [
+            web.get("/v1/metadata", metadata),
+            web.get("/v1/elementsFullHistory/geometry", replay),
+            web.get("/v1/contributions/geometry", replay),
+        ]
+    )
+    return app
+
+
+def serve(port, *args):
+    web.run_app(make_app(*args), host="127.0.0.1", port=port, print=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--density", type=int, default=5000, help="nodes per zoom 12 tile"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds per request"
+    )
+    parser.add_argument("--recordings", help="directory of recordings")
+    parser.add_argument("--upstream", help="ohsome API to record from")
+    args = parser.parse_args()
+    serve(
+        args.port, args.density, args.latency, args.recordings, args.upstream
+    )
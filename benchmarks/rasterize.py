@@ -0,0 +1,41 @@
+"""Compare the tile rasterizer against the per-feature implementation
+
+Run from the repository root: python -m benchmarks.rasterize
+"""
+
+import timeit
+
+import numpy as np
+
+from server.tile import rasterize
+from tests.test_tile import bbox, rasterize_reference
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print("nodes\tresolution\treference (ms)\tvectorized (ms)\tspeedup")
+    for size in (1_000, 10_000, 100_000):
+        lon = rng.uniform(bbox.left, bbox.right, size)
+        lat = rng.uniform(bbox.bottom, bbox.top, size)
+        values = rng.uniform(0, 1, size)
+        lists = lon.tolist(), lat.tolist(), values.tolist()
+        for resolution in (8, 64, 256):
+            number = 3
+            reference = timeit.timeit(
+                lambda: rasterize_reference(*lists, bbox, resolution, 50),
+                number=number,
+            )
+            vectorized = timeit.timeit(
+                lambda: rasterize(lon, lat, values, bbox, resolution, 50),
+                number=number,
+            )
+            print(
+                f"{size}\t{resolution}\t"
+                f"{reference / number * 1000:.1f}\t"
+                f"{vectorized / number * 1000:.1f}\t"
+                f"{reference / vectorized:.0f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Time for a worker to import and build the app, and its memory, with and
+without gunicorn --preload (Linux only)
+
+    python -m benchmarks.startup --workers 2 --repeat 5
+
+Each measure starts from a fresh interpreter, which forks the workers:
+without --preload each worker imports the app itself, with it the
+workers share the pages of the modules imported before the fork until
+they write to them. Private memory is what a worker does not share.
+The startup hooks are not run, as they need Redis.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MEASURES = ("import", "ready", "rss", "private")
+
+
+def memory():
+    """Resident and private memory of this process, in MiB"""
+    fields = {}
+    with open("/proc/self/smaps_rollup") as smaps:
+        for line in smaps:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0])
+    private = fields["Private_Clean"] + fields["Private_Dirty"]
+    return fields["Rss"] / 1024, private / 1024
+
+
+def load():
+    from server.app import webapp
+
+    return webapp
+
+
+def worker(preload, webapp, output):
+    began = time.perf_counter()
+    if not preload:
+        webapp = load()
+    asyncio.run(webapp())
+    rss, private = memory()
+    ready = time.perf_counter() - began
+    os.write(output, json.dumps([ready, rss, private]).encode())
+
+
+def child(preload, workers):
+    """Import the app if preloading, fork the workers and print the
+    measures of each of them"""
+    began = time.perf_counter()
+    webapp = load() if preload else None
+    imported = time.perf_counter() - began
+    pipes = []
+    for _ in range(workers):
+        read, write = os.pipe()
+        if os.fork() == 0:
+            os.close(read)
+            worker(preload, webapp, write)
+            os._exit(0)
+        os.close(write)
+        pipes.append(read)
+    results = []
+    for read in pipes:
+        with os.fdopen(read) as pipe:
+            results.append([imported, *json.loads(pipe.read())])
+    for _ in pipes:
+        os.wait()
+    print(json.dumps(results))
+
+
+def measure(preload, workers):
+    command = [sys.executable, "-m", "benchmarks.startup", "--child"]
+    command += ["--workers", str(workers)]
+    if preload:
+        command.append("--preload")
+    environment = {**os.environ, "PREWARM_TILES": "0"}
+    output = subprocess.run(
+        command, capture_output=True, check=True, env=environment
+    ).stdout
+    return json.loads(output)
+
+
+def main(args):
+    print("mode\timport (ms)\tready (ms)\tRSS (MiB)\tprivate (MiB)")
+    for preload in (False, True):
+        runs = [
+            worker
+            for _ in range(args.repeat)
+            for worker in measure(preload, args.workers)
+        ]
+        medians = [statistics.median(run[i] for run in runs) for i in range(4)]
+        imported, ready, rss, private = medians
+        print(
+            f"{'preload' if preload else 'default'}\t"
+            f"{imported * 1000:.0f}\t{ready * 1000:.0f}\t"
+            f"{rss:.1f}\t{private:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--preload", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.preload, args.workers)
+    else:
+        main(args)
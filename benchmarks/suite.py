@@ -0,0 +1,267 @@
+"""Offline benchmark suite: cold and warm getData, getStats on a complex
+polygon and tiles at several resolutions, against benchmarks/ohsome.py
+
+    python -m benchmarks.suite --fakeredis --output before.json
+    python -m benchmarks.suite --fakeredis --baseline before.json
+
+Latency percentiles, throughput and peak memory are reported for each
+scenario. With --baseline, the exit status is 1 if any of them is worse
+than the baseline by more than --threshold.
+
+PROCESS_WORKERS defaults to 0, so that the peak memory, traced in this
+process, covers all the work; set it to benchmark the process pool.
+Without --fakeredis, the Redis server at REDIS_HOST is used, and
+flushed; so is the STORAGE_PATH directory, with STORAGE=disk.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+with socket.socket() as unused:
+    unused.bind(("127.0.0.1", 0))
+    PORT = unused.getsockname()[1]
+os.environ["API_SERVER"] = f"http://127.0.0.1:{PORT}"
+os.environ.setdefault("PROCESS_WORKERS", "0")
+os.environ.setdefault("PREWARM_TILES", "0")
+
+import mercantile  # noqa: E402
+
+import server  # noqa: E402
+from server import lru, storage  # noqa: E402
+
+from . import ohsome  # noqa: E402
+from .load import area_tiles, jagged_polygon, use_fakeredis  # noqa: E402
+
+RESOLUTIONS = (16, 64, 256)
+# compared against the baseline: p99 is too noisy, with a few requests
+METRICS = ("p50", "p90", "throughput", "memory")
+
+
+def bbox_query(tiles):
+    west = min(mercantile.bounds(tile).west for tile in tiles)
+    east = max(mercantile.bounds(tile).east for tile in tiles)
+    south = min(mercantile.bounds(tile).south for tile in tiles)
+    north = max(mercantile.bounds(tile).north for tile in tiles)
+    margin = (east - west) / 10
+    return (
+        f"minx={west + margin}&miny={south + margin}"
+        f"&maxx={east - margin}&maxy={north - margin}"
+    )
+
+
+def tile_urls(tiles, resolution):
+    """A tile of each metatile, so that none is rendered twice unless
+    there are more requests than metatiles"""
+    z = server.Z_TARGET + 4
+    for tile in tiles:
+        for child in mercantile.children(tile, zoom=z):
+            if child.x % server.METATILE == child.y % server.METATILE == 0:
+                yield f"/tiles/{z}/{child.x}/{child.y}.png" + (
+                    f"?resolution={resolution}"
+                )
+
+
+def scenarios(tiles):
+    """name -> (request, whether the caches are flushed before it)"""
+    query = bbox_query(tiles[:2])
+    polygon = json.dumps(jagged_polygon(tiles))
+
+    async def get_data(client):
+        return await client.get(f"/api/getData?{query}")
+
+    async def get_stats(client):
+        form = {"geojson": polygon}
+        return await client.post("/api/getStats", data=form)
+
+    def get_tile(urls):
+        async def request(client):
+            return await client.get(next(urls))
+
+        return request
+
+    yield "getData cold", get_data, True
+    yield "getData warm", get_data, False
+    yield "getStats", get_stats, False
+    for resolution in RESOLUTIONS:
+        urls = itertools.cycle(tile_urls(tiles, resolution))
+        yield f"tile {resolution}px", get_tile(urls), False
+
+
+async def measure(client, request, flush, repeat, concurrency):
+    async def once():
+        if flush:
+            server.db.flushdb()
+            if server.STORAGE == "disk":
+                storage.storage.clear()
+            lru.tiles.clear()
+        began = time.perf_counter()
+        async with await request(client) as response:
+            await response.read()
+            assert response.status == 200, response.status
+        return time.perf_counter() - began
+
+    await once()  # warm up, or fill the caches
+    tracemalloc.start()
+    await once()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = []
+    remaining = iter(range(repeat))
+
+    async def worker():
+        for _ in remaining:
+            latencies.append(await once())
+
+    began = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - began
+    milliseconds = np.array(latencies) * 1000
+    return {
+        "p50": np.percentile(milliseconds, 50),
+        "p90": np.percentile(milliseconds, 90),
+        "p99": np.percentile(milliseconds, 99),
+        "throughput": repeat / elapsed,
+        "memory": peak / 2**20,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Metrics worse than the baseline by more than threshold"""
+    regressions = []
+    for name, metrics in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric in METRICS:
+            ratio = metrics[metric] / max(previous[metric], 1e-9)
+            if metric == "throughput":  # higher is better
+                ratio = 1 / max(ratio, 1e-9)
+            if ratio > 1 + threshold:
+                regressions.append((name, metric, previous[metric]))
+    return regressions
+
+
+def report(results, baseline):
+    print(
+        f"{'scenario':16}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+        f"{'req/s':>10}{'MiB':>10}"
+    )
+    for name, metrics in results.items():
+        print(
+            f"{name:16}"
+            + "".join(
+                f"{metrics[metric]:10.1f}"
+                for metric in ("p50", "p90", "p99", "throughput", "memory")
+            )
+        )
+        previous = baseline.get(name)
+        if previous:
+            print(
+                f"{'':16}"
+                + "".join(
+                    f"{metrics[metric] / previous[metric] - 1:+10.0%}"
+                    for metric in ("p50", "p90", "p99", "throughput", "memory")
+                )
+            )
+
+
+async def wait_for(url, timeout=30):
+    import aiohttp
+
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    if response.ok:
+                        return
+            except aiohttp.ClientConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.1)
+
+
+async def main(args):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    from server.app import webapp
+
+    await wait_for(f"{server.API_SERVER}/v1/metadata")
+    tiles = area_tiles(args.size)
+    client = TestClient(TestServer(await webapp()))
+    await client.start_server()
+    results = {}
+    try:
+        for name, request, flush in scenarios(tiles):
+            concurrency = 1 if flush else args.concurrency
+            results[name] = await measure(
+                client, request, flush, args.repeat, concurrency
+            )
+    finally:
+        await client.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fakeredis", action="store_true")
+    parser.add_argument(
+        "--density", type=int, default=5000, help="nodes per cached tile"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="ohsome seconds per request"
+    )
+    parser.add_argument("--recordings", help="ohsome responses to replay")
+    parser.add_argument("--size", type=int, default=3, help="tiles per side")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    args = parser.parse_args()
+    if args.fakeredis:
+        use_fakeredis()
+
+    fake = multiprocessing.get_context("spawn").Process(
+        target=ohsome.serve,
+        args=(PORT, args.density, args.latency, args.recordings),
+        daemon=True,
+    )
+    fake.start()
+    try:
+        results = asyncio.run(main(args))
+    finally:
+        fake.terminate()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["scenarios"]
+    report(results, baseline)
+    if args.output:
+        settings = {
+            key: value
+            for key, value in vars(args).items()
+            if key in ("density", "latency", "size", "repeat", "concurrency")
+        }
+        settings["PROCESS_WORKERS"] = server.PROCESS_WORKERS
+        with open(args.output, "w") as output:
+            json.dump({"settings": settings, "scenarios": results}, output)
+    regressions = compare(results, baseline, args.threshold)
+    for name, metric, previous in regressions:
+        print(
+            f"regression: {name} {metric} {results[name][metric]:.1f}"
+            f" (baseline {previous:.1f})"
+        )
+    sys.exit(1 if regressions else 0)
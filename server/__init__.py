@@ -1,6 +1,5 @@
 import os
 
-from matplotlib import cm
 from walrus import Database
 
 __version__ = "2.1.0-alpha"
@@ -8,13 +7,46 @@ __version__ = "2.1.0-alpha"
 API_SERVER = os.environ.get("API_SERVER", "https://api.ohsome.org")
 API = f"{API_SERVER}/v1/elementsFullHistory/geometry"
 METADATA = f"{API_SERVER}/v1/metadata"
+CONTRIBUTIONS = f"{API_SERVER}/v1/contributions/geometry"
 Z_TARGET = int(os.environ.get("Z_TARGET", 12))
+SPLIT_NODES = int(os.environ.get("SPLIT_NODES", 100_000))
+SPLIT_LEVELS = int(os.environ.get("SPLIT_LEVELS", 2))
+MERGE_NODES = int(os.environ.get("MERGE_NODES", 10_000))
+MERGE_LEVELS = int(os.environ.get("MERGE_LEVELS", 3))
 API_OSM = "https://www.openstreetmap.org/api/0.6"
 DEFAULT_FILTER = "type:node"
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", 4))
+CLIENT_CONNECTIONS = int(os.environ.get("CLIENT_CONNECTIONS", 32))
+CLIENT_TIMEOUT = int(os.environ.get("CLIENT_TIMEOUT", 280))
+CACHE_COMPRESSION = int(os.environ.get("CACHE_COMPRESSION", 6))
+TILE_CACHE_TIMEOUT = int(os.environ.get("TILE_CACHE_TIMEOUT", 60 * 60 * 24))
+TILE_MAX_AGE = int(os.environ.get("TILE_MAX_AGE", 60 * 60))
+TILE_MEMORY_CACHE = int(os.environ.get("TILE_MEMORY_CACHE", 128 * 2**20))
+METATILE = int(os.environ.get("METATILE", 4))
+MVT_CLUSTER_ZOOM = int(os.environ.get("MVT_CLUSTER_ZOOM", 17))
+MVT_GRID = int(os.environ.get("MVT_GRID", 128))
+AGGREGATE_LEVELS = int(os.environ.get("AGGREGATE_LEVELS", 5))
+AGGREGATE_CELLS = int(os.environ.get("AGGREGATE_CELLS", 2**15))
+SUMMARY_ZOOM = int(os.environ.get("SUMMARY_ZOOM", 17))
+SUMMARY_MIN_NODES = int(os.environ.get("SUMMARY_MIN_NODES", 64))
+SKETCH_SIZE = int(os.environ.get("SKETCH_SIZE", 100))
+FLIGHT_TIMEOUT = int(os.environ.get("FLIGHT_TIMEOUT", 300))
+PREWARM_TILES = int(os.environ.get("PREWARM_TILES", 256))
+PREWARM_INTERVAL = int(os.environ.get("PREWARM_INTERVAL", 60 * 10))
+PREWARM_CONCURRENCY = int(os.environ.get("PREWARM_CONCURRENCY", 2))
+PREWARM_RATE = float(os.environ.get("PREWARM_RATE", 1))
+PROCESS_WORKERS = int(os.environ.get("PROCESS_WORKERS", 0))
+PROCESS_QUEUE = int(os.environ.get("PROCESS_QUEUE", 2 * PROCESS_WORKERS + 1))
+REQUEST_CPU_BUDGET = int(os.environ.get("REQUEST_CPU_BUDGET", 120))
+INCREMENTAL_UPDATES = int(os.environ.get("INCREMENTAL_UPDATES", 1))
+LOCAL_FILTERS = int(os.environ.get("LOCAL_FILTERS", 0))
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+STORAGE = os.environ.get("STORAGE", "redis")
+STORAGE_PATH = os.environ.get("STORAGE_PATH", "cache")
+STORAGE_SIZE = int(os.environ.get("STORAGE_SIZE", 10 * 2**30))
 
-viridis = cm.get_cmap("viridis", 256)
-
-db = Database(host=os.environ.get("REDIS_HOST", "localhost"))
+# no connection is opened until used: see storage.redis_connections()
+db = Database(host=REDIS_HOST)
 cache = db.cache()
 
 SENTRY_DSN = os.getenv("SENTRY_DSN")
@@ -1,15 +1,23 @@
-import sentry_sdk
 from aiohttp import web
-from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 
 from server import SENTRY_DSN, __version__
+from server.client import client_session
 from server.feature import getFeature
+from server.flight import flight_listener
 from server.geojson import getData
+from server.metrics import instrument, metrics
+from server.mvt import vector_tile
+from server.pool import cpu_budget, process_pool
+from server.prewarm import prewarm
 from server.static import entry
 from server.statistics import getStats
+from server.storage import redis_connections
 from server.tile import tile
 
 if SENTRY_DSN:
+    import sentry_sdk
+    from sentry_sdk.integrations.aiohttp import AioHttpIntegration
+
     sentry_sdk.init(
         SENTRY_DSN,
         integrations=[AioHttpIntegration()],
@@ -19,7 +27,12 @@ if SENTRY_DSN:
 
 
 async def webapp():
-    app = web.Application()
+    app = web.Application(middlewares=[instrument, cpu_budget])
+    app.cleanup_ctx.append(redis_connections)
+    app.cleanup_ctx.append(client_session)
+    app.cleanup_ctx.append(flight_listener)
+    app.cleanup_ctx.append(prewarm)
+    app.cleanup_ctx.append(process_pool)
     app.add_routes(
         [
             web.get("/", entry),
@@ -29,6 +42,8 @@ async def webapp():
             web.get("/api/getStats", getStats),
             web.post("/api/getStats", getStats),
             web.get("/tiles/{z}/{x}/{y}.png", tile),
+            web.get("/tiles/{z}/{x}/{y}.mvt", vector_tile),
+            web.get("/metrics", metrics),
         ]
     )
     app.router.add_static("/", path="web/dist", name="static")
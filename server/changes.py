@@ -0,0 +1,116 @@
+"""Bring a cached tile up to date with the ohsome contributions made since
+its end timestamp, instead of downloading its full history again"""
+
+import datetime
+import io
+
+import numpy as np
+from jsonslicer import JsonSlicer
+
+from . import codec
+from .summary import Pyramid
+
+CHANGES = np.dtype(
+    [
+        ("id", "<i8"),
+        ("creation", "<f8"),
+        ("lastedit", "<f8"),
+        ("version", "<i8"),
+        ("count", "<i8"),
+        ("deleted", "?"),
+        ("lon", "<f8"),
+        ("lat", "<f8"),
+    ]
+)
+
+
+def to_timestamp(value):
+    """Same as process(): naive datetimes"""
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").timestamp()
+
+
+def is_true(value):
+    return value is True or value == "true"
+
+
+def parse_changes(body):
+    """Reduce the contributions of each node to its latest state"""
+    nodes = {}
+    for feature in JsonSlicer(io.BytesIO(body), ("features", None)):
+        properties = feature["properties"]
+        osmid = int(properties["@osmId"].split("/")[1])
+        timestamp = properties["@timestamp"]
+        geometry = feature.get("geometry")
+        deleted = is_true(properties.get("@deletion")) or not geometry
+        node = nodes.get(osmid)
+        if node is None:
+            node = nodes[osmid] = {"first": timestamp, "last": "", "count": 0}
+        node["count"] += 1
+        node["first"] = min(node["first"], timestamp)
+        if timestamp >= node["last"]:
+            node["last"] = timestamp
+            node["deleted"] = deleted
+            node["version"] = properties.get("@version", 0)
+            if not deleted:
+                node["lon"], node["lat"] = geometry["coordinates"][:2]
+    changes = np.zeros(len(nodes), dtype=CHANGES)
+    for row, (osmid, node) in enumerate(nodes.items()):
+        changes[row] = (
+            osmid,
+            to_timestamp(node["first"]),
+            to_timestamp(node["last"]),
+            node["version"],
+            node["count"],
+            node["deleted"],
+            node.get("lon", 0.0),
+            node.get("lat", 0.0),
+        )
+    return changes
+
+
+def update_frequency(features):
+    """Vectorized process() frequency, which depends on the current day"""
+    now = datetime.datetime.now().utcnow().timestamp()
+    days = np.maximum((now - features["creation"]) // (60 * 60 * 24), 1)
+    features["frequency"] = features["revisions"] / (days / 365)
+
+
+def merge(features, changes):
+    """Drop deleted nodes, update changed ones and add the new ones"""
+    changed = np.isin(features["id"], changes["id"])
+    previous = features[changed]
+    previous = previous[np.argsort(previous["id"])]
+    alive = changes[~changes["deleted"]]
+    index = np.searchsorted(previous["id"], alive["id"])
+    index = np.minimum(index, max(len(previous) - 1, 0))
+    found = np.zeros(len(alive), dtype=bool)
+    if len(previous):
+        found = previous["id"][index] == alive["id"]
+
+    updated = np.empty(len(alive), dtype=codec.DTYPE)
+    updated["lon"] = alive["lon"]
+    updated["lat"] = alive["lat"]
+    updated["id"] = alive["id"]
+    updated["lastedit"] = alive["lastedit"]
+    if len(previous):
+        updated["creation"] = np.where(
+            found, previous["creation"][index], alive["creation"]
+        )
+        revisions = np.where(found, previous["revisions"][index], 0)
+    else:
+        updated["creation"] = alive["creation"]
+        revisions = 0
+    # contributions may lack the version: each one adds a version
+    updated["revisions"] = np.where(
+        alive["version"] > 0, alive["version"], revisions + alive["count"]
+    )
+
+    merged = np.concatenate([features[~changed], updated])
+    merged = merged[np.argsort(merged["id"], kind="stable")]
+    update_frequency(merged)
+    return merged
+
+
+def apply_changes(features, body, quadkey):
+    merged = merge(features, parse_changes(body))
+    return merged, codec.encode(merged), Pyramid.build(quadkey, merged)
@@ -0,0 +1,42 @@
+import asyncio
+
+import aiohttp
+
+from . import CLIENT_CONNECTIONS, CLIENT_TIMEOUT
+from .metrics import trace_config
+
+session = None
+
+
+def get_session():
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=CLIENT_CONNECTIONS, ttl_dns_cache=300
+            ),
+            timeout=aiohttp.ClientTimeout(total=CLIENT_TIMEOUT),
+            trace_configs=[trace_config()],
+        )
+    return session
+
+
+async def client_session(app):
+    get_session()
+    yield
+    await session.close()
+
+
+class SyncReader:
+    """File-like view of an aiohttp stream, to be read from a thread"""
+
+    def __init__(self, stream, loop):
+        self.stream = stream
+        self.loop = loop
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            coroutine = self.stream.read()
+        else:
+            coroutine = self.stream.read(size)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
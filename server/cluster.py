@@ -0,0 +1,125 @@
+"""Group nodes by the cells of a regular grid over a bounding box, like the
+pixels of a raster tile, or by Web Mercator tiles, and aggregate each
+group"""
+
+import math
+
+import numpy as np
+
+from .summary import METRICS, tile_indices
+
+# latitude of the edges of Web Mercator
+MAX_LAT = math.degrees(math.atan(math.sinh(math.pi)))
+
+CLUSTER = np.dtype(
+    [
+        ("lon", "<f8"),
+        ("lat", "<f8"),
+        ("id", "<i8"),
+        ("count", "<i8"),
+        ("creation", "<f8"),
+        ("lastedit", "<f8"),
+        ("revisions", "<f8"),
+        ("frequency", "<f8"),
+        ("revisions_min", "<i8"),
+        ("revisions_max", "<i8"),
+    ]
+)
+
+
+def grid(lon, lat, bbox, resolution):
+    """Row-major cell of each node, clipped to the grid"""
+    y_index = np.floor(
+        resolution * (bbox.top - lat) / (bbox.top - bbox.bottom)
+    )
+    x_index = np.floor(
+        resolution * (lon - bbox.left) / (bbox.right - bbox.left)
+    )
+    y_index = np.clip(y_index, 0, resolution - 1).astype(np.intp)
+    x_index = np.clip(x_index, 0, resolution - 1).astype(np.intp)
+    return y_index * resolution + x_index
+
+
+def tile_zoom(bbox, zoom, limit):
+    """zoom, or the highest lower one with at most limit tiles over bbox"""
+    top = min(bbox.top, MAX_LAT)
+    bottom = max(bbox.bottom, -MAX_LAT)
+    while zoom > 0:
+        side = 2**zoom
+        (west, east), (north, south) = (
+            np.clip(index, 0, side - 1)
+            for index in tile_indices(
+                np.array([bbox.left, bbox.right]),
+                np.array([top, bottom]),
+                zoom,
+            )
+        )
+        if (int(east - west) + 1) * (int(south - north) + 1) <= limit:
+            break
+        zoom -= 1
+    return zoom
+
+
+def tile_cells(lon, lat, zoom):
+    """Cell of each node among the non-empty tiles of zoom, and the number
+    of cells"""
+    lat = np.clip(lat, -MAX_LAT, MAX_LAT)
+    x, y = tile_indices(lon, lat, zoom)
+    side = 2**zoom
+    tiles = np.clip(y, 0, side - 1) * side + np.clip(x, 0, side - 1)
+    unique, cells = np.unique(tiles, return_inverse=True)
+    return cells.reshape(-1), len(unique)
+
+
+def percentiles(values, cells, counts, percentile):
+    """Same as [min, *statistics.quantiles(n=100), max][percentile]"""
+    ordered = values[np.lexsort((values, cells))]
+    first = np.cumsum(counts) - counts
+    size = np.maximum(counts, 1)
+    if percentile == 0:
+        index = first
+    elif percentile == 100:
+        index = first + size - 1
+    else:
+        # statistics.quantiles(method="inclusive") interpolation
+        j, delta = np.divmod(percentile * (size - 1), 100)
+        lower = ordered.take(first + j, mode="clip")
+        upper = ordered.take(first + np.minimum(j + 1, size - 1), mode="clip")
+        result = (lower * (100 - delta) + upper * delta) / 100
+        return np.where(counts == 1, lower, result)
+    return ordered.take(index, mode="clip")
+
+
+def cluster(features, bbox, resolution, percentile=50):
+    """aggregate() on a resolution x resolution grid over bbox"""
+    if len(features) == 0:
+        return np.empty(0, dtype=CLUSTER)
+    cells = grid(features["lon"], features["lat"], bbox, resolution)
+    return aggregate(features, cells, resolution * resolution, percentile)
+
+
+def aggregate(features, cells, size, percentile=50):
+    """One point per non-empty cell out of size, at the mean position of
+    its nodes, with the percentile of each metric and the range of the
+    revisions; id is only kept for single nodes"""
+    if len(features) == 0:
+        return np.empty(0, dtype=CLUSTER)
+    counts = np.bincount(cells, minlength=size)
+    filled = counts > 0
+    clusters = np.zeros(np.count_nonzero(filled), dtype=CLUSTER)
+    clusters["count"] = counts[filled]
+    for axis in ("lon", "lat"):
+        sums = np.bincount(cells, features[axis], size)
+        clusters[axis] = sums[filled] / counts[filled]
+    for metric in METRICS:
+        values = features[metric].astype(np.float64)
+        aggregated = percentiles(values, cells, counts, percentile)
+        clusters[metric] = aggregated[filled]
+    first = (np.cumsum(counts) - counts)[filled]
+    order = np.argsort(cells, kind="stable")
+    ids = features["id"][order].take(first)
+    clusters["id"] = np.where(clusters["count"] == 1, ids, 0)
+    revisions = features["revisions"][order]
+    clusters["revisions_min"] = np.minimum.reduceat(revisions, first)
+    clusters["revisions_max"] = np.maximum.reduceat(revisions, first)
+    return clusters
@@ -0,0 +1,283 @@
+import struct
+import zlib
+
+import numpy as np
+import simplejson as json
+
+from . import CACHE_COMPRESSION
+
+MAGIC = b"IOU"
+VERSION = 1
+FLAG_ZLIB = 1
+FLAG_SHUFFLE = 2
+FLAG_INDEX = 4
+BLOCK_ROWS = 4096
+INDEX_MAGIC = b"IDX"
+
+DTYPE = np.dtype(
+    [
+        ("lon", "<f8"),
+        ("lat", "<f8"),
+        ("id", "<i8"),
+        ("creation", "<f8"),
+        ("lastedit", "<f8"),
+        ("revisions", "<i8"),
+        ("frequency", "<f8"),
+    ]
+)
+
+# rows, position of the payload, its length and bounds of each block
+INDEX = np.dtype(
+    [
+        ("rows", "<u4"),
+        ("position", "<u8"),
+        ("length", "<u4"),
+        ("west", "<f8"),
+        ("south", "<f8"),
+        ("east", "<f8"),
+        ("north", "<f8"),
+    ]
+)
+
+header = struct.Struct("<3sBB")  # magic, version, flags
+block_header = struct.Struct("<II")  # rows, payload length
+trailer = struct.Struct("<I3s")  # blocks, index magic
+
+
+def to_array(features):
+    return np.array(features, dtype=DTYPE)
+
+
+def morton(lon, lat):
+    """Z-order curve codes of coordinates, quantized to 32 bits each"""
+    x = ((lon + 180) / 360 * 2**32).clip(0, 2**32 - 1).astype(np.uint64)
+    y = ((lat + 90) / 180 * 2**32).clip(0, 2**32 - 1).astype(np.uint64)
+    return spread(x) | spread(y) << np.uint64(1)
+
+
+def spread(values):
+    """Insert a zero bit after each of the lower 32 bits"""
+    for shift, mask in (
+        (16, 0x0000FFFF0000FFFF),
+        (8, 0x00FF00FF00FF00FF),
+        (4, 0x0F0F0F0F0F0F0F0F),
+        (2, 0x3333333333333333),
+        (1, 0x5555555555555555),
+    ):
+        values = (values | values << np.uint64(shift)) & np.uint64(mask)
+    return values
+
+
+def spatial_sort(features):
+    """Features along the Z-order curve, so that each block covers a
+    small area"""
+    order = np.argsort(morton(features["lon"], features["lat"]), kind="stable")
+    return features[order]
+
+
+def encode(features, compression=CACHE_COMPRESSION):
+    chunks = []
+    write_sorted(spatial_sort(features), chunks.append, compression)
+    return b"".join(chunks)
+
+
+def write_sorted(features, write, compression=CACHE_COMPRESSION):
+    """Write the header, the blocks and their index"""
+    write(encode_header(compression))
+    index = np.zeros(-(-len(features) // BLOCK_ROWS), dtype=INDEX)
+    position = header.size
+    for entry, offset in zip(index, range(0, len(features), BLOCK_ROWS)):
+        block = features[offset : offset + BLOCK_ROWS]
+        chunk = encode_block(block, compression)
+        write(chunk)
+        entry["rows"] = len(block)
+        entry["position"] = position + block_header.size
+        entry["length"] = len(chunk) - block_header.size
+        entry["west"], entry["east"] = block["lon"].min(), block["lon"].max()
+        entry["south"], entry["north"] = block["lat"].min(), block["lat"].max()
+        position += len(chunk)
+    write(index.tobytes() + trailer.pack(len(index), INDEX_MAGIC))
+
+
+def encode_header(compression=CACHE_COMPRESSION):
+    flags = FLAG_INDEX | FLAG_SHUFFLE | (FLAG_ZLIB if compression else 0)
+    return header.pack(MAGIC, VERSION, flags)
+
+
+def encode_block(block, compression=CACHE_COMPRESSION):
+    """Store each column contiguously, byte-shuffled to compress better"""
+    payload = b"".join(
+        np.ascontiguousarray(block[name])
+        .view(np.uint8)
+        .reshape(-1, DTYPE.fields[name][0].itemsize)
+        .T.tobytes()
+        for name in DTYPE.names
+    )
+    if compression:
+        payload = zlib.compress(payload, compression)
+    return block_header.pack(len(block), len(payload)) + payload
+
+
+class Encoder:
+    """Collect rows as they come, to be sorted and written when closed
+
+    The Z-order sort needs every row of the tile, so nothing is written
+    until close(), which writes one chunk per block: memory grows with the
+    rows, kept as compact arrays and returned anyway, not with the
+    response or the encoded tile."""
+
+    def __init__(self, write, compression=CACHE_COMPRESSION):
+        self.write = write
+        self.compression = compression
+        self.block = np.empty(BLOCK_ROWS, dtype=DTYPE)
+        self.rows = 0
+        self.blocks = []
+
+    def append(self, row):
+        self.block[self.rows] = row
+        self.rows += 1
+        if self.rows == BLOCK_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.blocks.append(self.block[: self.rows].copy())
+            self.rows = 0
+
+    def close(self):
+        """Write all the rows and return them, as they are stored"""
+        self.flush()
+        features = np.concatenate(self.blocks or [np.empty(0, dtype=DTYPE)])
+        self.blocks = []
+        features = spatial_sort(features)
+        write_sorted(features, self.write, self.compression)
+        return features
+
+
+def is_encoded(blob):
+    return blob[: len(MAGIC)] == MAGIC
+
+
+def decode(blob):
+    if not is_encoded(blob):
+        return decode_legacy(blob)
+    flags = decode_header(blob)
+    if flags & FLAG_INDEX:
+        index = read_index(blob)
+    else:
+        index = scan(blob)
+    features = np.empty(index["rows"].sum(), dtype=DTYPE)
+    start = 0
+    for rows, position, length in index[
+        ["rows", "position", "length"]
+    ].tolist():
+        payload = memoryview(blob)[position : position + length]
+        decode_block(payload, rows, flags, features[start : start + rows])
+        start += rows
+    return features
+
+
+def decode_header(blob):
+    """Flags of an encoded blob"""
+    _, version, flags = header.unpack_from(blob)
+    if version != VERSION:
+        raise ValueError(f"Unsupported tile format version: {version}")
+    return flags
+
+
+def scan(blob):
+    """Index of the blocks of a blob written without one"""
+    index = []
+    position = header.size
+    while position < len(blob):
+        rows, length = block_header.unpack_from(blob, position)
+        position += block_header.size
+        index.append((rows, position, length, 0, 0, 0, 0))
+        position += length
+    return np.array(index, dtype=INDEX)
+
+
+def index_size(tail):
+    """Bytes taken by the index and its trailer, given the end of a blob"""
+    blocks, magic = trailer.unpack_from(tail, len(tail) - trailer.size)
+    if magic != INDEX_MAGIC:
+        raise ValueError("Missing tile index")
+    return blocks * INDEX.itemsize + trailer.size
+
+
+def read_index(tail):
+    """Index of the blocks, given enough of the end of a blob: see
+    index_size()"""
+    size = index_size(tail)
+    if len(tail) < size:
+        raise ValueError("Truncated tile index")
+    index = tail[len(tail) - size : len(tail) - trailer.size]
+    return np.frombuffer(index, dtype=INDEX)
+
+
+class Index:
+    """Blocks of an encoded tile, see INDEX, and the flags of the tile"""
+
+    def __init__(self, blocks, flags):
+        self.blocks = blocks
+        self.flags = flags
+
+    @property
+    def nbytes(self):
+        return self.blocks.nbytes
+
+    def setflags(self, write):
+        self.blocks.setflags(write=write)
+
+    def overlapping(self, west, south, east, north):
+        """Blocks which may have features within bounds"""
+        blocks = self.blocks
+        return np.flatnonzero(
+            (blocks["west"] <= east)
+            & (west <= blocks["east"])
+            & (blocks["south"] <= north)
+            & (south <= blocks["north"])
+        ).tolist()
+
+
+def decode_blocks(payloads, rows, flags):
+    return [
+        decode_block(payload, count, flags)
+        for payload, count in zip(payloads, rows)
+    ]
+
+
+def decode_block(payload, rows, flags, block=None):
+    """Rows of a block, decoded into block if given"""
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    if block is None:
+        block = np.empty(rows, dtype=DTYPE)
+    offset = 0
+    for name in DTYPE.names:
+        dtype = DTYPE.fields[name][0]
+        size = rows * dtype.itemsize
+        if flags & FLAG_SHUFFLE:
+            column = np.frombuffer(
+                payload, dtype=np.uint8, count=size, offset=offset
+            )
+            column = column.reshape(dtype.itemsize, rows).T.copy()
+            column = column.view(dtype).reshape(rows)
+        else:
+            column = np.frombuffer(
+                payload, dtype=dtype, count=rows, offset=offset
+            )
+        block[name] = column
+        offset += size
+    return block
+
+
+def decode_legacy(blob):
+    """Newline-delimited JSON tuples compressed with zlib"""
+    return to_array(
+        [
+            tuple(json.loads(line))
+            for line in zlib.decompress(blob).decode().split("\n")
+            if line
+        ]
+    )
@@ -0,0 +1,616 @@
+"""getData formats: each writer turns batches of nodes into bytes, which
+export() streams in chunks of about EXPORT_CHUNK bytes"""
+
+import io
+import math
+import struct
+import tempfile
+
+import numpy as np
+import simplejson as json
+
+from . import AGGREGATE_CELLS, AGGREGATE_LEVELS
+from .cluster import CLUSTER, aggregate, tile_cells, tile_zoom
+from .process import feature_to_geojson, generate_tiles
+
+EXPORT_CHUNK = 2**16
+COLUMNS = (
+    "lon",
+    "lat",
+    "id",
+    "creation",
+    "lastedit",
+    "revisions",
+    "frequency",
+)
+ROW = "%r,%r,%d,%r,%r,%d,%r\n"
+FEATURE = (
+    '{"type": "Feature", "geometry": {"type": "Point", "coordinates": '
+    '[%r, %r]}, "properties": {"id": %d, "creation": %r, "lastedit": %r, '
+    '"revisions": %d, "frequency": %r}}'
+)
+CLUSTER_FEATURE = (
+    '{"type": "Feature", "geometry": {"type": "Point", "coordinates": '
+    '[%r, %r]}, "properties": {%s"count": %d, "creation": %r, '
+    '"lastedit": %r, "revisions": %r, "frequency": %r, '
+    '"revisions_min": %d, "revisions_max": %d}}'
+)
+
+
+async def export(writer, multipolygon, start, end, *filters, **headers):
+    yield b""  # signal
+    tiles = generate_tiles(multipolygon, start, end, *filters, **headers)
+    tiled = getattr(writer, "tiled", False)
+
+    async def pieces():
+        for encoded in writer.start():
+            yield encoded
+        async for quadkey, batch in tiles:
+            written = (
+                writer.write(batch, quadkey) if tiled else writer.write(batch)
+            )
+            for encoded in written:
+                yield encoded
+        for encoded in writer.finish():
+            yield encoded
+
+    chunk = []
+    size = 0
+    async for encoded in pieces():
+        chunk.append(encoded)
+        size += len(encoded)
+        if size >= EXPORT_CHUNK:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    yield b"".join(chunk)
+
+
+def blocks(features, rows):
+    for offset in range(0, len(features), rows):
+        yield features[offset : offset + rows]
+
+
+def features_to_geojson(features):
+    """feature_to_geojson() of each feature, joined by ", ", formatted with
+    a template except for the frequencies that JSON cannot represent"""
+    return ", ".join(
+        [
+            FEATURE % row if math.isfinite(row[6]) else feature_to_geojson(row)
+            for row in features.tolist()
+        ]
+    ).encode()
+
+
+class GeoJSON:
+    content_type = "application/json"
+    extension = "geojson"
+    rows = 128
+
+    def __init__(self):
+        self.separator = b""
+
+    def start(self):
+        yield b'{"type": "FeatureCollection", "features": ['
+
+    def write(self, features):
+        for block in blocks(features, self.rows):
+            yield self.separator + features_to_geojson(block)
+            self.separator = b", "
+
+    def finish(self):
+        yield b"]}"
+
+
+def cluster_to_geojson(row):
+    lon, lat, id, count, *values = row
+    properties = {"id": id} if count == 1 else {}
+    properties["count"] = count
+    properties.update(zip(CLUSTER.names[4:], values))
+    return json.dumps(
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": properties,
+        },
+        use_decimal=True,
+        ignore_nan=True,
+    )
+
+
+def clusters_to_geojson(clusters):
+    """Like features_to_geojson(), for clusters: id is only written for
+    single nodes"""
+    return ", ".join(
+        [
+            CLUSTER_FEATURE
+            % (lon, lat, f'"id": {id}, ' if count == 1 else "", count, *rest)
+            if math.isfinite(rest[3])
+            else cluster_to_geojson((lon, lat, id, count, *rest))
+            for lon, lat, id, count, *rest in clusters.tolist()
+        ]
+    ).encode()
+
+
+class Aggregated(GeoJSON):
+    """GeoJSON with a point per tile of zoom + AGGREGATE_LEVELS, or of a
+    lower zoom if there are more than AGGREGATE_CELLS of them in bbox: the
+    number of nodes, the percentile of each metric and the range of the
+    revisions
+
+    Tiles come in depth-first order, so the nodes of a cell are kept only
+    until a tile out of it comes, and tiles larger than a cell are
+    aggregated as they come."""
+
+    tiled = True
+
+    def __init__(self, bbox, zoom, percentile=50):
+        super().__init__()
+        self.zoom = tile_zoom(bbox, zoom + AGGREGATE_LEVELS, AGGREGATE_CELLS)
+        self.percentile = percentile
+        self.cell = None  # quadkey of the cell of the pending nodes
+        self.pending = []
+
+    def write(self, features, quadkey):
+        if len(quadkey) < self.zoom:
+            yield from self.flush()
+            yield from self.emit(features)
+            return
+        cell = quadkey[: self.zoom]
+        if cell != self.cell:
+            yield from self.flush()
+            self.cell = cell
+        self.pending.append(features)
+
+    def flush(self):
+        if self.pending:
+            features = np.concatenate(self.pending)
+            self.pending = []
+            yield from self.emit(features)
+        self.cell = None
+
+    def emit(self, features):
+        if len(features) == 0:
+            return
+        cells, size = tile_cells(features["lon"], features["lat"], self.zoom)
+        clusters = aggregate(features, cells, size, self.percentile)
+        for block in blocks(clusters, self.rows):
+            yield self.separator + clusters_to_geojson(block)
+            self.separator = b", "
+
+    def finish(self):
+        yield from self.flush()
+        yield from super().finish()
+
+
+class CSV:
+    """The same numbers as in GeoJSON, one node per line"""
+
+    content_type = "text/csv"
+    extension = "csv"
+    rows = 1024
+
+    def start(self):
+        yield (",".join(COLUMNS) + "\n").encode()
+
+    def write(self, features):
+        for block in blocks(features, self.rows):
+            yield "".join([ROW % row for row in block.tolist()]).encode()
+
+    def finish(self):
+        return ()
+
+
+class GeoParquet:
+    """Points as WKB, with the GeoParquet 1.0 metadata, in row groups of at
+    least row_group nodes (the parquet extra)"""
+
+    content_type = "application/vnd.apache.parquet"
+    extension = "parquet"
+    row_group = 2**16
+    compression = "zstd"
+
+    def __init__(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        metadata = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {
+                "geometry": {"encoding": "WKB", "geometry_types": ["Point"]}
+            },
+        }
+        self.schema = pyarrow.schema(
+            [
+                ("geometry", pyarrow.binary()),
+                ("id", pyarrow.int64()),
+                ("creation", pyarrow.float64()),
+                ("lastedit", pyarrow.float64()),
+                ("revisions", pyarrow.int64()),
+                ("frequency", pyarrow.float64()),
+            ],
+            metadata={"geo": json.dumps(metadata)},
+        )
+        self.sink = Sink()
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.sink, self.schema, compression=self.compression
+        )
+        self.pending = []
+        self.rows = 0
+
+    def flush(self):
+        if self.pending:
+            features = np.concatenate(self.pending)
+            self.pending = []
+            self.rows = 0
+            self.writer.write_table(self.table(features))
+        return self.sink.drain()
+
+    def table(self, features):
+        pyarrow = self.pyarrow
+        geometry = pyarrow.Array.from_buffers(
+            pyarrow.binary(),
+            len(features),
+            [
+                None,
+                pyarrow.py_buffer(
+                    np.arange(len(features) + 1, dtype=np.int32) * WKB.itemsize
+                ),
+                pyarrow.py_buffer(wkb_points(features).tobytes()),
+            ],
+        )
+        columns = [geometry] + [
+            pyarrow.array(features[name]) for name in self.schema.names[1:]
+        ]
+        return pyarrow.Table.from_arrays(columns, schema=self.schema)
+
+    def start(self):
+        return ()
+
+    def write(self, features):
+        self.pending.append(features)
+        self.rows += len(features)
+        if self.rows >= self.row_group:
+            yield self.flush()
+
+    def finish(self):
+        yield self.flush()
+        self.writer.close()
+        yield self.sink.drain()
+
+
+class Sink(io.RawIOBase):
+    """Write-only file, drained as the writer goes"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        drained = b"".join(self.chunks)
+        self.chunks = []
+        return drained
+
+
+WKB = np.dtype([("order", "u1"), ("type", "<u4"), ("x", "<f8"), ("y", "<f8")])
+
+
+def wkb_points(features):
+    points = np.empty(len(features), dtype=WKB)
+    points["order"] = 1  # little endian
+    points["type"] = 1  # point
+    points["x"] = features["lon"]
+    points["y"] = features["lat"]
+    return points
+
+
+class FlatGeobuf:
+    """Points with a packed Hilbert R-tree, which comes before the features
+    and needs all of them: features are encoded as they come and spooled
+    to a temporary file, only their coordinates are kept to sort and index
+    them, then they are read back in order https://flatgeobuf.org"""
+
+    content_type = "application/octet-stream"
+    extension = "fgb"
+    rows = 4096
+    node_size = 16
+
+    def __init__(self):
+        self.template, self.layout = feature_template()
+        self.spool = tempfile.TemporaryFile()  # noqa: SIM115
+        self.points = []
+
+    def start(self):
+        return ()
+
+    def write(self, features):
+        records = np.empty(len(features), dtype=self.layout)
+        raw = records.view(np.uint8).reshape(len(features), len(self.template))
+        raw[:] = np.frombuffer(self.template, dtype=np.uint8)
+        for name in self.layout.names:
+            records[name] = features[name]
+        self.spool.write(records.tobytes())
+        points = np.empty(len(features), dtype=POINTS)
+        points["lon"], points["lat"] = features["lon"], features["lat"]
+        self.points.append(points)
+        return ()
+
+    def finish(self):
+        with self.spool:
+            points = np.concatenate(self.points or [np.empty(0, POINTS)])
+            self.points = []
+            yield MAGIC
+            if len(points) == 0:
+                yield header(points, 0)
+                return
+            order = np.argsort(hilbert_order(points))
+            points = points[order]
+            yield header(points, self.node_size)
+            yield packed_rtree(points, self.node_size, len(self.template))
+            self.spool.flush()
+            record = np.dtype((np.void, len(self.template)))
+            records = np.memmap(self.spool, dtype=record, mode="r")
+            for block in blocks(order, self.rows):
+                yield records[block].tobytes()
+
+
+# FlatGeobuf 3 schema: field indices, types and enums
+MAGIC = b"fgb\x03fgb\x01"
+POINTS = np.dtype([("lon", "<f8"), ("lat", "<f8")])
+POINT = 1
+LONG, DOUBLE = 7, 10
+PROPERTIES = (("id", LONG), ("creation", DOUBLE), ("lastedit", DOUBLE))
+PROPERTIES += (("revisions", LONG), ("frequency", DOUBLE))
+HILBERT_MAX = 2**16 - 1
+
+
+class Builder:
+    """Minimal size-prefixed FlatBuffers writer, laid out front to back:
+    each vtable comes right before its table, children after it
+
+    Fields are {index: value}: values are (struct format, number) scalars,
+    str, numpy arrays (vectors) or dicts (tables), a list of dicts is a
+    vector of tables. marks are where the data of each array starts, in
+    the order they were written."""
+
+    def __init__(self):
+        self.buffer = bytearray(8)  # size prefix, root offset
+        self.marks = []
+
+    def finish(self, fields):
+        root = self.table(fields)
+        struct.pack_into("<I", self.buffer, 4, root - 4)
+        self.pad(8)
+        struct.pack_into("<I", self.buffer, 0, len(self.buffer) - 4)
+        return bytes(self.buffer)
+
+    def pad(self, alignment):
+        self.buffer.extend(bytes(-len(self.buffer) % alignment))
+
+    def table(self, fields):
+        inline = []
+        for index, value in fields.items():
+            fmt = value[0] if isinstance(value, tuple) else "<I"
+            inline.append((struct.calcsize(fmt), index, fmt, value))
+        inline.sort(key=lambda field: -field[0])
+        offsets = {}
+        size = 4  # vtable offset
+        for width, index, _, _ in inline:
+            size += -size % width
+            offsets[index] = size
+            size += width
+        size += -size % 4
+        count = max(fields, default=-1) + 1
+        vtable = struct.pack(
+            f"<{count + 2}H",
+            4 + 2 * count,
+            size,
+            *(offsets.get(index, 0) for index in range(count)),
+        )
+        # align the table start for 8 bytes fields
+        self.pad(2)
+        self.buffer.extend(bytes(-(len(self.buffer) + len(vtable)) % 8))
+        vtable_position = len(self.buffer)
+        self.buffer.extend(vtable)
+        position = len(self.buffer)
+        self.buffer.extend(bytes(size))
+        struct.pack_into(
+            "<i", self.buffer, position, position - vtable_position
+        )
+        for _, index, fmt, value in inline:
+            field = position + offsets[index]
+            if isinstance(value, tuple):
+                struct.pack_into(fmt, self.buffer, field, value[1])
+            else:
+                child = self.child(value)
+                struct.pack_into("<I", self.buffer, field, child - field)
+        return position
+
+    def child(self, value):
+        if isinstance(value, dict):
+            return self.table(value)
+        if isinstance(value, str):
+            value = np.frombuffer(value.encode() + b"\0", dtype="u1")
+            return self.vector(value, len(value) - 1)
+        if isinstance(value, list):
+            position = self.vector(np.zeros(len(value), dtype="<u4"))
+            for item, fields in enumerate(value):
+                element = position + 4 + 4 * item
+                child = self.table(fields)
+                struct.pack_into("<I", self.buffer, element, child - element)
+            return position
+        position = self.vector(value)
+        self.marks.append(position + 4)
+        return position
+
+    def vector(self, array, length=None):
+        self.pad(4)
+        self.buffer.extend(bytes(-(len(self.buffer) + 4) % array.itemsize))
+        position = len(self.buffer)
+        length = len(array) if length is None else length
+        self.buffer.extend(struct.pack("<I", length))
+        self.buffer.extend(array.tobytes())
+        return position
+
+
+def header(features, node_size):
+    columns = [
+        {0: name, 1: ("<B", kind), 7: ("<?", False)}
+        for name, kind in PROPERTIES
+    ]
+    fields = {
+        0: "is-osm-uptodate",
+        2: ("<B", POINT),
+        7: columns,
+        8: ("<Q", len(features)),
+        9: ("<H", node_size),
+        10: {0: "EPSG", 1: ("<i", 4326)},
+    }
+    if len(features):
+        lon, lat = features["lon"], features["lat"]
+        envelope = [lon.min(), lat.min(), lon.max(), lat.max()]
+        fields[1] = np.array(envelope, dtype="<f8")
+    return Builder().finish(fields)
+
+
+def feature_template():
+    """An encoded feature, with the dtype that fills in its values"""
+    properties = b"".join(
+        struct.pack("<H", column) + bytes(8)
+        for column in range(len(PROPERTIES))
+    )
+    builder = Builder()
+    template = builder.finish(
+        {
+            0: {1: np.zeros(2, dtype="<f8")},
+            1: np.frombuffer(properties, dtype="u1"),
+        }
+    )
+    xy, values = builder.marks
+    names, formats, offsets = ["lon", "lat"], ["<f8", "<f8"], [xy, xy + 8]
+    for column, (name, kind) in enumerate(PROPERTIES):
+        names.append(name)
+        formats.append("<i8" if kind == LONG else "<f8")
+        offsets.append(values + column * 10 + 2)
+    layout = np.dtype(
+        {
+            "names": names,
+            "formats": formats,
+            "offsets": offsets,
+            "itemsize": len(template),
+        }
+    )
+    return template, layout
+
+
+def hilbert(x, y):
+    """Position along the Hilbert curve of 16 bits coordinates, as in the
+    FlatGeobuf reference implementation"""
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+    for shift in (2, 4):
+        a, b, c, d = A, B, C, D
+        A = (a & (a >> shift)) ^ (b & (b >> shift))
+        B = (a & (b >> shift)) ^ (b & ((a ^ b) >> shift))
+        C = C ^ ((a & (c >> shift)) ^ (b & (d >> shift)))
+        D = D ^ ((b & (c >> shift)) ^ ((a ^ b) & (d >> shift)))
+
+    a, b, c, d = A, B, C, D
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+    for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333)):
+        i0 = (i0 | (i0 << shift)) & mask
+        i1 = (i1 | (i1 << shift)) & mask
+    i0 = (i0 | (i0 << 1)) & 0x55555555
+    i1 = (i1 | (i1 << 1)) & 0x55555555
+    return (i1 << 1) | i0
+
+
+def hilbert_order(features):
+    lon, lat = features["lon"], features["lat"]
+    scaled = []
+    for values in (lon, lat):
+        low, width = values.min(), values.max() - values.min()
+        if width:
+            values = np.floor(HILBERT_MAX * (values - low) / width)
+        else:
+            values = np.zeros(len(values))
+        scaled.append(values.astype(np.uint32))
+    return hilbert(*scaled)
+
+
+NODE = np.dtype(
+    [
+        ("min_x", "<f8"),
+        ("min_y", "<f8"),
+        ("max_x", "<f8"),
+        ("max_y", "<f8"),
+        ("offset", "<u8"),
+    ]
+)
+
+
+def packed_rtree(features, node_size, feature_size):
+    """Leaves point to the byte offset of each feature, parents to the
+    index of their first child; the root comes first"""
+    counts = [len(features)]
+    while True:
+        counts.append(-(-counts[-1] // node_size))
+        if counts[-1] == 1:
+            break
+    nodes = np.empty(sum(counts), dtype=NODE)
+    starts = np.sum(counts) - np.cumsum(counts)
+
+    leaves = nodes[starts[0] :]
+    leaves["min_x"] = leaves["max_x"] = features["lon"]
+    leaves["min_y"] = leaves["max_y"] = features["lat"]
+    leaves["offset"] = np.arange(len(features)) * feature_size
+    for level in range(len(counts) - 1):
+        start = starts[level]
+        children = nodes[start : start + counts[level]]
+        groups = np.arange(0, counts[level], node_size)
+        parents = nodes[starts[level + 1] : starts[level + 1] + len(groups)]
+        for name, reduce in (
+            ("min_x", np.minimum),
+            ("min_y", np.minimum),
+            ("max_x", np.maximum),
+            ("max_y", np.maximum),
+        ):
+            parents[name] = reduce.reduceat(children[name], groups)
+        parents["offset"] = start + groups
+    return nodes.tobytes()
+
+
+FORMATS = {
+    "geojson": GeoJSON,
+    "csv": CSV,
+    "parquet": GeoParquet,
+    "fgb": FlatGeobuf,
+}
@@ -1,9 +1,7 @@
-import gzip
-import urllib.request
-
 from aiohttp import web
 
 from . import API_OSM
+from .client import get_session
 from .utils import generateHeaders
 
 
@@ -11,10 +9,8 @@ async def getFeature(request):
     feature_type = request.rel_url.query.get("feature_type", "node")
     feature_id = request.rel_url.query.get("feature_id")
     referer = request.headers.get("REFERER", "http://localhost:8000/")
-    request = urllib.request.Request(
+    async with get_session().get(
         f"{API_OSM}/{feature_type}/{feature_id}.json",
         headers=generateHeaders(referer),
-    )
-    with urllib.request.urlopen(request) as resp_gzipped:
-        resp = gzip.GzipFile(fileobj=resp_gzipped)
-        return web.Response(body=resp.read())
+    ) as resp:
+        return web.Response(body=await resp.read())
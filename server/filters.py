@@ -0,0 +1,156 @@
+"""Evaluate ohsome filters on cached tags, instead of asking ohsome for
+the nodes matching each of them: https://docs.ohsome.org/ohsome-api/v1/
+
+Only a subset is supported: key=value, key=*, key!=value, key!=*,
+key in (values), type:, and, or, not and parentheses. parse() raises
+UnsupportedFilter for anything else, which is left to ohsome."""
+
+import re
+
+import numpy as np
+
+TOKENS = re.compile(
+    r'\s*(?:(?P<symbol>!=|[=(),])|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    r'|(?P<word>[^\s=!(),"]+))'
+)
+TYPES = ("node", "way", "relation")
+
+
+class UnsupportedFilter(ValueError):
+    pass
+
+
+def tokenize(expression):
+    """(kind, text) pairs; quoted strings are never keywords"""
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKENS.match(expression, position)
+        if match is None:
+            raise UnsupportedFilter(expression)
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "quoted":
+            text = re.sub(r"\\(.)", r"\1", text)
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+def parse(expression):
+    """Nested tuples: ("tag", key, value or None for any value),
+    ("type", name), ("not", a), ("and", a, b) and ("or", a, b)"""
+    tokens = tokenize(expression)
+    position = 0
+
+    def peek(*expected):
+        if position < len(tokens) and tokens[position] in expected:
+            return tokens[position]
+
+    def take(*expected):
+        nonlocal position
+        if position >= len(tokens):
+            raise UnsupportedFilter(expression)
+        token = tokens[position]
+        if expected and token not in expected:
+            raise UnsupportedFilter(expression)
+        position += 1
+        return token
+
+    def string():
+        kind, text = take()
+        if kind == "symbol":
+            raise UnsupportedFilter(expression)
+        return text
+
+    def value():
+        kind, text = take()
+        if kind == "word" and text == "*":
+            return None
+        if kind == "symbol":
+            raise UnsupportedFilter(expression)
+        return text
+
+    def disjunction():
+        left = conjunction()
+        while peek(("word", "or")):
+            take()
+            left = ("or", left, conjunction())
+        return left
+
+    def conjunction():
+        left = negation()
+        while peek(("word", "and")):
+            take()
+            left = ("and", left, negation())
+        return left
+
+    def negation():
+        if peek(("word", "not")):
+            take()
+            return ("not", negation())
+        if peek(("symbol", "(")):
+            take()
+            inner = disjunction()
+            take(("symbol", ")"))
+            return inner
+        return selector()
+
+    def selector():
+        kind, text = tokens[position] if position < len(tokens) else ("", "")
+        key = string()
+        if peek(("symbol", "=")):
+            take()
+            return ("tag", key, value())
+        if peek(("symbol", "!=")):
+            take()
+            return ("not", ("tag", key, value()))
+        if peek(("word", "in")):
+            take()
+            take(("symbol", "("))
+            alternatives = ("tag", key, string())
+            while peek(("symbol", ",")):
+                take()
+                alternatives = ("or", alternatives, ("tag", key, string()))
+            take(("symbol", ")"))
+            return alternatives
+        selected, _, name = text.partition(":")
+        if kind == "word" and selected == "type" and name in TYPES:
+            return ("type", name)
+        raise UnsupportedFilter(expression)
+
+    parsed = disjunction()
+    if position != len(tokens):
+        raise UnsupportedFilter(expression)
+    return parsed
+
+
+def evaluate(expression, tags):
+    """Whether each version matches, given the tags of the versions of
+    the nodes: see history.History"""
+    index = {string: number for number, string in enumerate(tags.strings)}
+    count = len(tags.versions) - 1
+    owner = np.repeat(np.arange(count), np.diff(tags.versions))
+
+    def matches(node):
+        operator = node[0]
+        if operator == "and":
+            return matches(node[1]) & matches(node[2])
+        if operator == "or":
+            return matches(node[1]) | matches(node[2])
+        if operator == "not":
+            return ~matches(node[1])
+        if operator == "type":
+            return np.full(count, node[1] == "node")
+        _, key, value = node
+        result = np.zeros(count, dtype=bool)
+        if key not in index or (value is not None and value not in index):
+            return result
+        found = tags.keys == index[key]
+        if value is not None:
+            found &= tags.values == index[value]
+        result[owner[found]] = True
+        return result
+
+    return matches(expression)
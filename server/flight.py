@@ -0,0 +1,179 @@
+"""Single-flight fetches: at most one computation per key is in flight,
+among the coroutines of a worker and among the workers sharing Redis"""
+
+import asyncio
+import collections
+import uuid
+
+import aiohttp
+import redis.asyncio
+
+from . import FLIGHT_TIMEOUT, REDIS_HOST, db
+from .metrics import timer
+from .pool import Budget, budget
+
+LOCK = "flight:lock:"
+CHANNEL = "flight:done:"
+
+inflight = {}
+listener = None
+
+RELEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+release = db.register_script(RELEASE)
+
+
+class FlightError(aiohttp.ClientResponseError):
+    """A fetch failed in another worker"""
+
+    def __init__(self, status, message):
+        super().__init__(None, (), status=status, message=message)
+
+    def __str__(self):
+        return f"{self.status}, message={self.message!r}"
+
+
+class Listener:
+    """One pub/sub connection per worker, waking up the waiting futures"""
+
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = client.pubsub()
+        self.waiters = collections.defaultdict(set)
+        self.loop = asyncio.get_running_loop()
+        self.started = asyncio.ensure_future(self.start())
+        self.task = None
+
+    async def start(self):
+        await self.pubsub.psubscribe(f"{CHANNEL}*")
+        while True:  # wait for the subscription to be confirmed
+            message = await self.pubsub.get_message(timeout=1)
+            if message and message["type"] == "psubscribe":
+                break
+        self.task = asyncio.ensure_future(self.listen())
+
+    async def listen(self):
+        async for message in self.pubsub.listen():
+            if message["type"] != "pmessage":
+                continue
+            key = message["channel"][len(CHANNEL) :].decode()
+            for future in self.waiters.pop(key, ()):
+                if not future.done():
+                    future.set_result(message["data"].decode())
+
+    def wait(self, key):
+        future = self.loop.create_future()
+        self.waiters[key].add(future)
+        return future
+
+    def discard(self, key, future):
+        waiters = self.waiters.get(key)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self.waiters[key]
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.pubsub.aclose()
+        await self.client.aclose()
+
+
+def connect():
+    return redis.asyncio.Redis(host=REDIS_HOST)
+
+
+async def get_listener():
+    global listener
+    if listener is None or listener.loop is not asyncio.get_running_loop():
+        listener = Listener(connect())
+    await asyncio.shield(listener.started)
+    return listener
+
+
+async def flight_listener(app):
+    yield
+    if listener is not None:
+        await listener.close()
+
+
+async def single_flight(key, load, fetch):
+    """Return load(), or else the result of fetch(), which is computed once
+    for all the concurrent callers and is expected to store its result, so
+    that load() finds it in other workers
+
+    fetch() does not run within the CPU budget of the first caller: the
+    CPU time it spends is charged to each caller once it is done."""
+    result = await load()
+    if result is not None:
+        return result
+    shared = inflight.get(key)
+    if shared is None:
+        spent = Budget(0)
+        future = asyncio.ensure_future(lead(key, load, fetch, spent))
+        shared = inflight[key] = future, spent
+        future.add_done_callback(lambda _: inflight.pop(key, None))
+        result = await asyncio.shield(future)
+    else:
+        with timer("flight_wait"):
+            result = await asyncio.shield(shared[0])
+    current = budget.get()
+    if current is not None:
+        current.charge(shared[1].used)
+    return result
+
+
+async def lead(key, load, fetch, spent):
+    budget.set(spent)  # within the task, not in the context of the caller
+    while True:
+        token = uuid.uuid4().hex
+        if db.set(LOCK + key, token, nx=True, ex=FLIGHT_TIMEOUT):
+            return await run(key, token, load, fetch)
+        # another worker is fetching: wait for it, or for its lock to expire
+        waiters = await get_listener()
+        waiting = waiters.wait(key)
+        try:
+            result = await load()
+            if result is not None:
+                return result
+            ttl = db.pttl(LOCK + key)
+            if ttl < 0:
+                continue
+            try:
+                with timer("flight_wait"):
+                    message = await asyncio.wait_for(waiting, ttl / 1000 + 1)
+            except asyncio.TimeoutError:
+                continue
+        finally:
+            waiters.discard(key, waiting)
+        if message:
+            status, reason = message.split(" ", 1)
+            raise FlightError(int(status), reason)
+        result = await load()
+        if result is not None:
+            return result
+
+
+async def run(key, token, load, fetch):
+    message = "502 Bad Gateway"
+    try:
+        result = await load()  # another worker may have just stored it
+        if result is None:
+            result = await asyncio.wait_for(fetch(), FLIGHT_TIMEOUT)
+        message = ""
+        return result
+    except aiohttp.ClientResponseError as error:
+        message = f"{error.status} {error.message}"
+        raise
+    except asyncio.TimeoutError:
+        message = "504 Gateway Timeout"
+        raise
+    finally:
+        release(keys=[LOCK + key], args=[token])
+        db.publish(CHANNEL + key, message)
@@ -1,9 +1,9 @@
-import urllib.error
-
+import aiohttp
+import mercantile
 from aiohttp import web
 
 from . import DEFAULT_FILTER
-from .process import generate
+from .export import FORMATS, Aggregated, export
 from .utils import (
     generateHeaders,
     get_updated_metadata,
@@ -19,35 +19,60 @@ async def getData(request):
     headers = generateHeaders(referer)
     filters = request.rel_url.query.get("filter")
     filters = [filters, DEFAULT_FILTER]
-    start, end = get_updated_metadata()
+    start, end = await get_updated_metadata()
+    format = request.rel_url.query.get("format", "geojson")
+    if format not in FORMATS:
+        return web.Response(text="Invalid param", status=400)
+    aggregate = request.rel_url.query.get("aggregate")
+    if aggregate is not None:
+        try:
+            zoom = int(aggregate)
+            percentile = int(request.rel_url.query.get("percentile", "50"))
+        except ValueError:
+            return web.Response(text="Invalid param", status=400)
+        if (
+            format != "geojson"
+            or not 0 <= zoom <= 24
+            or not 0 <= percentile <= 100
+        ):
+            return web.Response(text="Invalid param", status=400)
+        bbox = mercantile.Bbox(*multipolygon.bounds)
+        writer = Aggregated(bbox, zoom, percentile)
+    else:
+        try:
+            writer = FORMATS[format]()
+        except ImportError as error:
+            return web.Response(text=f"Missing {error.name}", status=501)
 
     start_short = timestamp_shortener(start)
     end_short = timestamp_shortener(end)
-    generated = generate(multipolygon, start, end, *filters, **headers)
+    generated = export(writer, multipolygon, start, end, *filters, **headers)
 
     try:
-        next(generated)  # peek
-    except urllib.error.HTTPError as error:
-        if error.code == 503:
-            return "ohsome", error.code
+        await anext(generated)  # peek
+    except aiohttp.ClientResponseError as error:
+        if error.status == 503:
+            return web.Response(text="ohsome", status=error.status)
         else:
-            return error.reason, error.code
+            return web.Response(text=error.message, status=error.status)
+    except web.HTTPException:
+        raise
     except Exception:
-        return "", 500
+        return web.Response(status=500)
     else:
         filename = (
-            f"is-osm-uptodate_{start_short}_{end_short}.geojson"
+            f"is-osm-uptodate_{start_short}_{end_short}.{writer.extension}"
         ).replace(":", "")
         response = web.StreamResponse(
             status=200,
             reason="OK",
             headers={
-                "Content-Type": "application/json",
+                "Content-Type": writer.content_type,
                 "Content-Disposition": f'attachment; filename="{filename}"',
             },
         )
         await response.prepare(request)
-        for chunk in generated:
-            await response.write(chunk.encode("utf-8"))
+        async for chunk in generated:
+            await response.write(chunk)
         await response.write_eof()
         return response
@@ -0,0 +1,109 @@
+"""The versions of the nodes of a tile with their tags, downloaded once
+for all the filters: see filters.py"""
+
+import io
+
+import numpy as np
+import simplejson as json
+
+from . import codec
+from .changes import to_timestamp, update_frequency
+from .filters import evaluate
+
+ARRAYS = ("features", "nodes", "valid_from", "versions", "keys", "values")
+
+
+class History:
+    """features as process() returns them, for the nodes alive at the end
+    of the history. The versions of node i are nodes[i]:nodes[i + 1],
+    valid from valid_from; the tags of version j are the keys and values
+    at versions[j]:versions[j + 1], indices of strings."""
+
+    def __init__(self, features, nodes, valid_from, versions, keys, values):
+        self.features = features
+        self.nodes = nodes
+        self.valid_from = valid_from
+        self.versions = versions
+        self.keys = keys
+        self.values = values
+        self.strings = []
+
+    @property
+    def nbytes(self):
+        arrays = sum(getattr(self, name).nbytes for name in ARRAYS)
+        return arrays + sum(map(len, self.strings))
+
+    def setflags(self, write):
+        for name in ARRAYS:
+            getattr(self, name).setflags(write=write)
+
+    def encode(self):
+        buffer = io.BytesIO()
+        strings = json.dumps(self.strings).encode()
+        np.savez_compressed(
+            buffer,
+            strings=np.frombuffer(strings, dtype=np.uint8),
+            **{name: getattr(self, name) for name in ARRAYS},
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def decode(cls, encoded):
+        with np.load(io.BytesIO(encoded)) as arrays:
+            history = cls(*(arrays[name] for name in ARRAYS))
+            history.strings = json.loads(arrays["strings"].tobytes())
+        return history
+
+    def select(self, expression):
+        """Features of the nodes matching expression at the end, created
+        when they first matched it, as ohsome does"""
+        matches = evaluate(expression, self)
+        if len(self.features) == 0:
+            return self.features.copy()
+        current = matches[self.nodes[1:] - 1]
+        index = np.where(matches, np.arange(len(matches)), len(matches))
+        first = np.minimum.reduceat(index, self.nodes[:-1])[current]
+        features = self.features[current]
+        features["creation"] = self.valid_from[first]
+        update_frequency(features)
+        return features
+
+
+class Builder:
+    def __init__(self):
+        self.rows = []
+        self.nodes = [0]
+        self.valid_from = []
+        self.versions = [0]
+        self.keys = []
+        self.values = []
+        self.strings = {}
+
+    def intern(self, string):
+        return self.strings.setdefault(string, len(self.strings))
+
+    def append(self, processed, versions):
+        """Add a node, unless process() has left it out, with its
+        (valid from, tags) versions"""
+        if processed is None:
+            return
+        self.rows.append(processed)
+        for valid_from, tags in versions:
+            self.valid_from.append(to_timestamp(valid_from))
+            for key, value in tags.items():
+                self.keys.append(self.intern(key))
+                self.values.append(self.intern(value))
+            self.versions.append(len(self.keys))
+        self.nodes.append(len(self.valid_from))
+
+    def build(self):
+        history = History(
+            codec.to_array(self.rows),
+            np.array(self.nodes, dtype=np.int64),
+            np.array(self.valid_from, dtype=np.float64),
+            np.array(self.versions, dtype=np.int64),
+            np.array(self.keys, dtype=np.uint32),
+            np.array(self.values, dtype=np.uint32),
+        )
+        history.strings = list(self.strings)
+        return history
@@ -0,0 +1,233 @@
+"""Build the tile cache from an OSM full-history extract (.osh.pbf)
+
+Requires pyosmium (pip install osmium). Nodes are reduced as the file is
+read, bucketed by quadkey into temporary files, then each quadkey is turned
+into the tuples of process() and stored like get_tile_data does, with
+the end it can be updated from and its densities, in parallel."""
+
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+import mercantile
+import numpy as np
+
+from . import DEFAULT_FILTER, Z_TARGET, codec
+from .client import get_session
+from .plan import record
+from .process import CACHE_TIMEOUT, latest_key, store, tile_cache_key
+from .storage import storage
+from .summary import tile_indices
+from .utils import get_updated_metadata
+
+RAW = np.dtype(
+    [
+        ("id", "<i8"),
+        ("first", "<i8"),
+        ("last", "<i8"),
+        ("version", "<i8"),
+        ("lon", "<f8"),
+        ("lat", "<f8"),
+    ]
+)
+CHUNK_ROWS = 1_000_000
+
+
+def epoch(timestamp):
+    return int(
+        datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+        .replace(tzinfo=datetime.timezone.utc)
+        .timestamp()
+    )
+
+
+class Reducer:
+    """Keep the versions of each node which ohsome would report as the
+    first and the last one between start and end"""
+
+    def __init__(self, start, end, flush):
+        self.start = start
+        self.end = end
+        self.flush = flush
+        self.rows = []
+        self.id = None
+        self.nodes = 0
+
+    def add(self, id, version, timestamp, visible, lon, lat):
+        if id != self.id:
+            self.emit()
+            self.id = id
+            self.first = self.last = None
+        if timestamp > self.end:
+            return
+        if timestamp <= self.start:
+            # only the version valid at start is returned, if any
+            self.first = (version, self.start) if visible else None
+        elif self.first is None and visible:
+            self.first = (version, timestamp)
+        self.last = (version, timestamp, lon, lat) if visible else None
+
+    def emit(self):
+        if self.id is None or self.first is None or self.last is None:
+            return
+        version, timestamp, lon, lat = self.last
+        timestamp = max(timestamp, self.start)
+        self.rows.append(
+            (self.id, self.first[1], timestamp, version, lon, lat)
+        )
+        self.nodes += 1
+        if len(self.rows) >= CHUNK_ROWS:
+            self.drain()
+
+    def drain(self):
+        if self.rows:
+            self.flush(np.array(self.rows, dtype=RAW))
+            self.rows = []
+
+    def close(self):
+        self.emit()
+        self.id = None
+        self.drain()
+
+
+def spill(directory, rows):
+    """Append rows to one file per Z_TARGET quadkey"""
+    x, y = tile_indices(rows["lon"], rows["lat"], Z_TARGET)
+    cells = y * 2**Z_TARGET + x
+    order = np.argsort(cells, kind="stable")
+    rows, cells = rows[order], cells[order]
+    unique, starts = np.unique(cells, return_index=True)
+    for cell, begin, finish in zip(
+        unique.tolist(), starts.tolist(), np.r_[starts[1:], len(cells)]
+    ):
+        tile = mercantile.Tile(
+            cell % 2**Z_TARGET, cell // 2**Z_TARGET, Z_TARGET
+        )
+        path = os.path.join(directory, mercantile.quadkey(tile))
+        with open(path, "ab") as spilled:
+            spilled.write(rows[begin:finish].tobytes())
+
+
+def to_features(rows, now):
+    """Vectorized process()"""
+    rows = np.sort(rows, order="id")
+    features = np.empty(len(rows), dtype=codec.DTYPE)
+    features["lon"] = rows["lon"]
+    features["lat"] = rows["lat"]
+    features["id"] = rows["id"]
+    features["creation"] = naive_timestamps(rows["first"])
+    features["lastedit"] = naive_timestamps(rows["last"])
+    features["revisions"] = rows["version"]
+    days = np.maximum((now - rows["first"]) // (60 * 60 * 24), 1)
+    features["frequency"] = rows["version"] / (days / 365)
+    return features
+
+
+def naive_timestamps(epochs):
+    """process() reads timestamps as naive datetimes, in local time"""
+    unique, inverse = np.unique(epochs, return_inverse=True)
+    converted = [
+        datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+        .replace(tzinfo=None)
+        .timestamp()
+        for value in unique.tolist()
+    ]
+    return np.array(converted, dtype=np.float64)[inverse]
+
+
+def load_tile(path, start, end, now):
+    quadkey = os.path.basename(path)
+    with open(path, "rb") as spilled:
+        rows = np.frombuffer(spilled.read(), dtype=RAW)
+    features = to_features(rows, now)
+    cache_key = tile_cache_key(quadkey, start, end, None, DEFAULT_FILTER)
+    store(cache_key, quadkey, features)
+    latest = latest_key(quadkey, start, DEFAULT_FILTER)
+    storage.set(latest, end.encode(), CACHE_TIMEOUT)
+    record(quadkey, features)
+    os.remove(path)
+    return len(features)
+
+
+def read(path, reducer):
+    try:
+        import osmium
+    except ImportError:
+        sys.exit("pyosmium is required: pip install osmium")
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, node):
+            location = node.location
+            reducer.add(
+                node.id,
+                node.version,
+                int(node.timestamp.timestamp()),
+                node.visible and location.valid(),
+                location.lon if location.valid() else 0.0,
+                location.lat if location.valid() else 0.0,
+            )
+
+    Handler().apply_file(path, locations=False)
+    reducer.close()
+
+
+async def metadata():
+    try:
+        return await get_updated_metadata()
+    finally:
+        await get_session().close()
+
+
+def report(stage, count, unit, elapsed):
+    print(
+        f"{stage}: {count} {unit} in {elapsed:.1f}s "
+        f"({count / max(elapsed, 1e-9):.0f} {unit}/s)",
+        file=sys.stderr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", help="OSM full-history extract (.osh.pbf)")
+    parser.add_argument("--start", help="defaults to the ohsome metadata")
+    parser.add_argument("--end", help="defaults to the ohsome metadata")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    start, end = args.start, args.end
+    if start is None or end is None:
+        start, end = asyncio.run(metadata())
+        start, end = args.start or start, args.end or end
+
+    with tempfile.TemporaryDirectory() as directory:
+        began = time.perf_counter()
+        reducer = Reducer(
+            epoch(start), epoch(end), lambda rows: spill(directory, rows)
+        )
+        read(args.path, reducer)
+        report("read", reducer.nodes, "nodes", time.perf_counter() - began)
+
+        began = time.perf_counter()
+        now = time.time()
+        paths = [
+            os.path.join(directory, name) for name in os.listdir(directory)
+        ]
+        nodes = 0
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            loading = [
+                executor.submit(load_tile, path, start, end, now)
+                for path in paths
+            ]
+            for done, future in enumerate(
+                concurrent.futures.as_completed(loading), 1
+            ):
+                nodes += future.result()
+                if done % 100 == 0 or done == len(loading):
+                    print(f"{done}/{len(loading)} tiles", file=sys.stderr)
+        elapsed = time.perf_counter() - began
+        report("stored", len(paths), "tiles", elapsed)
+        report("stored", nodes, "nodes", elapsed)
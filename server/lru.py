@@ -0,0 +1,82 @@
+"""Decoded tiles kept by each worker in front of Redis: the map tiles
+within the same Z_TARGET tile are rendered from a single decoding"""
+
+import collections
+
+from . import TILE_MEMORY_CACHE
+from .metrics import MEMORY_CACHE, MEMORY_CACHE_BYTES
+
+
+class LRU:
+    """Least recently used arrays, or anything with nbytes and setflags(),
+    within capacity bytes
+
+    Arrays larger than a fraction of the capacity are not kept, since they
+    would evict many smaller ones. Entries belong to the end timestamp of
+    the ohsome data: those of older ends are dropped once a newer one is
+    used, while requests for an older end, such as those served from the
+    previous metadata during a prewarm, only evict by size."""
+
+    def __init__(self, capacity, largest=1 / 8):
+        self.capacity = capacity
+        self.largest = capacity * largest
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.end = None
+        self.hits = self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        MEMORY_CACHE_BYTES.set(0)
+
+    def invalidate(self, end):
+        """Drop the entries older than end, if it is the newest one"""
+        if self.end is not None and end <= self.end:
+            return
+        self.end = end
+        for entry in [entry for entry in self.entries if entry[0] < end]:
+            self.size -= self.entries.pop(entry).nbytes
+        MEMORY_CACHE_BYTES.set(self.size)
+
+    def get(self, key, end):
+        self.invalidate(end)
+        features = self.entries.get((end, key))
+        if features is None:
+            self.misses += 1
+            MEMORY_CACHE.labels("miss").inc()
+            return None
+        self.entries.move_to_end((end, key))
+        self.hits += 1
+        MEMORY_CACHE.labels("hit").inc()
+        return features
+
+    def put(self, key, end, features):
+        """Keep features, which must not be modified from now on"""
+        self.invalidate(end)
+        if not self.capacity or features.nbytes > self.largest:
+            return features
+        features.setflags(write=False)
+        previous = self.entries.pop((end, key), None)
+        if previous is not None:
+            self.size -= previous.nbytes
+        self.entries[end, key] = features
+        self.size += features.nbytes
+        while self.size > self.capacity:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+        MEMORY_CACHE_BYTES.set(self.size)
+        return features
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+
+tiles = LRU(TILE_MEMORY_CACHE)
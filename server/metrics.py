@@ -0,0 +1,157 @@
+"""Prometheus metrics, and Server-Timing headers with the time spent in
+each stage of a request
+
+With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty
+directory, so that /metrics aggregates all of them."""
+
+import contextlib
+import contextvars
+import inspect
+import os
+import time
+
+import aiohttp
+import prometheus_client
+from aiohttp import web
+from prometheus_client import multiprocess
+
+from . import API, API_OSM, CONTRIBUTIONS, METADATA
+
+IN_FLIGHT = prometheus_client.Gauge(
+    "requests_in_flight",
+    "Requests being handled",
+    ["handler"],
+    multiprocess_mode="livesum",
+)
+TILE_CACHE = prometheus_client.Counter(
+    "tile_cache_requests", "Tiles loaded from Redis or fetched", ["result"]
+)
+TILE_CACHE_BYTES = prometheus_client.Counter(
+    "tile_cache_read_bytes", "Encoded tile bytes read from Redis"
+)
+FEATURES_DECODED = prometheus_client.Counter(
+    "features_decoded", "Nodes decoded from cached tiles"
+)
+MEMORY_CACHE = prometheus_client.Counter(
+    "tile_memory_cache_requests",
+    "Decoded tiles found in the memory of the worker, or not",
+    ["result"],
+)
+MEMORY_CACHE_BYTES = prometheus_client.Gauge(
+    "tile_memory_cache_bytes",
+    "Decoded tiles kept in the memory of the worker",
+    multiprocess_mode="livesum",
+)
+OHSOME = prometheus_client.Histogram(
+    "ohsome_request_seconds",
+    "Time to the response headers of ohsome",
+    ["endpoint", "status"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+STAGES = prometheus_client.Histogram(
+    "stage_seconds", "Time spent in each stage of the requests", ["stage"]
+)
+
+# label of the requests to each upstream URL prefix: paths can hold ids
+ENDPOINTS = {
+    API: "elements",
+    CONTRIBUTIONS: "contributions",
+    METADATA: "metadata",
+    API_OSM: "osm",
+}
+
+# stage -> seconds, for the Server-Timing header of the current request
+timings = contextvars.ContextVar("timings", default=None)
+# set in the pool, where the timings are returned to the caller instead
+deferred = contextvars.ContextVar("deferred", default=False)
+
+
+def record(stage, seconds):
+    if not deferred.get():
+        STAGES.labels(stage).observe(seconds)
+    current = timings.get()
+    if current is not None:
+        current[stage] = current.get(stage, 0) + seconds
+
+
+@contextlib.contextmanager
+def timer(stage):
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - began)
+
+
+def collect(function, *args):
+    """Run function, returning its result and the timings it recorded"""
+    collected = {}
+    timings.set(collected)
+    deferred.set(True)
+    return function(*args), collected
+
+
+def server_timing(current):
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}"
+        for stage, seconds in current.items()
+    )
+
+
+@web.middleware
+async def instrument(request, handler):
+    name = request.match_info.handler
+    name = "static" if inspect.ismethod(name) else name.__name__
+    current = {}
+    timings.set(current)
+    began = time.perf_counter()
+    with IN_FLIGHT.labels(name).track_inprogress():
+        response = await handler(request)
+    current["total"] = time.perf_counter() - began
+    # streamed responses have sent their headers already
+    if not response.prepared:
+        response.headers["Server-Timing"] = server_timing(current)
+    return response
+
+
+def endpoint(url):
+    """Name of the upstream endpoint of url, out of a fixed set"""
+    url = str(url)
+    for prefix, name in ENDPOINTS.items():
+        if url.startswith(prefix):
+            return name
+    return "other"
+
+
+def trace_config():
+    """Time the requests of a ClientSession"""
+
+    async def on_request_start(session, context, params):
+        context.began = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        observe(context, params.url, params.response.status)
+
+    async def on_request_exception(session, context, params):
+        observe(context, params.url, "error")
+
+    def observe(context, url, status):
+        elapsed = time.perf_counter() - context.began
+        OHSOME.labels(endpoint(url), str(status)).observe(elapsed)
+        record("ohsome", elapsed)
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
+
+
+async def metrics(request):
+    registry = prometheus_client.REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    response = web.Response(body=prometheus_client.generate_latest(registry))
+    response.headers["Content-Type"] = prometheus_client.CONTENT_TYPE_LATEST
+    return response
@@ -0,0 +1,153 @@
+"""Mapbox Vector Tiles of the nodes, encoded by hand: a single layer of
+points, https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+
+Below MVT_CLUSTER_ZOOM, nodes are clustered on a MVT_GRID x MVT_GRID grid:
+each cluster carries the number of nodes and the percentile of each
+metric, and the id only if it is a single node."""
+
+import struct
+
+import mercantile
+import numpy as np
+import shapely.geometry
+from aiohttp import web
+
+from . import DEFAULT_FILTER, MVT_CLUSTER_ZOOM, MVT_GRID, codec
+from .cluster import cluster
+from .pool import offload
+from .process import generate_batches
+from .tile import cached_response
+from .utils import generateHeaders, get_updated_metadata
+
+CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+EXTENT = 4096
+LAYER = "nodes"
+KEYS = ("id", "creation", "lastedit", "revisions", "frequency", "count")
+MOVE_TO = 1 | 1 << 3  # command 1, once
+POINT = 1
+VARINT, FIXED64, LENGTH = 0, 1, 2
+
+
+async def vector_tile(request):
+    z = int(request.match_info["z"])
+    x = int(request.match_info["x"])
+    y = int(request.match_info["y"])
+    referer = request.headers.get("REFERER", "http://localhost:8000/")
+    headers = generateHeaders(referer)
+    filters = request.rel_url.query.get("filter")
+    start, end = await get_updated_metadata()
+
+    percentile = int(request.rel_url.query.get("percentile", "50"))
+    if percentile < 0 or percentile > 100 or z < 11:
+        return web.Response(body=b"", content_type=CONTENT_TYPE)
+
+    params = (z, x, y, filters, percentile, start, end)
+    cache_key = "mvt_" + "_".join(map(str, params))
+
+    async def render_tile():
+        tile = mercantile.Tile(x, y, z)
+        area = shapely.geometry.box(*mercantile.bounds(tile))
+        batches = generate_batches(
+            area, start, end, filters, DEFAULT_FILTER, **headers
+        )
+        features = np.concatenate(
+            [batch async for batch in batches] or [np.empty(0, codec.DTYPE)]
+        )
+        return {cache_key: await offload(render, features, tile, percentile)}
+
+    return await cached_response(
+        request, cache_key, render_tile, CONTENT_TYPE, compress=True
+    )
+
+
+def render(features, tile, percentile):
+    if tile.z < MVT_CLUSTER_ZOOM:
+        bbox = mercantile.Bbox(*mercantile.bounds(tile))
+        features = cluster(features, bbox, MVT_GRID, percentile)
+    return encode(features, tile)
+
+
+def project(lon, lat, tile, extent=EXTENT):
+    """Integer tile coordinates of each node, in Web Mercator"""
+    bounds = mercantile.xy_bounds(tile)
+    x = np.radians(lon) * mercantile.RE
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * mercantile.RE
+    x = (x - bounds.left) / (bounds.right - bounds.left) * extent
+    y = (bounds.top - y) / (bounds.top - bounds.bottom) * extent
+    return np.round(x).astype(np.int64), np.round(y).astype(np.int64)
+
+
+def varint(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def tag(number, wire_type):
+    return varint(number << 3 | wire_type)
+
+
+def message(number, payload):
+    return tag(number, LENGTH) + varint(len(payload)) + payload
+
+
+def packed(number, values):
+    return message(number, b"".join(map(varint, values)))
+
+
+def value_message(value):
+    """Integers as sint64, anything else as double"""
+    if value.is_integer():
+        return message(4, tag(6, VARINT) + varint(zigzag(int(value))))
+    return message(4, tag(3, FIXED64) + struct.pack("<d", value))
+
+
+def encode(features, tile, extent=EXTENT):
+    """Tile with a point for each of the features, with the KEYS they have
+    as attributes; null ids are left out"""
+    if len(features) == 0:
+        return b""
+    keys = [key for key in KEYS if key in features.dtype.names]
+    columns = [features[key].astype(np.float64).tolist() for key in keys]
+    ids = features["id"].tolist()
+    x, y = project(features["lon"], features["lat"], tile, extent)
+
+    values = {}
+    encoded = []
+    for row, (column, line) in enumerate(zip(x.tolist(), y.tolist())):
+        tags = []
+        for index, key in enumerate(keys):
+            value = columns[index][row]
+            if key == "id" and not value:
+                continue
+            tags.append(index)
+            # 1 and 1.0 share the same value, encoded as an integer
+            tags.append(values.setdefault(value, len(values)))
+        feature = b"".join(
+            (
+                tag(1, VARINT) + varint(ids[row]) if ids[row] else b"",
+                packed(2, tags),
+                tag(3, VARINT) + varint(POINT),
+                packed(4, (MOVE_TO, zigzag(column), zigzag(line))),
+            )
+        )
+        encoded.append(message(2, feature))
+
+    layer = b"".join(
+        (
+            tag(15, VARINT) + varint(2),
+            message(1, LAYER.encode()),
+            *encoded,
+            *(message(3, key.encode()) for key in keys),
+            *(value_message(value) for value in values),
+            tag(5, VARINT) + varint(extent),
+        )
+    )
+    return message(3, layer)
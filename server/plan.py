@@ -0,0 +1,198 @@
+"""Adaptive fetch granularity: Z_TARGET tiles are split into their
+children where they are dense and only partly requested, and sparse
+siblings are merged into their parent, from the number of nodes seen in
+previous fetches"""
+
+import collections
+
+import mercantile
+import numpy as np
+
+from . import (
+    MERGE_LEVELS,
+    MERGE_NODES,
+    SPLIT_LEVELS,
+    SPLIT_NODES,
+    Z_TARGET,
+    db,
+)
+from .storage import storage
+from .summary import tile_indices
+
+DENSITY = "density:"
+# a hash per tile of the highest zoom which can be merged into, which
+# expires like the cached tiles, so that Redis can evict it
+DENSITY_ZOOM = max(Z_TARGET - MERGE_LEVELS, 0)
+DENSITY_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def density_key(quadkey):
+    return DENSITY + quadkey[:DENSITY_ZOOM]
+
+
+def densities(quadkey, features, levels=SPLIT_LEVELS):
+    """Nodes in the tile and in each of its descendants, levels down"""
+    root = mercantile.quadkey_to_tile(quadkey)
+    counts = {quadkey: len(features)}
+    for level in range(1, levels + 1):
+        zoom = root.z + level
+        x, y = tile_indices(features["lon"], features["lat"], zoom)
+        side = 2**level
+        x = np.clip(x - root.x * side, 0, side - 1)
+        y = np.clip(y - root.y * side, 0, side - 1)
+        cells = np.bincount(y * side + x, minlength=side * side).tolist()
+        for index, count in enumerate(cells):
+            tile = mercantile.Tile(
+                root.x * side + index % side,
+                root.y * side + index // side,
+                zoom,
+            )
+            counts[mercantile.quadkey(tile)] = count
+    return counts
+
+
+def record(quadkey, features):
+    shards = collections.defaultdict(dict)
+    for key, count in densities(quadkey, features).items():
+        shards[density_key(key)][key] = count
+    pipeline = db.pipeline(transaction=False)
+    for shard, counts in shards.items():
+        pipeline.hset(shard, mapping=counts)
+        pipeline.expire(shard, DENSITY_TIMEOUT)
+    pipeline.execute()
+
+
+def within(tile, bbox):
+    bounds = mercantile.bounds(tile)
+    return (
+        bbox.left <= bounds.west
+        and bounds.east <= bbox.right
+        and bbox.bottom <= bounds.south
+        and bounds.north <= bbox.top
+    )
+
+
+def intersecting(bbox, tiles):
+    for tile in tiles:
+        bounds = mercantile.bounds(tile)
+        if not (
+            bounds.east < bbox.left
+            or bbox.right < bounds.west
+            or bounds.north < bbox.bottom
+            or bbox.top < bounds.south
+        ):
+            yield tile
+
+
+def candidates(tiles, bbox, split_levels, merge_levels):
+    """Quadkeys whose density can change the plan of tiles"""
+    quadkeys = set()
+    for tile in tiles:
+        quadkeys.add(mercantile.quadkey(tile))
+        for level in range(1, min(merge_levels, tile.z) + 1):
+            parent = mercantile.parent(tile, zoom=tile.z - level)
+            quadkeys.update(
+                map(mercantile.quadkey, mercantile.children(parent))
+            )
+            quadkeys.add(mercantile.quadkey(parent))
+        if split_levels and not within(tile, bbox):
+            children = mercantile.children(tile, zoom=tile.z + split_levels)
+            for child in intersecting(bbox, children):
+                quadkey = mercantile.quadkey(child)
+                quadkeys.update(
+                    quadkey[:z] for z in range(tile.z + 1, child.z + 1)
+                )
+    return quadkeys
+
+
+def plan(
+    bbox,
+    tiles,
+    known,
+    cached,
+    split_nodes=SPLIT_NODES,
+    merge_nodes=MERGE_NODES,
+    split_levels=SPLIT_LEVELS,
+    merge_levels=MERGE_LEVELS,
+):
+    """Tiles to fetch instead of tiles, given the known number of nodes
+    and the cached quadkeys, which are fetched as they are"""
+    planned = []
+    pending = list(tiles)
+    z_target = min((tile.z for tile in tiles), default=0)
+    while pending:
+        tile = pending.pop()
+        quadkey = mercantile.quadkey(tile)
+        if (
+            tile.z < z_target + split_levels
+            and known.get(quadkey, 0) > split_nodes
+            and quadkey not in cached
+            and not within(tile, bbox)
+        ):
+            pending.extend(intersecting(bbox, mercantile.children(tile)))
+        else:
+            planned.append(tile)
+
+    for z in range(z_target, max(z_target - merge_levels, 0), -1):
+        siblings = collections.defaultdict(list)
+        split = set()
+        merged = set()
+        parents = []
+        for tile in planned:
+            if tile.z == z:
+                siblings[mercantile.parent(tile)].append(tile)
+            elif tile.z > z:
+                split.add(mercantile.parent(tile, zoom=z - 1))
+        for parent, children in siblings.items():
+            quadkey = mercantile.quadkey(parent)
+            total = known.get(quadkey)
+            if total is None:
+                counts = [
+                    known.get(mercantile.quadkey(child))
+                    for child in mercantile.children(parent)
+                ]
+                total = None if None in counts else sum(counts)
+            if (
+                total is None
+                or total > merge_nodes
+                or parent in split
+                or (
+                    quadkey not in cached
+                    and all(
+                        mercantile.quadkey(tile) in cached for tile in children
+                    )
+                )
+            ):
+                continue
+            merged.update(children)
+            parents.append(parent)
+        planned = [tile for tile in planned if tile not in merged] + parents
+    return sorted(planned, key=mercantile.quadkey)
+
+
+def plan_tiles(bbox, tiles, cache_key=None):
+    """plan() with the densities from Redis and the cached tiles, where
+    cache_key(quadkey) is the key of a cached tile"""
+    if not SPLIT_LEVELS and not MERGE_LEVELS or not tiles:
+        return tiles
+    quadkeys = sorted(candidates(tiles, bbox, SPLIT_LEVELS, MERGE_LEVELS))
+    pipeline = db.pipeline(transaction=False)
+    for quadkey in quadkeys:
+        pipeline.hget(density_key(quadkey), quadkey)
+    counts = pipeline.execute()
+    known = {
+        quadkey: int(count)
+        for quadkey, count in zip(quadkeys, counts)
+        if count is not None
+    }
+    if not known:
+        return tiles
+    # cached tiles can only prevent splitting and merging
+    planned = plan(bbox, tiles, known, set())
+    if planned == sorted(tiles, key=mercantile.quadkey):
+        return tiles
+    if cache_key is None:
+        return planned
+    exists = storage.exists(map(cache_key, quadkeys))
+    cached = {quadkey for quadkey, hit in zip(quadkeys, exists) if hit}
+    return plan(bbox, tiles, known, cached)
@@ -0,0 +1,95 @@
+"""CPU-bound work (decoding, parsing, rasterization) runs in a process pool,
+so that a large request cannot stall the event loop of a worker"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import multiprocessing
+import time
+
+from aiohttp import web
+
+from . import PROCESS_QUEUE, PROCESS_WORKERS, REQUEST_CPU_BUDGET
+from .metrics import collect, record
+
+budget = contextvars.ContextVar("budget", default=None)
+executor = None
+slots = None
+
+
+class BudgetExceeded(web.HTTPServiceUnavailable):
+    def __init__(self):
+        super().__init__(text="Request too large, try a smaller area")
+
+
+class Budget:
+    """CPU seconds a request may spend in the pool"""
+
+    def __init__(self, seconds=REQUEST_CPU_BUDGET):
+        self.seconds = seconds
+        self.used = 0.0
+
+    def check(self):
+        if self.seconds and self.used > self.seconds:
+            raise BudgetExceeded()
+
+    def charge(self, seconds):
+        self.used += seconds
+        self.check()
+
+
+@web.middleware
+async def cpu_budget(request, handler):
+    budget.set(Budget())
+    return await handler(request)
+
+
+def enabled():
+    return PROCESS_WORKERS > 0
+
+
+def get_executor():
+    global executor
+    if executor is None and enabled():
+        executor = concurrent.futures.ProcessPoolExecutor(
+            PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return executor
+
+
+def get_slots():
+    global slots
+    loop = asyncio.get_running_loop()
+    if slots is None or slots[0] is not loop:
+        slots = loop, asyncio.Semaphore(PROCESS_QUEUE)
+    return slots[1]
+
+
+def timed(function, *args):
+    began = time.thread_time()
+    result, timings = collect(function, *args)
+    return result, time.thread_time() - began, timings
+
+
+async def offload(function, *args):
+    """Run function in the pool (or in a thread, if disabled), waiting for
+    a free slot first, and charge its CPU time to the current request"""
+    current = budget.get()
+    if current is not None:
+        current.check()
+    loop = asyncio.get_running_loop()
+    async with get_slots():
+        result, elapsed, timings = await loop.run_in_executor(
+            get_executor(), timed, function, *args
+        )
+    for stage, seconds in timings.items():
+        record(stage, seconds)
+    if current is not None:
+        current.charge(elapsed)
+    return result
+
+
+async def process_pool(app):
+    yield
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
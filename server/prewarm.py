@@ -0,0 +1,106 @@
+"""Refetch the most requested tiles as soon as ohsome has new data, before
+switching the cached metadata to it"""
+
+import asyncio
+import logging
+import uuid
+
+import aiohttp
+
+from . import (
+    PREWARM_CONCURRENCY,
+    PREWARM_INTERVAL,
+    PREWARM_RATE,
+    PREWARM_TILES,
+    db,
+)
+from .process import HOT, get_tile_data
+from .utils import (
+    cache_metadata,
+    cached_metadata,
+    fetch_metadata,
+    generateHeaders,
+)
+
+LOCK = "prewarm:lock"
+REFERER = "http://localhost:8000/prewarm"
+
+logger = logging.getLogger(__name__)
+
+
+async def warm(start, end):
+    hot = db.zrevrange(HOT, 0, PREWARM_TILES - 1)
+    headers = generateHeaders(REFERER)
+    slots = asyncio.Semaphore(PREWARM_CONCURRENCY)
+
+    async def fetch(quadkey, filters):
+        try:
+            await get_tile_data(quadkey, start, end, filters, **headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logger.warning("Pre-warming %s failed: %r", quadkey, error)
+        except Exception:
+            logger.exception("Pre-warming %s failed", quadkey)
+        finally:
+            slots.release()
+
+    pending = []
+    for member in hot:
+        quadkey, filters = member.decode().split("_", 1)
+        await slots.acquire()
+        pending.append(asyncio.ensure_future(fetch(quadkey, filters)))
+        await asyncio.sleep(1 / PREWARM_RATE)
+    await asyncio.gather(*pending)
+
+    # halve the counts, so that the hot set follows the requests
+    db.zunionstore(HOT, {HOT: 0.5})
+    trim()
+    return len(hot)
+
+
+def trim():
+    """Keep the counts of the most requested tiles only"""
+    db.zremrangebyrank(HOT, 0, -4 * PREWARM_TILES - 1)
+
+
+async def refresh():
+    updated = await fetch_metadata()
+    if cached_metadata() == updated:
+        return
+    warmed = await warm(*updated)
+    logger.info("Pre-warmed %d tiles up to %s", warmed, updated[1])
+    cache_metadata(updated)
+
+
+async def renew(token):
+    """Hold the lock while refreshing, which can take longer than an
+    interval"""
+    while True:
+        await asyncio.sleep(PREWARM_INTERVAL / 2)
+        if db.get(LOCK) != token.encode():
+            return
+        db.pexpire(LOCK, round(PREWARM_INTERVAL * 1000))
+
+
+async def scheduler():
+    while True:
+        try:
+            # a single worker checks for updates at each interval
+            token = uuid.uuid4().hex
+            ttl = round(PREWARM_INTERVAL * 1000)
+            if db.set(LOCK, token, nx=True, px=ttl):
+                trim()
+                renewing = asyncio.ensure_future(renew(token))
+                try:
+                    await refresh()
+                finally:
+                    renewing.cancel()
+        except Exception:
+            logger.exception("Pre-warming failed")
+        await asyncio.sleep(PREWARM_INTERVAL)
+
+
+async def prewarm(app):
+    task = asyncio.ensure_future(scheduler()) if PREWARM_TILES else None
+    yield
+    if task:
+        task.cancel()
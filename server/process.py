@@ -1,70 +1,153 @@
+import asyncio
+import collections
 import datetime
-import gzip
-import urllib.error
-import urllib.request
-import zlib
+import io
+import itertools
+import tempfile
 
+import aiohttp
 import mercantile
+import numpy as np
 import shapely.geometry
 import simplejson as json
 from jsonslicer import JsonSlicer
 
-from . import API, Z_TARGET, db
-from .utils import get_updated_metadata, lonlat_in_bbox, shape_contains_feature
+from . import (
+    API,
+    CONTRIBUTIONS,
+    DEFAULT_FILTER,
+    FETCH_CONCURRENCY,
+    INCREMENTAL_UPDATES,
+    LOCAL_FILTERS,
+    Z_TARGET,
+    codec,
+    db,
+    pool,
+)
+from .changes import apply_changes
+from .client import SyncReader, get_session
+from .filters import UnsupportedFilter, parse
+from .flight import single_flight
+from .history import Builder, History
+from .lru import tiles
+from .metrics import FEATURES_DECODED, TILE_CACHE, TILE_CACHE_BYTES, timer
+from .plan import plan_tiles, record
+from .pool import offload
+from .storage import storage
+from .summary import Pyramid
+from .utils import bbox_mask, shape_mask
 
+CACHE_TIMEOUT = 60 * 60 * 24 * 30
+HOT = "hot"
+SPOOL_CHUNK = 2**16
+INDEX_READ = 2**12  # bytes read from the end of a tile for its index
 
-def peek(iterator):
-    """Get the next element from an iterator, twice"""
-    try:
-        first = next(iterator)
-    except StopIteration:
-        pass
-    else:
-        yield first
-        yield first
-    yield from iterator
-
-
-def generate_raw(multipolygon, start, end, *filters, **headers):
-    if not multipolygon.is_empty:
-        bbox = mercantile.Bbox(*multipolygon.bounds)
-        for tile in bbox_tiles(bbox, Z_TARGET):
-            tile_box = shapely.geometry.box(*mercantile.bounds(*tile))
-            sliced = multipolygon.intersection(tile_box)
-            if sliced.is_empty:
-                continue
-            fast_comparison = sliced.bounds == tile_box.bounds
-            quadkey = mercantile.quadkey(tile)
-            tiled_data = peek(
-                get_tile_data(quadkey, start, end, *filters, **headers)
+
+async def generate_raw(multipolygon, start, end, *filters, **headers):
+    batches = generate_batches(multipolygon, start, end, *filters, **headers)
+    async for batch in batches:
+        for feature in batch.tolist():
+            yield feature
+
+
+async def generate_batches(multipolygon, start, end, *filters, **headers):
+    tiles = generate_tiles(multipolygon, start, end, *filters, **headers)
+    async for _, batch in tiles:
+        yield batch
+
+
+async def generate_tiles(multipolygon, start, end, *filters, **headers):
+    """(quadkey, nodes within multipolygon) of each fetched tile, in
+    depth-first order: the tiles within any other tile come together"""
+    bbox = mercantile.Bbox(*multipolygon.bounds)
+    requested = []
+
+    def fetch(quadkey, bounds):
+        requested.append(quadkey)
+        if bounds is not None:
+            return get_tile_window(
+                quadkey, start, end, bounds, *filters, **headers
             )
-            try:
-                next(tiled_data)
-            except StopIteration:
-                pass
-            except urllib.error.HTTPError:
-                break
-            for feature in tiled_data:
+        return get_tile_data(quadkey, start, end, *filters, **headers)
+
+    tiles = fetch_tiles(multipolygon, fetch, tile_key(start, end, *filters))
+    try:
+        async for quadkey, sliced, fast_comparison, tiled_data in tiles:
+            lon, lat = tiled_data["lon"], tiled_data["lat"]
+            with timer("point_in_polygon"):
                 if fast_comparison:
-                    if lonlat_in_bbox(bbox, feature[0], feature[1]):
-                        yield feature
+                    mask = bbox_mask(bbox, lon, lat)
                 else:
-                    if shape_contains_feature(sliced, feature):
-                        yield feature
+                    mask = shape_mask(sliced, lon, lat)
+            yield quadkey, tiled_data[mask]
+    finally:
+        track(requested, *filters)
 
 
-def generate(multipolygon, start, end, *filters, **headers):
-    yield ""  # signal
-    yield '{"type": "FeatureCollection", "features": ['
-    first = True
-    for feature in generate_raw(multipolygon, start, end, *filters, **headers):
-        feature_geojson = feature_to_geojson(feature)
-        if not first:
-            yield ", "
-        if first and feature_geojson:
-            first = False
-        yield feature_geojson
-    yield "]}"
+async def generate_summaries(multipolygon, start, end, *filters, **headers):
+    requested = []
+
+    def fetch(quadkey, bounds):
+        requested.append(quadkey)
+        return get_tile_summary(quadkey, start, end, *filters, **headers)
+
+    tiles = fetch_tiles(multipolygon, fetch, tile_key(start, end, *filters))
+    try:
+        async for quadkey, sliced, fast_comparison, pyramid in tiles:
+            if fast_comparison:
+                yield pyramid.get(pyramid.root)
+                continue
+            contained, boundary = pyramid.cover(sliced)
+            for summaries in contained:
+                yield summaries
+            if boundary:
+                features = await get_tile_data(
+                    quadkey, start, end, *filters, **headers
+                )
+                yield await offload(pyramid.scan, features, sliced, boundary)
+    finally:
+        track(requested, *filters)
+
+
+async def fetch_tiles(multipolygon, fetch, cache_key=None):
+    """(quadkey, slice, whether the slice is the whole tile, result) for
+    each tile intersecting multipolygon, where the result is awaited from
+    fetch(quadkey, bounds of the slice, or None for the whole tile)"""
+    if multipolygon.is_empty:
+        return
+    bbox = mercantile.Bbox(*multipolygon.bounds)
+    slices = []
+    tiles = list(bbox_tiles(bbox, Z_TARGET))
+    for tile in plan_tiles(bbox, tiles, cache_key):
+        tile_box = shapely.geometry.box(*mercantile.bounds(*tile))
+        sliced = multipolygon.intersection(tile_box)
+        if sliced.is_empty:
+            continue
+        fast_comparison = sliced.bounds == tile_box.bounds
+        slices.append((mercantile.quadkey(tile), sliced, fast_comparison))
+
+    def schedule(quadkey, sliced, fast_comparison):
+        bounds = None if fast_comparison else sliced.bounds
+        return asyncio.ensure_future(fetch(quadkey, bounds))
+
+    # keep at most FETCH_CONCURRENCY tiles in flight, consume them in order
+    queued = iter(slices)
+    pending = collections.deque(
+        schedule(*queued_slice)
+        for queued_slice in itertools.islice(queued, FETCH_CONCURRENCY)
+    )
+    try:
+        for quadkey, sliced, fast_comparison in slices:
+            try:
+                result = await pending.popleft()
+            except aiohttp.ClientResponseError:
+                break
+            for queued_slice in itertools.islice(queued, 1):
+                pending.append(schedule(*queued_slice))
+            yield quadkey, sliced, fast_comparison, result
+    finally:
+        for task in pending:
+            task.cancel()
 
 
 def bbox_tiles(bbox, z_target, *tiles):
@@ -88,85 +171,442 @@ def bbox_tiles(bbox, z_target, *tiles):
             yield from bbox_tiles(bbox, z_target, *mercantile.children(tile))
 
 
-def stream_to_processed(resp):
+Version = collections.namedtuple(
+    "Version", ("osmid", "valid_from", "valid_to", "version", "lon", "lat")
+)
+
+
+def to_version(feature):
+    properties = feature["properties"]
+    coordinates = feature["geometry"]["coordinates"]
+    return Version(
+        properties["@osmId"],
+        properties["@validFrom"],
+        properties["@validTo"],
+        properties["@version"],
+        coordinates[0],
+        coordinates[1],
+    )
+
+
+def stream_to_processed(resp, end):
+    """Versions are sorted by node: only the first and last are kept"""
     slicer = JsonSlicer(resp, ("features", None))
-    start, end = get_updated_metadata()
-    group = []
+    first = last = None
     for feature in slicer:
-        osmid = feature["properties"]["@osmId"]
-        if len(group) == 0:
-            group.append(feature)
-        elif group[0]["properties"]["@osmId"] == osmid:
-            group.append(feature)
-        else:
-            if processed := process_group(group, end):
+        version = to_version(feature)
+        if first is not None and first.osmid != version.osmid:
+            if processed := process(first, last, end):
                 yield processed
-            group = [feature]
-    if len(group) > 0:
-        if processed := process_group(group, end):
-            yield processed
+            first = None
+        if first is None:
+            first = version
+        last = version
+    if first is not None and (processed := process(first, last, end)):
+        yield processed
+
+
+def tags(feature):
+    return {
+        key: str(value)
+        for key, value in feature["properties"].items()
+        if not key.startswith("@")
+    }
+
+
+def stream_to_history(resp, end):
+    """Like stream_to_processed, keeping the tags of every version"""
+    builder = Builder()
+    first = last = None
+    versions = []
+    for feature in JsonSlicer(resp, ("features", None)):
+        version = to_version(feature)
+        if first is not None and first.osmid != version.osmid:
+            builder.append(process(first, last, end), versions)
+            first = None
+            versions = []
+        if first is None:
+            first = version
+        last = version
+        versions.append((version.valid_from, tags(feature)))
+    if first is not None:
+        builder.append(process(first, last, end), versions)
+    history = builder.build()
+    return history, history.encode()
+
+
+def parse_spooled_history(path, end):
+    with open(path, "rb") as resp:
+        return stream_to_history(resp, end)
+
+
+def stream_to_encoder(resp, end, write):
+    """Processed rows of a response, written once it has been read, see
+    codec.Encoder"""
+    encoder = codec.Encoder(write)
+    for processed in stream_to_processed(resp, end):
+        encoder.append(processed)
+    return encoder.close()
+
+
+def tile_key(start, end, *filters):
+    """Storage key of the cached tile of a quadkey"""
+    return lambda quadkey: (
+        f"tile:{tile_cache_key(quadkey, start, end, *filters)}"
+    )
+
+
+def tile_cache_key(quadkey, start, end, *filters):
+    filters = " and ".join(filter(None, filters))
+    return f"{quadkey}_{start}_{end}_{filters}"
+
+
+def latest_key(quadkey, start, *filters):
+    """Storage key of the end of the latest cached tile of a quadkey, from
+    which it can be updated"""
+    filters = " and ".join(filter(None, filters))
+    return f"tile:latest:{quadkey}_{start}_{filters}"
 
 
-def get_tile_data(quadkey, start, end, *filters, **headers):
+def track(quadkeys, *filters):
+    """Count the requests of each quadkey and filter, for pre-warming, in a
+    single round trip per request"""
+    if not quadkeys:
+        return
     filters = " and ".join(filter(None, filters))
+    pipeline = db.pipeline(transaction=False)
+    for quadkey in quadkeys:
+        pipeline.zincrby(HOT, 1, f"{quadkey}_{filters}")
+    pipeline.execute()
+
+
+def store(cache_key, quadkey, features):
+    storage.set(f"tile:{cache_key}", codec.encode(features), CACHE_TIMEOUT)
+    store_summary(cache_key, quadkey, features)
+
+
+def store_summary(cache_key, quadkey, features):
+    pyramid = Pyramid.build(quadkey, features)
+    save_summary(cache_key, pyramid)
+    return pyramid
+
+
+def save_summary(cache_key, pyramid):
+    storage.set(f"summary:{cache_key}", pyramid.encode(), CACHE_TIMEOUT)
+
+
+def load_summary(cache_key):
+    """The cached pyramid, or None if missing or in an older layout"""
+    summary = storage.get(f"summary:{cache_key}")
+    if summary is not None:
+        try:
+            return Pyramid.decode(summary)
+        except ValueError:
+            return None
+
+
+def parse_spooled(path, end, quadkey):
+    with open(path, "rb") as resp:
+        encoded = io.BytesIO()
+        features = stream_to_encoder(resp, end, encoded.write)
+    return features, encoded.getvalue(), Pyramid.build(quadkey, features)
+
+
+def store_encoded(cache_key, encoded, pyramid):
+    storage.set(f"tile:{cache_key}", encoded, CACHE_TIMEOUT)
+    save_summary(cache_key, pyramid)
+
+
+def stream_to_stored(resp, end, cache_key, quadkey):
+    writer = storage.writer(f"tile:{cache_key}", CACHE_TIMEOUT)
+    try:
+        features = stream_to_encoder(resp, end, writer.write)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+    store_summary(cache_key, quadkey, features)
+    return features
+
+
+def local_filter(filters):
+    """Expression to select the nodes from the tile history, or None if
+    ohsome has to be asked"""
+    if not LOCAL_FILTERS or filters == DEFAULT_FILTER:
+        return None
+    try:
+        return parse(filters)
+    except UnsupportedFilter:
+        return None
+
+
+async def get_tile_history(quadkey, start, end, **headers):
+    """All the nodes of a tile, with the tags of their versions"""
+    cache_key = f"history:{quadkey}_{start}_{end}"
+    history = tiles.get(cache_key, end)
+    if history is not None:
+        return history
+    bbox = mercantile.bounds(mercantile.quadkey_to_tile(quadkey))
+
+    async def load():
+        result = storage.get(cache_key)
+        if result is not None:
+            TILE_CACHE.labels("hit").inc()
+            TILE_CACHE_BYTES.inc(len(result))
+            return await offload(History.decode, result)
+
+    async def fetch():
+        TILE_CACHE.labels("miss").inc()
+        params = {
+            "bboxes": "|".join(map(str, bbox)),
+            "properties": "metadata,tags",
+            "showMetadata": "true",
+            "time": f"{start},{end}",
+            "filter": DEFAULT_FILTER,
+        }
+        session = get_session()
+        async with session.get(API, params=params, headers=headers) as resp:
+            resp.raise_for_status()
+            if not pool.enabled():
+                reader = SyncReader(resp.content, asyncio.get_running_loop())
+                history, encoded = await asyncio.to_thread(
+                    stream_to_history, reader, end
+                )
+            else:
+                with tempfile.NamedTemporaryFile() as spooled:
+                    async for chunk in resp.content.iter_chunked(SPOOL_CHUNK):
+                        spooled.write(chunk)
+                    spooled.flush()
+                    history, encoded = await offload(
+                        parse_spooled_history, spooled.name, end
+                    )
+        storage.set(cache_key, encoded, CACHE_TIMEOUT)
+        record(quadkey, history.features)
+        return history
+
+    history = await single_flight(cache_key, load, fetch)
+    return tiles.put(cache_key, end, history)
+
+
+async def get_tile_data(quadkey, start, end, *filters, **headers):
     cache = db.cache()
-    cache_key = f"{quadkey}_{start}_{end}_{filters}"
-    with db.lock(cache_key, ttl=300000):
-        result = cache.get(cache_key)
-        if not result:
-            bbox = mercantile.bounds(mercantile.quadkey_to_tile(quadkey))
-            params = urllib.parse.urlencode(
-                {
-                    "bboxes": "|".join(map(str, bbox)),
-                    "properties": "metadata",
-                    "showMetadata": "true",
-                    "time": f"{start},{end}",
-                    "filter": filters,
-                }
-            )
+    cache_key = tile_cache_key(quadkey, start, end, *filters)
+    features = tiles.get(cache_key, end)
+    if features is not None:
+        return features
+    filters = " and ".join(filter(None, filters))
+    expression = local_filter(filters)
+    if expression is not None:
+        history = await get_tile_history(quadkey, start, end, **headers)
+        features = await offload(history.select, expression)
+        return tiles.put(cache_key, end, features)
+    latest = latest_key(quadkey, start, filters)
+    bbox = mercantile.bounds(mercantile.quadkey_to_tile(quadkey))
+    bboxes = "|".join(map(str, bbox))
+
+    async def load():
+        result = storage.get(f"tile:{cache_key}")
+        if result is not None:
+            features = await offload(codec.decode, result)
+            TILE_CACHE.labels("hit").inc()
+            TILE_CACHE_BYTES.inc(len(result))
+            FEATURES_DECODED.inc(len(features))
+            return features
+        legacy = cache.get(cache_key)
+        if legacy:
+            features = await offload(codec.decode, legacy)
+            store(cache_key, quadkey, features)
+            cache.delete(cache_key)
+            return features
+
+    async def download():
+        params = {
+            "bboxes": bboxes,
+            "properties": "metadata",
+            "showMetadata": "true",
+            "time": f"{start},{end}",
+            "filter": filters,
+        }
+        session = get_session()
+        async with session.get(API, params=params, headers=headers) as resp:
+            resp.raise_for_status()
+            if not pool.enabled():
+                reader = SyncReader(resp.content, asyncio.get_running_loop())
+                return await asyncio.to_thread(
+                    stream_to_stored, reader, end, cache_key, quadkey
+                )
+            # spool the response, to be parsed by the process pool
+            with tempfile.NamedTemporaryFile() as spooled:
+                async for chunk in resp.content.iter_chunked(SPOOL_CHUNK):
+                    spooled.write(chunk)
+                spooled.flush()
+                features, encoded, pyramid = await offload(
+                    parse_spooled, spooled.name, end, quadkey
+                )
+        store_encoded(cache_key, encoded, pyramid)
+        return features
+
+    async def update():
+        """Apply the contributions made since the last cached end"""
+        previous_end = storage.get(latest)
+        if previous_end is None or previous_end.decode() >= end:
+            return
+        previous_end = previous_end.decode()
+        previous_key = tile_cache_key(quadkey, start, previous_end, filters)
+        previous = storage.get(f"tile:{previous_key}")
+        if previous is None:
+            return
+        params = {
+            "bboxes": bboxes,
+            "properties": "metadata,contributionTypes",
+            "time": f"{previous_end},{end}",
+            "filter": filters,
+        }
+        session = get_session()
+        async with session.get(
+            CONTRIBUTIONS, params=params, headers=headers
+        ) as resp:
+            if not resp.ok:
+                return  # fall back to a full download
+            body = await resp.read()
+        features = await offload(codec.decode, previous)
+        features, encoded, pyramid = await offload(
+            apply_changes, features, body, quadkey
+        )
+        store_encoded(cache_key, encoded, pyramid)
+        return features
 
-            req = urllib.request.Request(API + "?" + params)
-            for key, value in headers.items():
-                req.add_header(key, value)
-            with urllib.request.urlopen(req) as resp_gzipped:
-                resp = gzip.GzipFile(fileobj=resp_gzipped)
-                compress = zlib.compressobj()
-                result = b""
-                for chunk in stream_to_processed(resp):
-                    serialized = json.dumps(chunk, use_decimal=True) + "\n"
-                    result += compress.compress(serialized.encode())
-                result += compress.flush()
-            cache.set(cache_key, result, timeout=60 * 60 * 24 * 30)
-    for line in zlib.decompress(result).decode().split("\n"):
-        if line:
-            yield json.loads(line)
-
-
-def process(group, end):
-    first, last = group[0], group[-1]
-    if last["properties"]["@validTo"] != end:
+    async def fetch():
+        TILE_CACHE.labels("miss").inc()
+        features = None
+        if INCREMENTAL_UPDATES:
+            features = await update()
+        if features is None:
+            features = await download()
+        storage.set(latest, end.encode(), CACHE_TIMEOUT)
+        if filters == DEFAULT_FILTER:
+            record(quadkey, features)
+        return features
+
+    features = await single_flight(cache_key, load, fetch)
+    return tiles.put(cache_key, end, features)
+
+
+async def get_tile_window(quadkey, start, end, bounds, *filters, **headers):
+    """Features of a tile within bounds (west, south, east, north), and a
+    few more around them: only the blocks of the cached tile overlapping
+    bounds are read and decoded, unless the tile is not cached yet, is
+    already decoded in memory or is needed for the most part"""
+    cache_key = tile_cache_key(quadkey, start, end, *filters)
+    features = tiles.get(cache_key, end)
+    if features is None:
+        index = get_tile_index(cache_key, end)
+        if index is not None:
+            blocks = index.overlapping(*bounds)
+            if len(blocks) <= len(index.blocks) // 2:
+                features = await get_tile_blocks(cache_key, end, index, blocks)
+    if features is None:
+        features = await get_tile_data(
+            quadkey, start, end, *filters, **headers
+        )
+    return features
+
+
+def get_tile_index(cache_key, end):
+    """Index of the blocks of a cached tile, or None if it is missing or
+    has been stored without one"""
+    index = tiles.get((cache_key, "index"), end)
+    if index is not None:
+        return index
+    key = f"tile:{cache_key}"
+    head, tail = storage.getranges(
+        key, [(0, codec.header.size - 1), (-INDEX_READ, -1)]
+    )
+    if len(head) < codec.header.size or not codec.is_encoded(head):
+        return None
+    flags = codec.decode_header(head)
+    if not flags & codec.FLAG_INDEX:
+        return None
+    size = codec.index_size(tail)
+    if size > len(tail):
+        (tail,) = storage.getranges(key, [(-size, -1)])
+    index = codec.Index(codec.read_index(tail), flags)
+    return tiles.put((cache_key, "index"), end, index)
+
+
+async def get_tile_blocks(cache_key, end, index, blocks):
+    """Features of some blocks of a cached tile, or None if it has expired
+    in the meantime"""
+    decoded = {block: tiles.get((cache_key, block), end) for block in blocks}
+    missing = [block for block, rows in decoded.items() if rows is None]
+    if missing:
+        entries = index.blocks[missing]
+        payloads = storage.getranges(
+            f"tile:{cache_key}",
+            [
+                (position, position + length - 1)
+                for position, length in entries[
+                    ["position", "length"]
+                ].tolist()
+            ],
+        )
+        if list(map(len, payloads)) != entries["length"].tolist():
+            return None
+        TILE_CACHE.labels("hit").inc()
+        TILE_CACHE_BYTES.inc(sum(map(len, payloads)))
+        rows = entries["rows"].tolist()
+        for block, features in zip(
+            missing,
+            await offload(codec.decode_blocks, payloads, rows, index.flags),
+        ):
+            FEATURES_DECODED.inc(len(features))
+            decoded[block] = tiles.put((cache_key, block), end, features)
+    return np.concatenate(
+        list(decoded.values()) or [np.empty(0, dtype=codec.DTYPE)]
+    )
+
+
+async def get_tile_summary(quadkey, start, end, *filters, **headers):
+    cache_key = tile_cache_key(quadkey, start, end, *filters)
+    pyramid = load_summary(cache_key)
+    if pyramid is None:
+        features = await get_tile_data(
+            quadkey, start, end, *filters, **headers
+        )
+        pyramid = load_summary(cache_key)
+        if pyramid is None:
+            pyramid = await offload(Pyramid.build, quadkey, features)
+            save_summary(cache_key, pyramid)
+    return pyramid
+
+
+def process(first, last, end):
+    if last.valid_to != end:
         return  # feature has been deleted
     firstedit = datetime.datetime.strptime(
-        first["properties"]["@validFrom"], "%Y-%m-%dT%H:%M:%SZ"
+        first.valid_from, "%Y-%m-%dT%H:%M:%SZ"
     )
     lastedit = datetime.datetime.strptime(
-        last["properties"]["@validFrom"], "%Y-%m-%dT%H:%M:%SZ"
-    )
-    updatefrequency = last["properties"]["@version"] / (
-        (datetime.datetime.now().utcnow() - firstedit).days / 365
+        last.valid_from, "%Y-%m-%dT%H:%M:%SZ"
     )
+    # edits per year, counting nodes created today as one day old
+    days = max((datetime.datetime.now().utcnow() - firstedit).days, 1)
+    updatefrequency = last.version / (days / 365)
     return (
-        last["geometry"]["coordinates"][0],
-        last["geometry"]["coordinates"][1],
-        int(first["properties"]["@osmId"].split("/")[1]),
+        last.lon,
+        last.lat,
+        int(first.osmid.split("/")[1]),
         firstedit.timestamp(),
         lastedit.timestamp(),
-        last["properties"]["@version"],
+        last.version,
         updatefrequency,
     )
 
 
 def feature_to_geojson(feature):
+    """process() gives finite frequencies, but tiles cached before it did
+    can hold infinite ones: these are written as null, as simplejson would
+    refuse them"""
     return json.dumps(
         {
             "type": "Feature",
@@ -183,9 +623,5 @@ def feature_to_geojson(feature):
             },
         },
         use_decimal=True,
+        ignore_nan=True,
     )
-
-
-def process_group(group, end):
-    if processed := process(group, end):
-        return processed
@@ -1,11 +1,8 @@
-import collections
-import statistics
-
 import simplejson as json
 from aiohttp import web
 
-from . import DEFAULT_FILTER
-from .process import generate_raw
+from . import DEFAULT_FILTER, codec, summary
+from .process import generate_summaries
 from .utils import (
     generateHeaders,
     get_updated_metadata,
@@ -13,7 +10,7 @@ from .utils import (
     timestamp_shortener,
 )
 
-params = ["creation", "lastedit", "revisions", "frequency"]
+params = summary.METRICS
 
 
 async def getStats(request):
@@ -23,37 +20,19 @@ async def getStats(request):
     headers = generateHeaders(referer)
     filters = request.rel_url.query.get("filter")
     filters = [filters, DEFAULT_FILTER]
-    start, end = get_updated_metadata()
-
-    features = generate_raw(multipolygon, start, end, *filters, **headers)
+    start, end = await get_updated_metadata()
 
-    values = collections.defaultdict(list)
-    for feature in features:
+    merged = {param: summary.empty() for param in params}
+    tiles = generate_summaries(multipolygon, start, end, *filters, **headers)
+    async for summaries in tiles:
         for param in params:
-            index = ["lon", "lat", "id", *params].index(param)
-            if index == -1:
-                pass  # error
-            value = feature[index]
-            if value:
-                values[param].append(value)
+            merged[param] = summary.merge([merged[param], summaries[param]])
 
-    stats = collections.defaultdict(collections.OrderedDict)
+    stats = {}
     for param in params:
-        values_p = values[param]
-        stats[param]["nodes"] = len(values[param])
-        if len(values_p) >= 1:
-            stats[param] |= {
-                "min": min(values_p),
-                "max": max(values_p),
-            }
-        if len(values_p) >= 2:
-            quartiles = statistics.quantiles(values_p, n=4, method="inclusive")
-            stats[param] |= {
-                "1st quartile": quartiles[0],
-                "median": quartiles[1],
-                "3rd quartile": quartiles[2],
-            }
-            stats[param].move_to_end("max")
+        stats[param] = summary.statistics(
+            merged[param], integer=codec.DTYPE.fields[param][0].kind == "i"
+        )
 
     start_short = timestamp_shortener(start)
     end_short = timestamp_shortener(end)
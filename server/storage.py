@@ -0,0 +1,270 @@
+"""Where tiles, their summaries and histories and the ohsome metadata are
+cached: in Redis, or with STORAGE=disk in files on a local disk, shared by
+the workers of a node and bounded to STORAGE_SIZE bytes. Locks, counters
+and the density index are always kept in Redis."""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+from . import STORAGE, STORAGE_PATH, STORAGE_SIZE, db
+
+# expiration time, in seconds since the epoch, before the value of a file
+expiry = struct.Struct("<d")
+# temporary files older than this are left from interrupted writes
+ABANDONED = 60 * 60
+
+
+class RedisWriter:
+    """Append chunks to a temporary key, renamed once complete"""
+
+    def __init__(self, db, key, timeout, temporary_timeout):
+        self.db = db
+        self.key = key
+        self.timeout = timeout
+        self.temporary_timeout = temporary_timeout
+        self.temporary = f"{key}_{uuid.uuid4().hex}"
+
+    def write(self, chunk):
+        pipeline = self.db.pipeline(transaction=False)
+        pipeline.append(self.temporary, chunk)
+        pipeline.expire(self.temporary, self.temporary_timeout)
+        pipeline.execute()
+
+    def commit(self):
+        pipeline = self.db.pipeline()
+        pipeline.rename(self.temporary, self.key)
+        pipeline.expire(self.key, self.timeout)
+        pipeline.execute()
+
+    def abort(self):
+        self.db.delete(self.temporary)
+
+
+class RedisStorage:
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def set(self, key, value, timeout):
+        self.db.set(key, value, ex=timeout)
+
+    def delete(self, key):
+        self.db.delete(key)
+
+    def exists(self, keys):
+        pipeline = self.db.pipeline(transaction=False)
+        for key in keys:
+            pipeline.exists(key)
+        return list(map(bool, pipeline.execute()))
+
+    def getranges(self, key, ranges):
+        """Bytes from start to end, both included and negative from the
+        end of the value as in GETRANGE, for each (start, end)"""
+        pipeline = self.db.pipeline(transaction=False)
+        for start, end in ranges:
+            pipeline.getrange(key, start, end)
+        return pipeline.execute()
+
+    def writer(self, key, timeout, temporary_timeout=60 * 10):
+        return RedisWriter(self.db, key, timeout, temporary_timeout)
+
+
+class DiskWriter:
+    """Write to a temporary file, moved in place once complete"""
+
+    def __init__(self, storage, key, timeout):
+        self.storage = storage
+        self.path = storage.path(key)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(  # noqa: SIM115
+            prefix=".", dir=os.path.dirname(self.path), delete=False
+        )
+        self.file.write(expiry.pack(time.time() + timeout))
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.file.name, self.path)
+        self.storage.written(os.path.getsize(self.path))
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.file.name)
+
+
+class DiskStorage:
+    """A file for each key, sharded by hash. Files are replaced
+    atomically, read through a memory map and touched when read; the
+    least recently used ones are deleted when the directory grows larger
+    than capacity."""
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.unchecked = 0
+        self.evicting = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def open(self, key):
+        """Memory map of the value of key, or None if missing or expired"""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        (expires,) = expiry.unpack_from(mapped)
+        if expires < time.time():
+            mapped.close()
+            self.delete(key)
+            return None
+        os.utime(path)
+        return mapped
+
+    def get(self, key):
+        """A copy of the value, as bytes: values are mostly decoded in the
+        process pool, where they are sent pickled, so a view over the
+        mapping would be copied all the same; getranges() only copies the
+        requested ranges"""
+        mapped = self.open(key)
+        if mapped is None:
+            return None
+        with mapped:
+            return mapped[expiry.size :]
+
+    def set(self, key, value, timeout):
+        writer = DiskWriter(self, key, timeout)
+        try:
+            writer.write(value)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, keys):
+        exists = []
+        for key in keys:
+            mapped = self.open(key)
+            exists.append(mapped is not None)
+            if mapped is not None:
+                mapped.close()
+        return exists
+
+    def getranges(self, key, ranges):
+        """See RedisStorage.getranges()"""
+        mapped = self.open(key)
+        if mapped is None:
+            return [b""] * len(ranges)
+        with mapped:
+            size = len(mapped) - expiry.size
+            chunks = []
+            for start, end in ranges:
+                start = max(start + size if start < 0 else start, 0)
+                end = min(end + size if end < 0 else end, size - 1)
+                chunks.append(
+                    mapped[expiry.size + start : expiry.size + end + 1]
+                    if start <= end
+                    else b""
+                )
+            return chunks
+
+    def writer(self, key, timeout, temporary_timeout=None):
+        return DiskWriter(self, key, timeout)
+
+    def clear(self):
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                shutil.rmtree(shard.path, ignore_errors=True)
+
+    def written(self, size):
+        """Evict files after a sixteenth of the capacity has been written
+        by this process, in a thread: walking the directory would block
+        the event loop"""
+        self.unchecked += size
+        if self.unchecked > self.capacity / 16 and not (
+            self.evicting and self.evicting.is_alive()
+        ):
+            self.unchecked = 0
+            self.evicting = threading.Thread(target=self.evict, daemon=True)
+            self.evicting.start()
+
+    def evict(self, target=0.9):
+        """Delete the least recently used files until the directory is
+        within target of the capacity, unless another process is at it"""
+        lock = os.path.join(self.directory, ".lock")
+        with open(lock, "w") as locked:
+            try:
+                fcntl.flock(locked, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            files = []
+            abandoned = time.time() - ABANDONED
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    if (
+                        entry.name.startswith(".")
+                        and stat.st_mtime > abandoned
+                    ):
+                        continue  # still being written
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            files.sort()
+            for _, size, path in files:
+                if total <= self.capacity * target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+async def redis_connections(app):
+    """A pool of connections to Redis of this worker, created once it has
+    started, so that none is shared with the process which imported the
+    app, as with gunicorn --preload"""
+    pool = db.connection_pool
+    db.connection_pool = type(pool)(
+        connection_class=pool.connection_class,
+        max_connections=pool.max_connections,
+        **pool.connection_kwargs,
+    )
+    yield
+    db.connection_pool.disconnect()
+
+
+def connect():
+    if STORAGE == "disk":
+        return DiskStorage(STORAGE_PATH, STORAGE_SIZE)
+    return RedisStorage(db)
+
+
+storage = connect()
@@ -0,0 +1,299 @@
+import collections
+import io
+import math
+import zipfile
+
+import mercantile
+import numpy as np
+import shapely.geometry
+
+from . import SKETCH_SIZE, SUMMARY_MIN_NODES, SUMMARY_ZOOM
+
+METRICS = ("creation", "lastedit", "revisions", "frequency")
+COLUMNS = ("count", "min", "max", "start", "end", "means", "weights")
+VERSION = 1
+
+Summary = collections.namedtuple(
+    "Summary", ("count", "min", "max", "means", "weights")
+)
+
+
+def tile_indices(lon, lat, zoom):
+    """Vectorized mercantile.tile"""
+    scale = 2**zoom
+    x = np.floor((lon + 180.0) / 360.0 * scale)
+    sinlat = np.sin(np.radians(lat))
+    y = np.floor(
+        (0.5 - 0.25 * np.log((1.0 + sinlat) / (1.0 - sinlat)) / math.pi)
+        * scale
+    )
+    return x.astype(np.int64), y.astype(np.int64)
+
+
+def compress(groups, means, weights, delta=SKETCH_SIZE):
+    """Merge centroids sorted by (group, mean) following the t-digest k1
+    scale, so that each group keeps about delta centroids at most"""
+    if len(groups) == 0:
+        return groups, means, weights
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sizes = np.diff(np.r_[starts, len(groups)])
+    cumulative = np.cumsum(weights)
+    before = cumulative - weights
+    group_before = np.repeat(before[starts], sizes)
+    group_total = np.repeat(cumulative[starts + sizes - 1], sizes)
+    quantile = (before - group_before + weights / 2) / (
+        group_total - group_before
+    )
+    bucket = np.floor(delta * (np.arcsin(2 * quantile - 1) / math.pi + 0.5))
+    key = groups * (delta + 1) + bucket.astype(np.int64)
+    runs = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    merged_weights = np.add.reduceat(weights, runs)
+    merged_means = np.add.reduceat(means * weights, runs) / merged_weights
+    return groups[runs], merged_means, merged_weights
+
+
+def summarize(values, groups, delta=SKETCH_SIZE):
+    """Count, min, max and centroids of the non-zero values of each group"""
+    keep = values != 0
+    values, groups = values[keep], groups[keep]
+    order = np.lexsort((values, groups))
+    values, groups = values[order], groups[order]
+    unique, starts, counts = np.unique(
+        groups, return_index=True, return_counts=True
+    )
+    sketch_groups, means, weights = compress(
+        groups, values.astype(np.float64), np.ones(len(values)), delta
+    )
+    offsets = np.r_[np.searchsorted(sketch_groups, unique), len(means)]
+    minimum = values[starts]
+    maximum = values[starts + counts - 1]
+    return unique, counts, minimum, maximum, offsets, means, weights
+
+
+def empty():
+    return Summary(0, None, None, np.empty(0), np.empty(0))
+
+
+def merge(summaries):
+    summaries = [summary for summary in summaries if summary.count]
+    if not summaries:
+        return empty()
+    means = np.concatenate([summary.means for summary in summaries])
+    weights = np.concatenate([summary.weights for summary in summaries])
+    order = np.argsort(means, kind="stable")
+    _, means, weights = compress(
+        np.zeros(len(means), dtype=np.int64), means[order], weights[order]
+    )
+    return Summary(
+        sum(summary.count for summary in summaries),
+        min(summary.min for summary in summaries),
+        max(summary.max for summary in summaries),
+        means,
+        weights,
+    )
+
+
+def quantile(summary, q):
+    """Interpolate between centroids: as long as no values have been
+    merged, this is statistics.quantiles(method="inclusive")"""
+    centers = np.cumsum(summary.weights) - (summary.weights + 1) / 2
+    position = q * (summary.weights.sum() - 1)
+    value = float(np.interp(position, centers, summary.means))
+    return min(max(value, summary.min), summary.max)
+
+
+def statistics(summary, integer=False):
+    stats = collections.OrderedDict()
+    stats["nodes"] = summary.count
+    if summary.count >= 1:
+        cast = int if integer else float
+        stats["min"] = cast(summary.min)
+        stats["max"] = cast(summary.max)
+    if summary.count >= 2:
+        stats["1st quartile"] = quantile(summary, 0.25)
+        stats["median"] = quantile(summary, 0.5)
+        stats["3rd quartile"] = quantile(summary, 0.75)
+        stats.move_to_end("max")
+    return stats
+
+
+class Pyramid:
+    """Summaries of a cached quadkey and of its descendants down to
+    SUMMARY_ZOOM, one row per tile holding at least SUMMARY_MIN_NODES nodes
+
+    Each level halves the sketch size: deeper tiles only cover the edges of
+    an area. Tiles without a row are scanned node by node."""
+
+    def __init__(self, quadkey, tiles, columns):
+        self.quadkey = quadkey
+        self.root = mercantile.quadkey_to_tile(quadkey)
+        self.zoom = max(SUMMARY_ZOOM, self.root.z)
+        self.tiles = tiles
+        self.columns = columns
+        self.index = {
+            tuple(tile): row for row, tile in enumerate(tiles.tolist())
+        }
+
+    def __getstate__(self):
+        return self.quadkey, self.tiles, self.columns
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def encode(self):
+        """Arrays in an npz archive, with the version of their layout"""
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            version=np.array(VERSION),
+            quadkey=np.array(self.quadkey),
+            tiles=self.tiles,
+            **{
+                f"{metric}.{name}": self.columns[metric][name]
+                for metric in METRICS
+                for name in COLUMNS
+            },
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def decode(cls, encoded):
+        """Raises ValueError if encoded is not a pyramid of this version"""
+        try:
+            with np.load(io.BytesIO(encoded)) as arrays:
+                if arrays["version"] != VERSION:
+                    raise ValueError("Unsupported summary version")
+                columns = {
+                    metric: {
+                        name: arrays[f"{metric}.{name}"] for name in COLUMNS
+                    }
+                    for metric in METRICS
+                }
+                return cls(str(arrays["quadkey"]), arrays["tiles"], columns)
+        except (EOFError, KeyError, OSError, zipfile.BadZipFile) as error:
+            raise ValueError("Invalid summary") from error
+
+    @classmethod
+    def build(cls, quadkey, features):
+        root = mercantile.quadkey_to_tile(quadkey)
+        zoom = max(SUMMARY_ZOOM, root.z)
+        x, y = cls.indices(root, zoom, features)
+        tiles = []
+        columns = {metric: collections.defaultdict(list) for metric in METRICS}
+        sketch_size = dict.fromkeys(METRICS, 0)
+        for z in range(root.z, zoom + 1):
+            delta = max(SKETCH_SIZE >> (z - root.z), 4)
+            cells = (y >> (zoom - z)) * (2**z) + (x >> (zoom - z))
+            level, counts = np.unique(cells, return_counts=True)
+            if z > root.z:
+                level = level[counts >= SUMMARY_MIN_NODES]
+            keep = np.isin(cells, level)
+            tiles.append(
+                np.column_stack(
+                    [np.full(len(level), z), level % (2**z), level // (2**z)]
+                ).astype(np.int32)
+            )
+            for metric in METRICS:
+                groups, counts, minimum, maximum, offsets, means, weights = (
+                    summarize(features[metric][keep], cells[keep], delta)
+                )
+                position = np.searchsorted(level, groups)
+                offsets = offsets + sketch_size[metric]
+                column = columns[metric]
+                for name, values, default in (
+                    ("count", counts, 0),
+                    ("min", minimum, np.nan),
+                    ("max", maximum, np.nan),
+                    ("start", offsets[:-1], 0),
+                    ("end", offsets[1:], 0),
+                ):
+                    aligned = np.full(len(level), default, dtype=type(default))
+                    aligned[position] = values
+                    column[name].append(aligned)
+                column["means"].append(means)
+                column["weights"].append(weights.astype(np.float32))
+                sketch_size[metric] += len(means)
+        tiles = np.concatenate(tiles)
+        columns = {
+            metric: {
+                name: np.concatenate(values) for name, values in column.items()
+            }
+            for metric, column in columns.items()
+        }
+        return cls(quadkey, tiles, columns)
+
+    @staticmethod
+    def indices(root, zoom, features):
+        x, y = tile_indices(features["lon"], features["lat"], zoom)
+        shift = zoom - root.z
+        x = np.clip(x, root.x << shift, ((root.x + 1) << shift) - 1)
+        y = np.clip(y, root.y << shift, ((root.y + 1) << shift) - 1)
+        return x, y
+
+    def get(self, tile):
+        row = self.index.get((tile.z, tile.x, tile.y))
+        if row is None:
+            return {metric: empty() for metric in METRICS}
+        summaries = {}
+        for metric in METRICS:
+            column = self.columns[metric]
+            if not column["count"][row]:
+                summaries[metric] = empty()
+                continue
+            start, end = column["start"][row], column["end"][row]
+            summaries[metric] = Summary(
+                int(column["count"][row]),
+                column["min"][row],
+                column["max"][row],
+                column["means"][start:end],
+                column["weights"][start:end],
+            )
+        return summaries
+
+    def cover(self, shape):
+        """Summaries of the descendants within shape, and the tiles which
+        have to be scanned: unsummarized ones, or crossing its boundary"""
+        shapely.prepare(shape)
+        contained = []
+        scan = []
+        pending = [self.root]
+        while pending:
+            tile = pending.pop()
+            box = shapely.geometry.box(*mercantile.bounds(tile))
+            if not shape.intersects(box):
+                continue
+            summarized = (tile.z, tile.x, tile.y) in self.index
+            if summarized and shape.contains(box):
+                contained.append(self.get(tile))
+            elif summarized and tile.z < self.zoom:
+                pending.extend(mercantile.children(tile))
+            else:
+                scan.append(tile)
+        return contained, scan
+
+    def scan(self, features, shape, tiles):
+        """Summaries of the features within shape, among the given tiles"""
+        x, y = self.indices(self.root, self.zoom, features)
+        mask = np.zeros(len(features), dtype=bool)
+        for z in {tile.z for tile in tiles}:
+            wanted = [
+                tile.y * (2**z) + tile.x for tile in tiles if tile.z == z
+            ]
+            cells = (y >> (self.zoom - z)) * (2**z) + (x >> (self.zoom - z))
+            mask |= np.isin(cells, np.array(wanted, dtype=np.int64))
+        mask[mask] = shapely.contains_xy(
+            shape, features["lon"][mask], features["lat"][mask]
+        )
+        groups = np.zeros(mask.sum(), dtype=np.int64)
+        summaries = {}
+        for metric in METRICS:
+            _, counts, minimum, maximum, _, means, weights = summarize(
+                features[metric][mask], groups
+            )
+            if len(counts):
+                summaries[metric] = Summary(
+                    int(counts[0]), minimum[0], maximum[0], means, weights
+                )
+            else:
+                summaries[metric] = empty()
+        return summaries
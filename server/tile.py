@@ -1,32 +1,41 @@
 import datetime
+import hashlib
 import io
-import math
-import statistics
+import itertools
 
 import mercantile
-import PIL
-import png
+import numpy as np
+import shapely.geometry
 from aiohttp import web
 
-from . import DEFAULT_FILTER, viridis
-from .process import generate_raw
-from .utils import (
-    ensure_range,
-    generateHeaders,
-    get_updated_metadata,
-    request_to_multipolygon,
+from . import (
+    DEFAULT_FILTER,
+    METATILE,
+    TILE_CACHE_TIMEOUT,
+    TILE_MAX_AGE,
+    Z_TARGET,
+    cache,
+    codec,
 )
+from .cluster import grid, percentiles
+from .colormap import VIRIDIS
+from .metrics import timer
+from .pool import offload
+from .process import generate_batches
+from .utils import bbox_mask, generateHeaders, get_updated_metadata
+
+MODES = ("creation", "lastedit", "revisions", "frequency")
+VIRIDIS_LUT = np.frombuffer(VIRIDIS, dtype=np.uint8).reshape(256, 3)
 
 
 async def tile(request):
     z = int(request.match_info["z"])
-    # common
-    multipolygon = await request_to_multipolygon(request)
+    x = int(request.match_info["x"])
+    y = int(request.match_info["y"])
     referer = request.headers.get("REFERER", "http://localhost:8000/")
     headers = generateHeaders(referer)
     filters = request.rel_url.query.get("filter")
-    filters = [filters, DEFAULT_FILTER]
-    start, end = get_updated_metadata()
+    start, end = await get_updated_metadata()
 
     mode = request.rel_url.query.get("mode", "lastedit")
     scale_min = request.rel_url.query.get("scale_min")
@@ -38,12 +47,99 @@ async def tile(request):
         return web.Response(
             body=generate_invalid_tile(), content_type="image/png"
         )
+    if mode not in MODES:
+        return web.Response(text="Invalid param")
+
+    options = (
+        filters,
+        scale_min,
+        scale_max,
+        percentile,
+        resolution,
+        upscale,
+        start,
+        end,
+    )
+    cache_key = rendered_key(mercantile.Tile(x, y, z), mode, *options)
+
+    async def render_metatile():
+        tiles = metatile(mercantile.Tile(x, y, z))
+        # a custom scale only makes sense for the requested mode
+        modes = (mode,) if scale_min or scale_max else MODES
+        bodies = await render(
+            tiles,
+            modes,
+            start,
+            end,
+            [filters, DEFAULT_FILTER],
+            headers,
+            scale_min,
+            scale_max,
+            percentile,
+            resolution,
+            upscale,
+        )
+        return {
+            rendered_key(*tile_mode, *options): rendered
+            for tile_mode, rendered in zip(
+                itertools.product(tiles, modes), bodies
+            )
+        }
+
+    return await cached_response(
+        request, cache_key, render_metatile, "image/png"
+    )
+
+
+async def cached_response(
+    request, cache_key, render, content_type, compress=False
+):
+    """The body cached under cache_key, or 304 if the client has it
+
+    On a miss, render() returns the bodies to cache by key, cache_key's
+    among them. Bodies are cached with their digest, the ETag."""
+    cached = cache.get(cache_key)
+    if cached:
+        digest, body = cached
+    else:
+        rendered = {
+            key: (hashlib.sha1(body).hexdigest(), body)
+            for key, body in (await render()).items()
+        }
+        cache.set_many(rendered, timeout=TILE_CACHE_TIMEOUT)
+        digest, body = rendered[cache_key]
+
+    if any(etag.value == digest for etag in request.if_none_match or ()):
+        response = web.Response(status=304)
+    else:
+        response = web.Response(body=body, content_type=content_type)
+        if compress:
+            response.enable_compression()
+    response.etag = digest
+    response.headers["Cache-Control"] = f"public, max-age={TILE_MAX_AGE}"
+    return response
+
+
+def rendered_key(tile, mode, *options):
+    return "tile_" + "_".join(
+        map(str, (tile.z, tile.x, tile.y, mode, *options))
+    )
 
-    if mode == "creation":
-        feature_index = 3
-    elif mode == "lastedit":
-        feature_index = 4
 
+def metatile(tile):
+    """The block of METATILE x METATILE tiles containing tile, shrunk to
+    fit in its Z_TARGET tile, so that a single tile is decoded"""
+    depth = min(METATILE.bit_length() - 1, tile.z - Z_TARGET)
+    size = 2 ** max(depth, 0)
+    left, top = tile.x - tile.x % size, tile.y - tile.y % size
+    return [
+        mercantile.Tile(x, y, tile.z)
+        for y in range(top, top + size)
+        for x in range(left, left + size)
+    ]
+
+
+def scale(mode, start, end, scale_min, scale_max):
     if mode == "creation" or mode == "lastedit":
         if not scale_min:
             scale_min = datetime.datetime.strptime(
@@ -62,76 +158,112 @@ async def tile(request):
             scale_min = 1
         if not scale_max:
             scale_max = 10
-        feature_index = 5
     elif mode == "frequency":
         if not scale_min:
             scale_min = 7
         if not scale_max:
             scale_max = 700
-        feature_index = 6
-    else:
-        return web.Response(text="Invalid param")
 
     scale_min = float(scale_min)
     scale_max = float(scale_max)
     if scale_min == scale_max:
         scale_max += 1
+    return scale_min, scale_max
 
-    subvalues = [[] for _ in range(resolution * resolution)]
-    bbox = mercantile.Bbox(*multipolygon.bounds)
-    features = generate_raw(multipolygon, start, end, *filters, **headers)
-    for feature in features:
-        y_index = ensure_range(
-            math.floor(
-                resolution * (bbox.top - feature[1]) / (bbox.top - bbox.bottom)
-            ),
-            value_max=resolution - 1,
-        )
-        x_index = ensure_range(
-            math.floor(
-                resolution
-                * (feature[0] - bbox.left)
-                / (bbox.right - bbox.left)
-            ),
-            value_max=resolution - 1,
-        )
-        subvalues[y_index * resolution + x_index].append(
-            (feature[feature_index] - scale_min) / (scale_max - scale_min)
-        )
 
-    colors = []
-    for values in subvalues:
-        if len(values) == 0:
-            colors.extend([255, 255, 255])
-            continue
-        elif len(values) == 1:
-            value = values[0]
-        else:
-            value = [
-                min(values),
-                *statistics.quantiles(values, n=100, method="inclusive"),
-                max(values),
-            ][percentile]
-        colors.extend(
-            [round(c * 255) for c in viridis(round(value * 255))][:3]
-        )
+async def render(
+    tiles,
+    modes,
+    start,
+    end,
+    filters,
+    headers,
+    scale_min,
+    scale_max,
+    percentile,
+    resolution,
+    upscale,
+):
+    """Render each tile in each mode, decoding their nodes only once"""
+    bounds = [mercantile.Bbox(*mercantile.bounds(tile)) for tile in tiles]
+    area = shapely.geometry.box(
+        min(bbox.left for bbox in bounds),
+        min(bbox.bottom for bbox in bounds),
+        max(bbox.right for bbox in bounds),
+        max(bbox.top for bbox in bounds),
+    )
+    batches = generate_batches(area, start, end, *filters, **headers)
+    features = np.concatenate(
+        [batch async for batch in batches] or [np.empty(0, codec.DTYPE)]
+    )
+    scales = [scale(mode, start, end, scale_min, scale_max) for mode in modes]
 
-    tile = io.BytesIO()
-    writer = png.Writer(resolution, resolution, greyscale=False)
-    writer.write_array(tile, colors)
-    tile.seek(0)
+    jobs = []
+    for tile, bbox in zip(tiles, bounds):
+        selected = features
+        if tile.z > Z_TARGET:
+            # generate_batches() compares a tile smaller than Z_TARGET with
+            # shape_mask(), which leaves out the nodes on its borders
+            with timer("point_in_polygon"):
+                mask = bbox_mask(bbox, features["lon"], features["lat"], True)
+            selected = features[mask]
+        values = [
+            (selected[mode] - low) / (high - low)
+            for mode, (low, high) in zip(modes, scales)
+        ]
+        jobs.append((selected["lon"], selected["lat"], values, bbox))
+    return await offload(draw_all, jobs, resolution, percentile, upscale)
+
+
+def draw_all(jobs, resolution, percentile, upscale):
+    return [
+        draw(lon, lat, values, bbox, resolution, percentile, upscale)
+        for lon, lat, modes, bbox in jobs
+        for values in modes
+    ]
 
-    if upscale > resolution:
-        image = PIL.Image.open(tile)
-        scaled = image.resize((upscale, upscale), resample=PIL.Image.BOX)
+
+def draw(lon, lat, values, bbox, resolution, percentile, upscale):
+    import png  # only needed where tiles are drawn, often the pool
+
+    with timer("rasterize"):
+        pixels = rasterize(lon, lat, values, bbox, resolution, percentile)
+
+    with timer("png"):
         tile = io.BytesIO()
-        scaled.save(tile, "png")
+        writer = png.Writer(resolution, resolution, greyscale=False)
+        writer.write(tile, pixels.reshape(resolution, resolution * 3))
         tile.seek(0)
 
-    return web.Response(body=tile.getvalue(), content_type="image/png")
+        if upscale > resolution:
+            import PIL.Image
+
+            image = PIL.Image.open(tile)
+            scaled = image.resize((upscale, upscale), resample=PIL.Image.BOX)
+            tile = io.BytesIO()
+            scaled.save(tile, "png")
+            tile.seek(0)
+
+    return tile.getvalue()
+
+
+def rasterize(lon, lat, values, bbox, resolution, percentile):
+    """Color each cell by the given percentile of its values"""
+    pixels = np.full((resolution * resolution, 3), 255, dtype=np.uint8)
+    if len(values) == 0:
+        return pixels
+    cells = grid(lon, lat, bbox, resolution)
+    counts = np.bincount(cells, minlength=resolution * resolution)
+    cell_value = percentiles(values, cells, counts, percentile)
+    filled = counts > 0
+    color_index = np.clip(np.round(cell_value[filled] * 255), 0, 255)
+    pixels[filled] = VIRIDIS_LUT[color_index.astype(np.intp)]
+    return pixels
 
 
 def generate_invalid_tile():
+    import png
+
     tile = io.BytesIO()
     writer = png.Writer(1, 1, greyscale=True)
     writer.write(tile, [[255]])
@@ -1,12 +1,13 @@
-import urllib.parse
-import urllib.request
-
 import aiohttp.web_request
 import mercantile
 import shapely.geometry
 import simplejson as json
 
-from . import METADATA, __version__, cache
+from . import METADATA, __version__
+from .client import get_session
+from .storage import storage
+
+METADATA_TIMEOUT = 60 * 60 * 24
 
 
 def generateHeaders(referer):
@@ -27,13 +28,28 @@ def timestamp_shortener(timestamp):
     )
 
 
-def lonlat_in_bbox(bbox, lon, lat):
-    return bbox.left <= lon <= bbox.right and bbox.bottom <= lat <= bbox.top
+def bbox_mask(bbox, lon, lat, strict=False):
+    """Points within bbox, borders included unless strict, which matches
+    shape_mask() on the same box"""
+    if strict:
+        return (
+            (bbox.left < lon)
+            & (lon < bbox.right)
+            & (bbox.bottom < lat)
+            & (lat < bbox.top)
+        )
+    return (
+        (bbox.left <= lon)
+        & (lon <= bbox.right)
+        & (bbox.bottom <= lat)
+        & (lat <= bbox.top)
+    )
 
 
-@cache.cached(timeout=60 * 60 * 24)
-def get_updated_metadata():
-    metadata = json.load(urllib.request.urlopen(METADATA))
+async def fetch_metadata():
+    async with get_session().get(METADATA) as resp:
+        resp.raise_for_status()
+        metadata = json.loads(await resp.read())
     temporal_extent = metadata["extractRegion"]["temporalExtent"]
     start = temporal_extent["fromTimestamp"]
     end = temporal_extent["toTimestamp"]
@@ -41,6 +57,24 @@ def get_updated_metadata():
     return start, end
 
 
+def cached_metadata():
+    metadata = storage.get("metadata")
+    if metadata is not None:
+        return tuple(json.loads(metadata))
+
+
+def cache_metadata(metadata):
+    storage.set("metadata", json.dumps(metadata).encode(), METADATA_TIMEOUT)
+
+
+async def get_updated_metadata():
+    updated = cached_metadata()
+    if updated is None:
+        updated = await fetch_metadata()
+        cache_metadata(updated)
+    return updated
+
+
 def ensure_range(value, value_min=0, value_max=1):
     if value < value_min:
         value = value_min
@@ -93,6 +127,6 @@ async def request_to_multipolygon(request):
         return multipolygon.intersection(bbox_polygon)
 
 
-def shape_contains_feature(shape, feature):
-    point = shapely.geometry.Point(feature[0], feature[1])
-    return shape.contains(point)
+def shape_mask(shape, lon, lat):
+    shapely.prepare(shape)
+    return shapely.contains_xy(shape, lon, lat)
@@ -0,0 +1,32 @@
+"""Random nodes shared by the tests and the benchmarks"""
+
+import mercantile
+import numpy as np
+
+from server import codec
+
+MILAN = mercantile.LngLatBbox(9.1, 45.4, 9.3, 45.5)
+
+
+def random_features(
+    size,
+    seed=0,
+    bounds=MILAN,
+    ids=None,
+    edits=1e8,
+    revisions=20,
+    frequency=1,
+):
+    """Nodes within bounds, numbered from 0 unless ids is a (low, high)"""
+    rng = np.random.default_rng(seed)
+    features = np.zeros(size, dtype=codec.DTYPE)
+    features["lon"] = rng.uniform(bounds.west, bounds.east, size)
+    features["lat"] = rng.uniform(bounds.south, bounds.north, size)
+    features["id"] = (
+        np.arange(size) if ids is None else rng.integers(*ids, size)
+    )
+    features["creation"] = rng.integers(1.2e9, 1.7e9, size)
+    features["lastedit"] = features["creation"] + rng.integers(0, edits, size)
+    features["revisions"] = rng.integers(1, revisions, size)
+    features["frequency"] = rng.exponential(frequency, size)
+    return features
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+
+from server import changes, codec, process
+
+fixture = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def stored():
+    features = np.zeros(4, dtype=codec.DTYPE)
+    features["id"] = [1, 2, 4, 5]
+    features["lon"] = 9.1
+    features["lat"] = 45.4
+    features["creation"] = changes.to_timestamp("2015-01-01T00:00:00Z")
+    features["lastedit"] = changes.to_timestamp("2020-01-01T00:00:00Z")
+    features["revisions"] = [4, 2, 7, 1]
+    return features
+
+
+class TestChanges:
+    def test_merge(self):
+        with open(os.path.join(fixture, "contributions.json"), "rb") as body:
+            merged = changes.merge(
+                stored(), changes.parse_changes(body.read())
+            )
+        assert merged["id"].tolist() == [1, 3, 4, 5]
+        one, three, four, five = merged
+        assert (one["lon"], one["lat"], one["revisions"]) == (9.19, 45.461, 5)
+        assert one["creation"] == stored()["creation"][0]
+        assert one["lastedit"] == changes.to_timestamp("2024-01-02T10:00:00Z")
+        assert three["creation"] == changes.to_timestamp(
+            "2024-01-02T12:00:00Z"
+        )
+        assert three["lastedit"] == changes.to_timestamp(
+            "2024-01-04T12:00:00Z"
+        )
+        assert (three["lon"], three["revisions"]) == (9.181, 2)
+        assert four["revisions"] == 8
+        assert (five["lon"], five["revisions"]) == (9.1, 1)
+
+    def test_frequency(self):
+        features = stored()
+        changes.update_frequency(features)
+        expected = process.process(
+            process.Version("node/1", "2015-01-01T00:00:00Z", "", 4, 0, 0),
+            process.Version("node/1", "2020-01-01T00:00:00Z", "", 4, 0, 0),
+            "",
+        )
+        assert features["frequency"][0] == expected[-1]
@@ -0,0 +1,58 @@
+import statistics
+
+import mercantile
+import numpy as np
+
+from server import codec
+from server.cluster import cluster, grid, tile_cells, tile_zoom
+
+bbox = mercantile.Bbox(9.1, 45.4, 9.3, 45.5)
+
+
+class TestCluster:
+    def test_groups(self):
+        rng = np.random.default_rng(0)
+        size = 5000
+        features = np.zeros(size, dtype=codec.DTYPE)
+        features["lon"] = rng.uniform(bbox.left, bbox.right, size)
+        features["lat"] = rng.uniform(bbox.bottom, bbox.top, size)
+        features["id"] = np.arange(1, size + 1)
+        features["revisions"] = rng.integers(1, 20, size)
+        features["creation"] = rng.uniform(1.2e9, 1.7e9, size)
+        features["lastedit"] = features["creation"]
+        features["frequency"] = rng.exponential(50, size)
+        features[-1]["lon"], features[-1]["lat"] = bbox.left, bbox.bottom
+
+        clusters = cluster(features, bbox, 32, percentile=50)
+        cells = grid(features["lon"], features["lat"], bbox, 32)
+        assert clusters["count"].sum() == size
+        for group, cell in zip(clusters, np.unique(cells)):
+            members = features[cells == cell]
+            assert group["count"] == len(members)
+            assert np.isclose(group["lon"], members["lon"].mean())
+            assert np.isclose(group["lat"], members["lat"].mean())
+            expected = statistics.median(members["revisions"].tolist())
+            assert group["revisions"] == expected
+            if len(members) == 1:
+                assert group["id"] == members["id"][0]
+            else:
+                assert group["id"] == 0
+
+    def test_empty(self):
+        empty = np.empty(0, codec.DTYPE)
+        assert len(cluster(empty, bbox, 8)) == 0
+
+
+class TestTileCells:
+    def test_tiles(self):
+        lon = np.array([9.11, 9.12, 9.29, 9.29])
+        lat = np.array([45.41, 45.41, 45.49, 45.49])
+        cells, size = tile_cells(lon, lat, 14)
+        assert size == 3
+        assert cells[2] == cells[3] != cells[0] != cells[1]
+
+    def test_zoom(self):
+        assert tile_zoom(bbox, 14, 2**20) == 14
+        zoom = tile_zoom(bbox, 14, 4)
+        assert len(list(mercantile.tiles(*bbox, zooms=zoom))) <= 4
+        assert len(list(mercantile.tiles(*bbox, zooms=zoom + 1))) > 4
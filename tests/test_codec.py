@@ -0,0 +1,111 @@
+import zlib
+
+import numpy as np
+import simplejson as json
+
+from server import codec
+
+features = [
+    (9.1900474, 45.4642035, 21154906, 1199145600.0, 1609459200.0, 7, 0.5),
+    (9.1901, 45.4643, 4533112321, 1420070400.0, 1420070400.0, 1, 0.12),
+]
+
+
+class TestCodec:
+    def test_roundtrip(self):
+        encoded = codec.encode(codec.to_array(features))
+        assert codec.is_encoded(encoded)
+        assert codec.decode(encoded).tolist() == features
+
+    def test_uncompressed(self):
+        encoded = codec.encode(codec.to_array(features), compression=0)
+        assert codec.decode(encoded).tolist() == features
+
+    def test_blocks(self):
+        array = np.zeros(codec.BLOCK_ROWS * 2 + 3, dtype=codec.DTYPE)
+        array["id"] = np.arange(len(array))
+        decoded = codec.decode(codec.encode(array))
+        assert (decoded == array).all()
+
+    def test_empty(self):
+        encoded = codec.encode(codec.to_array([]))
+        assert encoded
+        assert len(codec.decode(encoded)) == 0
+
+    def test_legacy(self):
+        lines = "".join(
+            json.dumps(feature, use_decimal=True) + "\n"
+            for feature in features
+        )
+        legacy = zlib.compress(lines.encode())
+        assert not codec.is_encoded(legacy)
+        assert codec.decode(legacy).tolist() == features
+
+
+def scattered(size, seed=0):
+    rng = np.random.default_rng(seed)
+    array = np.zeros(size, dtype=codec.DTYPE)
+    array["lon"] = rng.uniform(9.1, 9.2, size)
+    array["lat"] = rng.uniform(45.4, 45.5, size)
+    array["id"] = np.arange(size)
+    return array
+
+
+class TestEncoder:
+    def test_written_when_closed(self):
+        array = np.zeros(codec.BLOCK_ROWS * 2 + 3, dtype=codec.DTYPE)
+        array["lon"] = np.linspace(10, -10, len(array))
+        chunks = []
+        encoder = codec.Encoder(chunks.append)
+        for row in array.tolist():
+            encoder.append(row)
+        assert chunks == []
+        stored = encoder.close()
+        # the header, a chunk per block and the index
+        assert len(chunks) == 5
+        assert (stored == codec.spatial_sort(array)).all()
+        assert (codec.decode(b"".join(chunks)) == stored).all()
+
+
+class TestIndex:
+    def test_sorted_along_the_curve(self):
+        array = scattered(codec.BLOCK_ROWS * 4)
+        decoded = codec.decode(codec.encode(array))
+        assert sorted(decoded["id"].tolist()) == array["id"].tolist()
+        codes = codec.morton(decoded["lon"], decoded["lat"])
+        assert (np.diff(codes.astype(np.float64)) >= 0).all()
+
+    def test_blocks_within_bounds(self):
+        encoded = codec.encode(scattered(codec.BLOCK_ROWS * 16))
+        index = codec.Index(codec.read_index(encoded), codec.FLAG_INDEX)
+        bounds = (9.1, 45.4, 9.12, 45.42)
+        blocks = index.overlapping(*bounds)
+        assert 0 < len(blocks) < len(index.blocks) // 4
+        entries = index.blocks[blocks].tolist()
+        payloads = [
+            encoded[entry[1] : entry[1] + entry[2]] for entry in entries
+        ]
+        rows = [entry[0] for entry in entries]
+        flags = codec.decode_header(encoded)
+        selected = np.concatenate(codec.decode_blocks(payloads, rows, flags))
+        features = codec.decode(encoded)
+        west, south, east, north = bounds
+        inside = features[
+            (west <= features["lon"])
+            & (features["lon"] <= east)
+            & (south <= features["lat"])
+            & (features["lat"] <= north)
+        ]
+        assert set(inside["id"].tolist()) <= set(selected["id"].tolist())
+
+    def test_without_index(self):
+        """Tiles cached before the index was added"""
+        array = scattered(codec.BLOCK_ROWS + 3)
+        blocks = [
+            codec.encode_block(array[offset : offset + codec.BLOCK_ROWS])
+            for offset in (0, codec.BLOCK_ROWS)
+        ]
+        flags = codec.FLAG_SHUFFLE | codec.FLAG_ZLIB
+        blob = codec.header.pack(codec.MAGIC, codec.VERSION, flags)
+        decoded = codec.decode(blob + b"".join(blocks))
+        assert (decoded == array).all()
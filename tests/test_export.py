@@ -0,0 +1,306 @@
+import asyncio
+import csv
+import io
+import json
+import statistics
+import struct
+
+import mercantile
+import numpy as np
+import pytest
+from features import random_features
+
+from server import export, process, summary
+
+
+def edge_cases(size, seed):
+    """Infinite frequencies and nodes on the prime meridian"""
+    features = random_features(
+        size, seed, ids=(1, 2**40), revisions=500, frequency=50
+    )
+    features["frequency"][::97] = np.inf
+    features["lon"][:3] = [0.0, -0.0, 1e-7][:size]
+    return features
+
+
+def run(writer, batches, monkeypatch, quadkeys=None):
+    async def generate_tiles(*args, **kwargs):
+        for quadkey, batch in zip(quadkeys or ["0"] * len(batches), batches):
+            yield quadkey, batch
+
+    async def collect():
+        return [chunk async for chunk in export.export(writer, None, "", "")]
+
+    monkeypatch.setattr(export, "generate_tiles", generate_tiles)
+    chunks = asyncio.run(collect())
+    assert chunks[0] == b""
+    return chunks
+
+
+def reference_collection(features):
+    """What getData wrote one feature at a time"""
+    return (
+        '{"type": "FeatureCollection", "features": ['
+        + ", ".join(map(process.feature_to_geojson, features.tolist()))
+        + "]}"
+    ).encode()
+
+
+def search(nodes, size, bbox, node_size=16):
+    """Indices of the leaves within bbox, as FlatGeobuf readers do"""
+    counts = [size]
+    while counts[-1] > 1 or len(counts) == 1:
+        counts.append(-(-counts[-1] // node_size))
+    ends = np.sum(counts) - np.cumsum(counts) + counts
+    found = []
+    queue = [(0, len(counts) - 1)]
+    while queue:
+        index, level = queue.pop()
+        node = nodes[index]
+        if (
+            node["max_x"] < bbox[0]
+            or bbox[2] < node["min_x"]
+            or node["max_y"] < bbox[1]
+            or bbox[3] < node["min_y"]
+        ):
+            continue
+        if level == 0:
+            found.append(int(node["offset"]) // 100)
+            continue
+        first = int(node["offset"])
+        for child in range(first, min(first + node_size, ends[level - 1])):
+            queue.append((child, level - 1))
+    return sorted(found)
+
+
+batches = [edge_cases(size, size) for size in (0, 1, 3000, 700)]
+features = np.concatenate(batches)
+
+
+class TestGeoJSON:
+    def test_identical(self):
+        assert (
+            export.features_to_geojson(features)
+            == (
+                ", ".join(map(process.feature_to_geojson, features.tolist()))
+            ).encode()
+        )
+
+    def test_chunks(self, monkeypatch):
+        chunks = run(export.GeoJSON(), batches, monkeypatch)
+        assert all(len(chunk) < 2 * export.EXPORT_CHUNK for chunk in chunks)
+        assert b"".join(chunks) == reference_collection(features)
+
+    def test_empty(self, monkeypatch):
+        chunks = run(export.GeoJSON(), [], monkeypatch)
+        assert b"".join(chunks) == reference_collection(features[:0])
+
+
+def tiled(features, zoom):
+    """features in batches per tile of zoom, in depth-first order"""
+    x, y = summary.tile_indices(features["lon"], features["lat"], zoom)
+    quadkeys = [
+        mercantile.quadkey(x, y, zoom) for x, y in zip(x.tolist(), y.tolist())
+    ]
+    order = sorted(set(quadkeys))
+    return order, [
+        features[[quadkey == tile for quadkey in quadkeys]] for tile in order
+    ]
+
+
+class TestAggregated:
+    bbox = mercantile.Bbox(0.0, 45.4, 9.3, 45.5)
+
+    def aggregated(self, zoom, tile_zoom, monkeypatch):
+        quadkeys, batches = tiled(features, tile_zoom)
+        writer = export.Aggregated(self.bbox, zoom)
+        chunks = run(writer, batches, monkeypatch, quadkeys)
+        return json.loads(b"".join(chunks))["features"], writer.zoom
+
+    @pytest.mark.parametrize(
+        ("zoom", "tile_zoom"), [(10, 12), (5, 12), (5, 8), (1, 12)]
+    )
+    def test_clusters(self, zoom, tile_zoom, monkeypatch):
+        clusters, cell_zoom = self.aggregated(zoom, tile_zoom, monkeypatch)
+        assert sum(c["properties"]["count"] for c in clusters) == len(features)
+        x, y = summary.tile_indices(
+            features["lon"], features["lat"], cell_zoom
+        )
+        cells = {}
+        for index, tile in enumerate(zip(x.tolist(), y.tolist())):
+            cells.setdefault(tile, []).append(index)
+        assert len(clusters) == len(cells)
+        for cluster in clusters:
+            lon, lat = cluster["geometry"]["coordinates"]
+            tile = mercantile.tile(lon, lat, cell_zoom)[:2]
+            members = features[cells[tile]]
+            properties = cluster["properties"]
+            assert properties["count"] == len(members)
+            assert properties["revisions_min"] == members["revisions"].min()
+            assert properties["revisions_max"] == members["revisions"].max()
+            median = statistics.median(members["lastedit"].tolist())
+            assert np.isclose(properties["lastedit"], median)
+            if len(members) == 1:
+                assert properties["id"] == members["id"][0]
+            else:
+                assert "id" not in properties
+
+    def test_pending_cell_only(self, monkeypatch):
+        quadkeys, batches = tiled(features, 14)
+        writer = export.Aggregated(self.bbox, 2)
+        largest = 0
+        for quadkey, batch in zip(quadkeys, batches):
+            list(writer.write(batch, quadkey))
+            largest = max(largest, sum(map(len, writer.pending)))
+        cell = [quadkey[: writer.zoom] for quadkey in quadkeys]
+        assert largest == max(
+            sum(len(b) for c, b in zip(cell, batches) if c == prefix)
+            for prefix in set(cell)
+        )
+
+    def test_bounded(self, monkeypatch):
+        monkeypatch.setattr(export, "AGGREGATE_CELLS", 16)
+        clusters, _ = self.aggregated(18, 12, monkeypatch)
+        assert 1 < len(clusters) <= 16
+        assert sum(c["properties"]["count"] for c in clusters) == len(features)
+
+    def test_empty(self, monkeypatch):
+        chunks = run(export.Aggregated(self.bbox, 10), [], monkeypatch)
+        assert json.loads(b"".join(chunks))["features"] == []
+
+
+class TestCSV:
+    def test_same_as_csv_module(self, monkeypatch):
+        body = b"".join(run(export.CSV(), batches, monkeypatch))
+        expected = io.StringIO()
+        writer = csv.writer(expected, lineterminator="\n")
+        writer.writerow(export.COLUMNS)
+        writer.writerows(features.tolist())
+        assert body == expected.getvalue().encode()
+
+
+class TestFlatGeobuf:
+    def test_builder(self):
+        buffer = export.Builder().finish(
+            {0: "name", 2: ("<B", 1), 3: np.array([1.5, 2.5])}
+        )
+        (size,) = struct.unpack_from("<I", buffer)
+        assert size == len(buffer) - 4
+        (root,) = struct.unpack_from("<I", buffer, 4)
+        table = 4 + root
+        assert table % 8 == 0
+        (vtable,) = struct.unpack_from("<i", buffer, table)
+        vtable_size, _, *offsets = struct.unpack_from(
+            "<6H", buffer, table - vtable
+        )
+        assert vtable_size == 12
+        name, missing, kind, doubles = offsets
+        assert missing == 0
+        assert buffer[table + kind] == 1
+        string = table + name
+        string += struct.unpack_from("<I", buffer, string)[0]
+        assert buffer[string : string + 9] == b"\x04\0\0\0name\0"
+        vector = table + doubles
+        vector += struct.unpack_from("<I", buffer, vector)[0]
+        assert (vector + 4) % 8 == 0
+        assert struct.unpack_from("<Idd", buffer, vector) == (2, 1.5, 2.5)
+
+    @pytest.mark.parametrize("size", [1, 16, 17, 1000])
+    def test_rtree(self, size):
+        nodes = np.frombuffer(
+            export.packed_rtree(features[:size], 16, 100), dtype=export.NODE
+        )
+        leaves = nodes[-size:]
+        assert leaves["offset"].tolist() == list(range(0, size * 100, 100))
+        root = nodes[0]
+        assert root["min_x"] == features["lon"][:size].min()
+        assert root["max_y"] == features["lat"][:size].max()
+        bbox = (9.15, 45.42, 9.2, 45.45)
+        found = search(nodes, size, bbox)
+        lon, lat = features["lon"][:size], features["lat"][:size]
+        inside = (
+            (bbox[0] <= lon)
+            & (lon <= bbox[2])
+            & (bbox[1] <= lat)
+            & (lat <= bbox[3])
+        )
+        assert found == np.flatnonzero(inside).tolist()
+
+    def test_gdal(self, monkeypatch, tmp_path):
+        pyogrio = pytest.importorskip("pyogrio")
+        body = b"".join(run(export.FlatGeobuf(), batches, monkeypatch))
+        path = tmp_path / "nodes.fgb"
+        path.write_bytes(body)
+        info = pyogrio.read_info(path)
+        assert info["features"] == len(features)
+        assert info["capabilities"]["fast_spatial_filter"]
+        meta, _, geometry, fields = pyogrio.raw.read(path)
+        assert meta["fields"].tolist() == [
+            "id",
+            "creation",
+            "lastedit",
+            "revisions",
+            "frequency",
+        ]
+        order = np.argsort(fields[0])
+        expected = features[np.argsort(features["id"])]
+        assert (fields[0][order] == expected["id"]).all()
+        assert (fields[3][order] == expected["revisions"]).all()
+        assert (fields[4][order] == expected["frequency"]).all()
+        points = np.array([struct.unpack("<xIdd", wkb) for wkb in geometry])
+        assert (points[order, 1] == expected["lon"]).all()
+        # the spatial index is used and complete
+        bbox = (9.15, 45.42, 9.2, 45.45)
+        _, _, _, within = pyogrio.raw.read(path, bbox=bbox)
+        inside = (
+            (bbox[0] <= features["lon"])
+            & (features["lon"] <= bbox[2])
+            & (bbox[1] <= features["lat"])
+            & (features["lat"] <= bbox[3])
+        )
+        assert sorted(within[0]) == sorted(features["id"][inside])
+
+    def test_spooled(self):
+        writer = export.FlatGeobuf()
+        template, _ = export.feature_template()
+        for batch in batches:
+            assert writer.write(batch) == ()
+        assert writer.spool.tell() == len(features) * len(template)
+        assert all(points.dtype == export.POINTS for points in writer.points)
+        body = b"".join(writer.finish())
+        assert writer.spool.closed
+        assert len(body) > len(features) * len(template)
+
+    def test_empty(self, monkeypatch, tmp_path):
+        body = b"".join(run(export.FlatGeobuf(), [], monkeypatch))
+        assert body.startswith(export.MAGIC)
+        pyogrio = pytest.importorskip("pyogrio")
+        path = tmp_path / "nodes.fgb"
+        path.write_bytes(body)
+        _, _, geometry, _ = pyogrio.raw.read(path)
+        assert len(geometry) == 0
+
+
+class TestGeoParquet:
+    def test_table(self, monkeypatch, tmp_path):
+        pytest.importorskip("pyarrow")
+        import pyarrow.parquet
+
+        monkeypatch.setattr(export.GeoParquet, "row_group", 2000)
+        chunks = run(export.GeoParquet(), batches, monkeypatch)
+        path = tmp_path / "nodes.parquet"
+        path.write_bytes(b"".join(chunks))
+        parquet = pyarrow.parquet.ParquetFile(path)
+        assert parquet.metadata.num_row_groups == 2
+        geo = parquet.schema_arrow.metadata[b"geo"]
+        assert b'"encoding": "WKB"' in geo
+        table = parquet.read()
+        assert table["id"].to_pylist() == features["id"].tolist()
+        points = [
+            struct.unpack("<BIdd", wkb)
+            for wkb in table["geometry"].to_pylist()
+        ]
+        assert points == [
+            (1, 1, lon, lat)
+            for lon, lat in zip(features["lon"], features["lat"])
+        ]
@@ -0,0 +1,156 @@
+import io
+
+import pytest
+import simplejson as json
+
+from server import process
+from server.changes import to_timestamp
+from server.filters import UnsupportedFilter, parse
+from server.history import History
+
+end = "2024-01-01T00:00:00Z"
+
+# osmid: versions of (valid from, tags); the last one is still valid
+nodes = {
+    1: [
+        ("2010-01-01T00:00:00Z", {}),
+        ("2012-01-01T00:00:00Z", {"shop": "bakery"}),
+    ],
+    2: [("2011-01-01T00:00:00Z", {"amenity": "cafe", "name": "Bar"})],
+    3: [("2013-01-01T00:00:00Z", {"amenity": "bar"})],
+    4: [
+        ("2014-01-01T00:00:00Z", {"amenity": "cafe"}),
+        ("2015-01-01T00:00:00Z", {}),
+    ],
+}
+deleted = {5: [("2012-01-01T00:00:00Z", {"amenity": "cafe"})]}
+
+
+def ohsome_response(nodes, deleted):
+    features = []
+    for osmid, versions in [*nodes.items(), *deleted.items()]:
+        for number, (valid_from, tags) in enumerate(versions):
+            last = number == len(versions) - 1
+            valid_to = versions[number + 1][0] if not last else end
+            if osmid in deleted:
+                valid_to = "2013-01-01T00:00:00Z"
+            properties = {
+                "@osmId": f"node/{osmid}",
+                "@validFrom": valid_from,
+                "@validTo": valid_to,
+                "@version": number + 1,
+                **tags,
+            }
+            geometry = {"type": "Point", "coordinates": [9 + osmid, 45.0]}
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": geometry,
+                    "properties": properties,
+                }
+            )
+    return json.dumps({"type": "FeatureCollection", "features": features})
+
+
+def history():
+    body = ohsome_response(nodes, deleted).encode()
+    _, encoded = process.stream_to_history(io.BytesIO(body), end)
+    return History.decode(encoded)
+
+
+class TestParse:
+    @pytest.mark.parametrize(
+        "expression, parsed",
+        [
+            ("type:node", ("type", "node")),
+            ("amenity=*", ("tag", "amenity", None)),
+            (
+                '"addr:street"="Via \\"Roma\\""',
+                ("tag", "addr:street", 'Via "Roma"'),
+            ),
+            ("shop!=*", ("not", ("tag", "shop", None))),
+            (
+                "amenity in (cafe, bar)",
+                ("or", ("tag", "amenity", "cafe"), ("tag", "amenity", "bar")),
+            ),
+            (
+                "a=1 or b=2 and not c=3",
+                (
+                    "or",
+                    ("tag", "a", "1"),
+                    ("and", ("tag", "b", "2"), ("not", ("tag", "c", "3"))),
+                ),
+            ),
+            (
+                "(a=1 or b=2) and type:node",
+                (
+                    "and",
+                    ("or", ("tag", "a", "1"), ("tag", "b", "2")),
+                    ("type", "node"),
+                ),
+            ),
+        ],
+    )
+    def test_supported(self, expression, parsed):
+        assert parse(expression) == parsed
+
+    @pytest.mark.parametrize(
+        "expression",
+        [
+            "geometry:point",
+            "id:123",
+            "amenity=",
+            "(amenity=cafe",
+            "amenity=cafe shop=*",
+            "type:area",
+            "amenity=cafe and",
+            "",
+        ],
+    )
+    def test_unsupported(self, expression):
+        with pytest.raises(UnsupportedFilter):
+            parse(expression)
+
+
+class TestHistory:
+    def test_same_as_processed(self):
+        body = ohsome_response(nodes, deleted).encode()
+        processed = list(process.stream_to_processed(io.BytesIO(body), end))
+        features = history().select(parse("type:node"))
+        assert features[
+            ["lon", "lat", "id", "creation", "lastedit", "revisions"]
+        ].tolist() == [feature[:6] for feature in processed]
+
+    def test_select(self):
+        features = history().select(parse("amenity=cafe or shop=*"))
+        assert features["id"].tolist() == [1, 2]
+        assert features["revisions"].tolist() == [2, 1]
+        # as ohsome: since the node has matched the filter
+        assert features["creation"].tolist() == [
+            to_timestamp("2012-01-01T00:00:00Z"),
+            to_timestamp("2011-01-01T00:00:00Z"),
+        ]
+
+    def test_not(self):
+        features = history().select(parse("amenity!=cafe and type:node"))
+        assert features["id"].tolist() == [1, 3, 4]
+        assert features["creation"][2] == to_timestamp("2015-01-01T00:00:00Z")
+        assert not len(history().select(parse("type:way")))
+
+    def test_unknown(self):
+        assert not len(history().select(parse("amenity=pub or craft=*")))
+
+    def test_empty(self):
+        body = ohsome_response({}, {}).encode()
+        _, encoded = process.stream_to_history(io.BytesIO(body), end)
+        assert len(History.decode(encoded).select(parse("amenity=*"))) == 0
+
+
+class TestLocalFilter:
+    def test_fallback(self, monkeypatch):
+        monkeypatch.setattr(process, "LOCAL_FILTERS", 1)
+        assert process.local_filter("amenity=* and type:node")
+        assert process.local_filter("type:node") is None
+        assert process.local_filter("geometry:point and type:node") is None
+        monkeypatch.setattr(process, "LOCAL_FILTERS", 0)
+        assert process.local_filter("amenity=* and type:node") is None
@@ -0,0 +1,153 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from server import flight, pool
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    server = fakeredis.FakeServer()
+    db = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(flight, "db", db)
+    monkeypatch.setattr(flight, "release", db.register_script(flight.RELEASE))
+    monkeypatch.setattr(
+        flight, "connect", lambda: fakeredis.FakeAsyncRedis(server=server)
+    )
+    monkeypatch.setattr(flight, "listener", None)
+    return db
+
+
+def run(coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            if flight.listener is not None:
+                await flight.listener.close()
+
+    return asyncio.run(main())
+
+
+def store(db, key, value):
+    async def load():
+        result = db.get(f"value:{key}")
+        return None if result is None else result.decode()
+
+    async def fetch():
+        fetch.calls += 1
+        await asyncio.sleep(0.01)
+        db.set(f"value:{key}", value)
+        return value
+
+    fetch.calls = 0
+    return load, fetch
+
+
+def failure(status):
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise aiohttp.ClientResponseError(
+            None, (), status=status, message="Service Unavailable"
+        )
+
+    return fetch
+
+
+class TestSingleFlight:
+    def test_coalesce(self, redis):
+        load, fetch = store(redis, "a", "value")
+
+        async def main():
+            return await asyncio.gather(
+                *(flight.single_flight("a", load, fetch) for _ in range(10))
+            )
+
+        assert run(main()) == ["value"] * 10
+        assert fetch.calls == 1
+        assert redis.get(flight.LOCK + "a") is None
+        assert run(flight.single_flight("a", load, fetch)) == "value"
+        assert fetch.calls == 1
+
+    def test_failure(self, redis):
+        load, _ = store(redis, "a", "value")
+
+        async def main():
+            return await asyncio.gather(
+                *(
+                    flight.single_flight("a", load, failure(503))
+                    for _ in range(5)
+                ),
+                return_exceptions=True,
+            )
+
+        errors = run(main())
+        assert all(error.status == 503 for error in errors)
+        assert redis.get(flight.LOCK + "a") is None
+
+    def test_other_worker(self, redis):
+        load, fetch = store(redis, "a", "value")
+        redis.set(flight.LOCK + "a", "token", ex=60)
+
+        async def main():
+            waiting = asyncio.ensure_future(
+                flight.single_flight("a", load, fetch)
+            )
+            await asyncio.sleep(0.1)
+            assert not waiting.done()
+            redis.set("value:a", "stored")
+            redis.publish(flight.CHANNEL + "a", "")
+            return await waiting
+
+        assert run(main()) == "stored"
+        assert fetch.calls == 0
+
+    def test_other_worker_failure(self, redis):
+        load, fetch = store(redis, "a", "value")
+        redis.set(flight.LOCK + "a", "token", ex=60)
+
+        async def main():
+            waiting = asyncio.ensure_future(
+                flight.single_flight("a", load, fetch)
+            )
+            await asyncio.sleep(0.1)
+            redis.publish(flight.CHANNEL + "a", "503 Service Unavailable")
+            return await waiting
+
+        with pytest.raises(flight.FlightError) as error:
+            run(main())
+        assert error.value.status == 503
+        assert fetch.calls == 0
+
+    def test_stale_lock(self, redis):
+        load, fetch = store(redis, "a", "value")
+        redis.set(flight.LOCK + "a", "token", px=100)
+        assert run(flight.single_flight("a", load, fetch)) == "value"
+        assert fetch.calls == 1
+
+    def test_budget_per_caller(self, redis):
+        load, _ = store(redis, "a", "value")
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            pool.budget.get().charge(5)  # as offload() does
+            redis.set("value:a", "value")
+            return "value"
+
+        async def caller(seconds):
+            budget = pool.Budget(seconds)
+            pool.budget.set(budget)
+            return await flight.single_flight("a", load, fetch), budget.used
+
+        async def main():
+            return await asyncio.gather(
+                caller(1), caller(100), return_exceptions=True
+            )
+
+        small, large = run(main())
+        assert isinstance(small, pool.BudgetExceeded)
+        assert large == ("value", 5)
+        assert redis.get("value:a") == b"value"
@@ -0,0 +1,134 @@
+import time
+
+import numpy as np
+import pytest
+import redis
+import walrus
+
+from server import changes, codec, ingest, plan, process
+from server.storage import RedisStorage
+
+start = "2010-01-01T00:00:00Z"
+end = "2024-01-01T00:00:00Z"
+
+
+def version(id, number, timestamp, visible=True):
+    return id, number, ingest.epoch(timestamp), visible, 9.0 + number, 45.0
+
+
+class TestIngest:
+    def reduce(self, versions):
+        chunks = []
+        reducer = ingest.Reducer(
+            ingest.epoch(start), ingest.epoch(end), chunks.append
+        )
+        for arguments in versions:
+            reducer.add(*arguments)
+        reducer.close()
+        return np.concatenate(chunks) if chunks else []
+
+    def test_reduce(self):
+        rows = self.reduce(
+            [
+                # edited before start, then twice
+                version(1, 1, "2008-01-01T00:00:00Z"),
+                version(1, 2, "2009-01-01T00:00:00Z"),
+                version(1, 3, "2012-01-01T00:00:00Z"),
+                version(1, 4, "2015-01-01T00:00:00Z"),
+                # deleted
+                version(2, 1, "2011-01-01T00:00:00Z"),
+                version(2, 2, "2013-01-01T00:00:00Z", visible=False),
+                # deleted before start, then restored
+                version(3, 1, "2008-01-01T00:00:00Z"),
+                version(3, 2, "2009-01-01T00:00:00Z", visible=False),
+                version(3, 3, "2014-01-01T00:00:00Z"),
+                # deleted after end
+                version(4, 1, "2011-01-01T00:00:00Z"),
+                version(4, 2, "2025-01-01T00:00:00Z", visible=False),
+                # created after end
+                version(5, 1, "2025-01-01T00:00:00Z"),
+            ]
+        )
+        assert rows["id"].tolist() == [1, 3, 4]
+        assert rows["first"].tolist() == [
+            ingest.epoch(start),
+            ingest.epoch("2014-01-01T00:00:00Z"),
+            ingest.epoch("2011-01-01T00:00:00Z"),
+        ]
+        assert rows["last"][0] == ingest.epoch("2015-01-01T00:00:00Z")
+        assert rows["version"].tolist() == [4, 3, 1]
+        assert rows["lon"].tolist() == [13.0, 12.0, 10.0]
+
+    def test_same_as_process(self):
+        rows = self.reduce(
+            [
+                version(1, 1, "2008-01-01T00:00:00Z"),
+                version(1, 4, "2015-06-01T12:30:00Z"),
+                version(2, 2, "2021-03-04T05:06:07Z"),
+            ]
+        )
+        features = ingest.to_features(rows, time.time())
+        expected = [
+            process.process(
+                process.Version("node/1", start, end, 1, 9.0, 45.0),
+                process.Version(
+                    "node/1", "2015-06-01T12:30:00Z", end, 4, 13.0, 45.0
+                ),
+                end,
+            ),
+            process.process(
+                *[
+                    process.Version(
+                        "node/2", "2021-03-04T05:06:07Z", end, 2, 11.0, 45.0
+                    )
+                ]
+                * 2,
+                end,
+            ),
+        ]
+        assert features.tolist() == expected
+
+    def test_created_today(self):
+        now = time.time()
+        today = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+        rows = np.zeros(1, dtype=ingest.RAW)
+        rows[0] = (1, ingest.epoch(today), ingest.epoch(today), 2, 11, 45)
+        features = ingest.to_features(rows, now)
+        current = process.Version("node/1", today, end, 2, 11.0, 45.0)
+        expected = process.process(current, current, end)
+        assert features.tolist() == [expected]
+        assert expected[-1] == 2 * 365
+        changes.update_frequency(features)
+        assert features["frequency"][0] == 2 * 365
+
+    def test_load_tile(self, monkeypatch, tmp_path):
+        fakeredis = pytest.importorskip("fakeredis")
+        db = walrus.Database(
+            connection_pool=redis.ConnectionPool(
+                connection_class=fakeredis.FakeConnection,
+                server=fakeredis.FakeServer(),
+            )
+        )
+        storage = RedisStorage(db)
+        for module in (ingest, process, plan):
+            monkeypatch.setattr(module, "storage", storage)
+        monkeypatch.setattr(plan, "db", db)
+        rows = self.reduce(
+            [
+                version(1, 1, "2011-01-01T00:00:00Z"),
+                version(2, 2, "2012-01-01T00:00:00Z"),
+            ]
+        )
+        quadkey = "120220011"
+        path = tmp_path / quadkey
+        path.write_bytes(rows.tobytes())
+        assert ingest.load_tile(str(path), start, end, time.time()) == 2
+        key = process.tile_cache_key(
+            quadkey, start, end, process.DEFAULT_FILTER
+        )
+        stored = codec.decode(storage.get(f"tile:{key}"))
+        assert stored["id"].tolist() == [1, 2]
+        latest = process.latest_key(quadkey, start, process.DEFAULT_FILTER)
+        assert storage.get(latest) == end.encode()
+        assert int(db.hget(plan.density_key(quadkey), quadkey)) == 2
+        assert not path.exists()
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from server import codec
+from server.lru import LRU
+
+
+def features(size):
+    return np.zeros(size, dtype=codec.DTYPE)
+
+
+class TestLRU:
+    def test_evict_least_recently_used(self):
+        size = features(10).nbytes
+        lru = LRU(3 * size, largest=1)
+        for key in "abc":
+            lru.put(key, "end", features(10))
+        assert lru.get("a", "end") is not None
+        lru.put("d", "end", features(10))
+        assert lru.get("b", "end") is None
+        assert [key for _, key in lru.entries] == ["c", "a", "d"]
+        assert lru.size == 3 * size
+
+    def test_size_aware(self):
+        size = features(10).nbytes
+        lru = LRU(8 * size)
+        lru.put("small", "end", features(10))
+        lru.put("large", "end", features(11))
+        assert [key for _, key in lru.entries] == ["small"]
+        lru.put("replaced", "end", features(5))
+        lru.put("replaced", "end", features(10))
+        assert lru.size == 2 * size
+
+    def test_new_end(self):
+        lru = LRU(2**20)
+        lru.put("key", "2024-01-01", features(10))
+        assert lru.get("key", "2024-01-01") is not None
+        assert lru.get("key", "2024-01-02") is None
+        assert lru.size == 0
+
+    def test_previous_end(self):
+        lru = LRU(2**20)
+        lru.put("key", "2024-01-01", features(10))
+        lru.put("key", "2024-01-02", features(10))
+        # requests still using the previous metadata clear nothing
+        for _ in range(3):
+            lru.put("other", "2024-01-01", features(10))
+            assert lru.get("key", "2024-01-02") is not None
+        assert lru.get("other", "2024-01-01") is not None
+        assert lru.get("key", "2024-01-01") is None
+
+    def test_read_only(self):
+        lru = LRU(2**20)
+        cached = lru.put("key", "end", features(10))
+        with pytest.raises(ValueError):
+            cached["lon"][0] = 1
+
+    def test_stats(self):
+        lru = LRU(2**20)
+        lru.get("key", "end")
+        lru.put("key", "end", features(10))
+        lru.get("key", "end")
+        lru.get("key", "end")
+        stats = lru.stats()
+        assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 1, 1)
+        assert stats["hit_rate"] == pytest.approx(2 / 3)
+
+    def test_disabled(self):
+        lru = LRU(0)
+        lru.put("key", "end", features(0))
+        assert lru.get("key", "end") is None
@@ -0,0 +1,119 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from server import metrics, pool
+
+
+def staged(seconds):
+    metrics.record("stage", seconds)
+    return seconds
+
+
+def observed(stage):
+    return metrics.prometheus_client.REGISTRY.get_sample_value(
+        "stage_seconds_sum", {"stage": stage}
+    )
+
+
+@pytest.fixture(params=[0, 1])
+def workers(request, monkeypatch):
+    monkeypatch.setattr(pool, "PROCESS_WORKERS", request.param)
+    monkeypatch.setattr(pool, "executor", None)
+    yield request.param
+    if pool.executor is not None:
+        pool.executor.shutdown()
+
+
+async def handler(request):
+    with metrics.timer("work"):
+        await pool.offload(staged, 0.5)
+    return web.Response(text="ok")
+
+
+async def get(*paths):
+    app = web.Application(middlewares=[metrics.instrument])
+    app.add_routes(
+        [web.get("/", handler), web.get("/metrics", metrics.metrics)]
+    )
+    async with TestClient(TestServer(app)) as client:
+        responses = []
+        for path in paths:
+            response = await client.get(path)
+            responses.append((response.headers, await response.text()))
+        return responses
+
+
+class TestMetrics:
+    def test_record(self):
+        async def request():
+            current = {}
+            metrics.timings.set(current)
+            metrics.record("stage", 1)
+            with metrics.timer("stage"):
+                pass
+            return current
+
+        before = observed("stage") or 0
+        assert asyncio.run(request())["stage"] >= 1
+        assert observed("stage") >= before + 1
+
+    def test_offload(self, workers):
+        async def request():
+            current = {}
+            metrics.timings.set(current)
+            await pool.offload(staged, 2)
+            await pool.offload(staged, 3)
+            return current
+
+        before = observed("stage") or 0
+        assert asyncio.run(request()) == {"stage": 5}
+        # observed once, in this process
+        assert observed("stage") == before + 5
+
+    def test_server_timing(self, workers):
+        ((headers, _),) = asyncio.run(get("/"))
+        stages = dict(
+            entry.split(";dur=")
+            for entry in headers["Server-Timing"].split(", ")
+        )
+        assert list(stages) == ["stage", "work", "total"]
+        assert float(stages["stage"]) == 500
+        assert float(stages["total"]) >= float(stages["work"])
+
+    def test_exposition(self):
+        _, (headers, body) = asyncio.run(get("/", "/metrics"))
+        assert headers["Content-Type"].startswith("text/plain")
+        assert 'requests_in_flight{handler="handler"}' in body
+        assert 'stage_seconds_count{stage="work"}' in body
+
+    def test_endpoint_labels(self, monkeypatch):
+        async def node(request):
+            return web.json_response({})
+
+        async def request():
+            app = web.Application()
+            app.add_routes([web.get("/api/0.6/node/{id}.json", node)])
+            async with TestServer(app) as server:
+                osm = str(server.make_url("/api/0.6"))
+                monkeypatch.setattr(metrics, "ENDPOINTS", {osm: "osm"})
+                async with aiohttp.ClientSession(
+                    trace_configs=[metrics.trace_config()]
+                ) as session:
+                    for id in (1, 2):
+                        async with session.get(f"{osm}/node/{id}.json"):
+                            pass
+
+        asyncio.run(request())
+        series = {
+            (sample.labels["endpoint"], sample.labels["status"])
+            for family in metrics.prometheus_client.REGISTRY.collect()
+            if family.name == "ohsome_request_seconds"
+            for sample in family.samples
+            if sample.name.endswith("_count")
+            and sample.labels["endpoint"] in ("osm", "other")
+        }
+        assert series == {("osm", "200")}
@@ -0,0 +1,140 @@
+import struct
+
+import mercantile
+import numpy as np
+
+from server import codec, mvt
+
+tile = mercantile.Tile(8609, 5873, 14)
+
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+
+def fields(data):
+    """Decode a protobuf message into (number, value) pairs"""
+    offset = 0
+    while offset < len(data):
+        key, offset = read_varint(data, offset)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, offset = read_varint(data, offset)
+        elif wire_type == 1:
+            value = struct.unpack_from("<d", data, offset)[0]
+            offset += 8
+        else:
+            size, offset = read_varint(data, offset)
+            value = data[offset : offset + size]
+            offset += size
+        yield number, value
+
+
+def unpack(data):
+    values, offset = [], 0
+    while offset < len(data):
+        value, offset = read_varint(data, offset)
+        values.append(value)
+    return values
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode(body):
+    """Features of the only layer, as (id, x, y, properties)"""
+    ((number, layer),) = fields(body)
+    assert number == 3
+    layer = list(fields(layer))
+    assert (15, 2) in layer and (5, mvt.EXTENT) in layer
+    assert (1, b"nodes") in layer
+    keys = [value.decode() for number, value in layer if number == 3]
+    values = []
+    for number, value in layer:
+        if number == 4:
+            ((kind, value),) = fields(value)
+            values.append(unzigzag(value) if kind == 6 else value)
+    features = []
+    for number, feature in layer:
+        if number != 2:
+            continue
+        feature = dict(fields(feature))
+        assert feature[3] == 1
+        command, x, y = unpack(feature[4])
+        assert command == 9
+        tags = unpack(feature[2])
+        properties = {
+            keys[key]: values[value]
+            for key, value in zip(tags[::2], tags[1::2])
+        }
+        features.append((feature.get(1), unzigzag(x), unzigzag(y), properties))
+    return features
+
+
+def nodes(size, seed=0):
+    bounds = mercantile.bounds(tile)
+    rng = np.random.default_rng(seed)
+    features = np.zeros(size, dtype=codec.DTYPE)
+    features["lon"] = rng.uniform(bounds.west, bounds.east, size)
+    features["lat"] = rng.uniform(bounds.south, bounds.north, size)
+    features["id"] = rng.integers(1, 2**40, size)
+    features["creation"] = rng.integers(1.2e9, 1.7e9, size)
+    features["lastedit"] = features["creation"] + 3600
+    features["revisions"] = rng.integers(1, 20, size)
+    features["frequency"] = rng.exponential(50, size)
+    return features
+
+
+class TestEncode:
+    def test_point_geometry(self):
+        # example from the specification: a point at (25, 17)
+        point = (mvt.MOVE_TO, mvt.zigzag(25), mvt.zigzag(17))
+        assert mvt.packed(4, point) == bytes([0x22, 3, 9, 50, 34])
+
+    def test_roundtrip(self):
+        features = nodes(500)
+        decoded = decode(mvt.encode(features, tile))
+        x, y = mvt.project(features["lon"], features["lat"], tile)
+        assert len(decoded) == len(features)
+        for feature, row, column, line in zip(
+            decoded, features.tolist(), x.tolist(), y.tolist()
+        ):
+            osmid, fx, fy, properties = feature
+            assert (osmid, fx, fy) == (row[2], column, line)
+            assert 0 <= fx <= mvt.EXTENT and 0 <= fy <= mvt.EXTENT
+            assert properties == {
+                "id": row[2],
+                "creation": row[3],
+                "lastedit": row[4],
+                "revisions": row[5],
+                "frequency": row[6],
+            }
+
+    def test_project_corners(self):
+        bounds = mercantile.bounds(tile)
+        x, y = mvt.project(
+            np.array([bounds.west, bounds.east]),
+            np.array([bounds.north, bounds.south]),
+            tile,
+        )
+        assert x.tolist() == [0, mvt.EXTENT]
+        assert y.tolist() == [0, mvt.EXTENT]
+
+    def test_empty(self):
+        assert mvt.encode(np.empty(0, codec.DTYPE), tile) == b""
+
+    def test_clustered(self):
+        features = nodes(20_000)
+        decoded = decode(mvt.render(features, tile, 50))
+        assert 0 < len(decoded) <= mvt.MVT_GRID**2
+        assert sum(props["count"] for *_, props in decoded) == len(features)
+        for osmid, _, _, properties in decoded:
+            assert (osmid is not None) == (properties["count"] == 1)
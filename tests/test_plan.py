@@ -0,0 +1,148 @@
+import mercantile
+import numpy as np
+import pytest
+import redis
+import walrus
+
+from server import codec
+from server import plan as planner
+from server.plan import densities, plan
+from server.process import bbox_tiles
+
+# a z12 tile in Milan, and its parent
+milan = mercantile.tile(9.19, 45.46, 12)
+parent = mercantile.parent(milan)
+
+
+def bbox_of(*tiles):
+    bounds = [mercantile.bounds(tile) for tile in tiles]
+    return mercantile.Bbox(
+        min(bound.west for bound in bounds),
+        min(bound.south for bound in bounds),
+        max(bound.east for bound in bounds),
+        max(bound.north for bound in bounds),
+    )
+
+
+def inner(bbox, margin=0.01):
+    """Smaller than bbox, so that neighbouring tiles are left out"""
+    width = (bbox.right - bbox.left) * margin
+    height = (bbox.top - bbox.bottom) * margin
+    return mercantile.Bbox(
+        bbox.left + width,
+        bbox.bottom + height,
+        bbox.right - width,
+        bbox.top - height,
+    )
+
+
+def planned(bbox, known, cached=()):
+    tiles = list(bbox_tiles(bbox, 12))
+    return plan(
+        bbox,
+        tiles,
+        known,
+        set(cached),
+        split_nodes=1000,
+        merge_nodes=100,
+        split_levels=2,
+        merge_levels=2,
+    )
+
+
+class TestDensities:
+    def test_descendants(self):
+        bounds = mercantile.bounds(milan)
+        rng = np.random.default_rng(0)
+        features = np.zeros(1000, dtype=codec.DTYPE)
+        features["lon"] = rng.uniform(bounds.west, bounds.east, 1000)
+        features["lat"] = rng.uniform(bounds.south, bounds.north, 1000)
+        counts = densities(mercantile.quadkey(milan), features, levels=2)
+        assert len(counts) == 1 + 4 + 16
+        quadkey = mercantile.quadkey(milan)
+        assert counts[quadkey] == 1000
+        for zoom in (13, 14):
+            assert (
+                sum(counts[key] for key in counts if len(key) == zoom) == 1000
+            )
+        child = mercantile.tile(*features[["lon", "lat"]][0].tolist(), 14)
+        assert counts[mercantile.quadkey(child)] > 0
+
+
+class TestPlan:
+    def test_unknown(self):
+        bbox = inner(bbox_of(milan))
+        assert planned(bbox, {}) == [milan]
+
+    def test_split(self):
+        child = mercantile.children(milan)[0]
+        grandchild = mercantile.children(child)[3]
+        bbox = inner(bbox_of(grandchild))
+        known = {
+            mercantile.quadkey(milan): 5000,
+            mercantile.quadkey(child): 2000,
+        }
+        assert planned(bbox, known) == [grandchild]
+        # cached, or wholly requested
+        assert planned(bbox, known, [mercantile.quadkey(milan)]) == [milan]
+        assert planned(inner(bbox_of(milan), -0.01), known)[0] != child
+
+    def test_merge(self):
+        siblings = mercantile.children(parent)
+        bbox = inner(bbox_of(*siblings))
+        known = {mercantile.quadkey(tile): 10 for tile in siblings}
+        assert planned(bbox, known) == [parent]
+        # each level needs all the siblings
+        grandparent = mercantile.parent(parent)
+        for tile in mercantile.children(grandparent):
+            known[mercantile.quadkey(tile)] = 20
+        assert planned(bbox, known) == [grandparent]
+
+    def test_no_merge(self):
+        siblings = mercantile.children(parent)
+        bbox = inner(bbox_of(*siblings))
+        quadkeys = [mercantile.quadkey(tile) for tile in siblings]
+        known = dict.fromkeys(quadkeys, 10)
+        assert planned(bbox, {**known, quadkeys[0]: 1000}) == siblings_sorted()
+        assert (
+            planned(bbox, dict.fromkeys(quadkeys[1:], 1)) == siblings_sorted()
+        )
+        # already cached one by one
+        assert planned(bbox, known, quadkeys) == siblings_sorted()
+
+
+def siblings_sorted():
+    return sorted(mercantile.children(parent), key=mercantile.quadkey)
+
+
+class TestRecord:
+    def test_sharded(self, monkeypatch):
+        fakeredis = pytest.importorskip("fakeredis")
+        db = walrus.Database(
+            connection_pool=redis.ConnectionPool(
+                connection_class=fakeredis.FakeConnection,
+                server=fakeredis.FakeServer(),
+            )
+        )
+        monkeypatch.setattr(planner, "db", db)
+        features = np.zeros(3, dtype=codec.DTYPE)
+        bounds = mercantile.bounds(milan)
+        features["lon"] = bounds.west + 1e-6
+        features["lat"] = bounds.north - 1e-6
+        planner.record(mercantile.quadkey(milan), features)
+        shards = db.keys(planner.DENSITY + "*")
+        shard = planner.density_key(mercantile.quadkey(milan))
+        assert shards == [shard.encode()]
+        assert 0 < db.ttl(shards[0]) <= planner.DENSITY_TIMEOUT
+        seen = []
+
+        def plan(bbox, tiles, known, cached):
+            seen.append(known)
+            return tiles
+
+        monkeypatch.setattr(planner, "plan", plan)
+        bbox = inner(bbox_of(milan))
+        planner.plan_tiles(bbox, [milan])
+        child = mercantile.quadkey(mercantile.children(milan)[0])
+        assert seen[0][mercantile.quadkey(milan)] == 3
+        assert seen[0][child] == 3
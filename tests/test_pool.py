@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import pytest
+
+from server import pool
+
+
+def spin(seconds):
+    began = time.thread_time()
+    while time.thread_time() - began < seconds:
+        pass
+    return seconds
+
+
+@pytest.fixture(params=[0, 1])
+def workers(request, monkeypatch):
+    monkeypatch.setattr(pool, "PROCESS_WORKERS", request.param)
+    monkeypatch.setattr(pool, "executor", None)
+    yield request.param
+    if pool.executor is not None:
+        pool.executor.shutdown()
+
+
+class TestPool:
+    def test_offload(self, workers):
+        assert asyncio.run(pool.offload(sorted, [3, 1, 2])) == [1, 2, 3]
+        assert (pool.executor is not None) == bool(workers)
+
+    def test_budget(self, workers):
+        async def request():
+            pool.budget.set(pool.Budget(0.05))
+            await pool.offload(spin, 0.03)
+            await pool.offload(spin, 0.03)
+
+        with pytest.raises(pool.BudgetExceeded):
+            asyncio.run(request())
+
+    def test_backpressure(self, workers, monkeypatch):
+        monkeypatch.setattr(pool, "PROCESS_QUEUE", 1)
+        monkeypatch.setattr(pool, "slots", None)
+
+        async def requests():
+            offloaded = [pool.offload(spin, 0.01) for _ in range(3)]
+            pending = asyncio.gather(*offloaded)
+            await asyncio.sleep(0)
+            assert pool.get_slots().locked()
+            return await pending
+
+        assert asyncio.run(requests()) == [0.01] * 3
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+import redis
+import walrus
+
+from server import prewarm, process, utils
+from server.storage import RedisStorage
+
+fakeredis = pytest.importorskip("fakeredis")
+
+metadata = ("2007-10-08T00:00:00Z", "2024-01-01T00:00:00Z")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = walrus.Database(
+        connection_pool=redis.ConnectionPool(
+            connection_class=fakeredis.FakeConnection,
+            server=fakeredis.FakeServer(),
+        )
+    )
+    monkeypatch.setattr(prewarm, "db", db)
+    monkeypatch.setattr(utils, "storage", RedisStorage(db))
+    monkeypatch.setattr(prewarm, "PREWARM_TILES", 3)
+    monkeypatch.setattr(prewarm, "PREWARM_CONCURRENCY", 2)
+    monkeypatch.setattr(prewarm, "PREWARM_RATE", 1000)
+    return db
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    fetched = []
+    running = []
+
+    async def get_tile_data(quadkey, start, end, *filters, **headers):
+        running.append(quadkey)
+        assert len(running) <= prewarm.PREWARM_CONCURRENCY
+        await asyncio.sleep(0.01)
+        running.remove(quadkey)
+        fetched.append((quadkey, start, end, *filters))
+
+    monkeypatch.setattr(prewarm, "get_tile_data", get_tile_data)
+    return fetched
+
+
+class TestPrewarm:
+    def test_warm_hot_tiles(self, db, fetched):
+        counts = {"0_type:node": 1, "1_type:node": 5, "2_a=b": 3, "3_": 4}
+        db.zadd(prewarm.HOT, counts)
+        assert asyncio.run(prewarm.warm(*metadata)) == 3
+        assert sorted(fetched) == [
+            ("1", *metadata, "type:node"),
+            ("2", *metadata, "a=b"),
+            ("3", *metadata, ""),
+        ]
+        assert db.zscore(prewarm.HOT, "1_type:node") == 2.5
+
+    def test_refresh(self, db, fetched, monkeypatch):
+        async def fetch_metadata():
+            return metadata
+
+        monkeypatch.setattr(prewarm, "fetch_metadata", fetch_metadata)
+        db.zadd(prewarm.HOT, {"1_type:node": 1})
+        utils.cache_metadata(("2007-10-08T00:00:00Z", "2023"))
+        asyncio.run(prewarm.refresh())
+        assert len(fetched) == 1
+        assert utils.cached_metadata() == metadata
+        asyncio.run(prewarm.refresh())
+        assert len(fetched) == 1
+
+    def test_failed_tiles(self, db, fetched, monkeypatch):
+        warming = prewarm.get_tile_data
+
+        async def get_tile_data(quadkey, *args, **kwargs):
+            if quadkey == "1":
+                raise asyncio.TimeoutError
+            if quadkey == "2":
+                raise ValueError("corrupted tile")
+            await warming(quadkey, *args, **kwargs)
+
+        async def fetch_metadata():
+            return metadata
+
+        monkeypatch.setattr(prewarm, "get_tile_data", get_tile_data)
+        monkeypatch.setattr(prewarm, "fetch_metadata", fetch_metadata)
+        db.zadd(prewarm.HOT, {"1_": 3, "2_": 2, "3_": 1})
+        asyncio.run(prewarm.refresh())
+        assert [quadkey for quadkey, *_ in fetched] == ["3"]
+        assert utils.cached_metadata() == metadata
+
+    def test_lock_held_while_refreshing(self, db, monkeypatch):
+        monkeypatch.setattr(prewarm, "PREWARM_INTERVAL", 0.1)
+        running = []
+        overlapping = []
+
+        async def refresh():
+            running.append(1)
+            overlapping.append(len(running))
+            await asyncio.sleep(0.3)
+            running.pop()
+
+        monkeypatch.setattr(prewarm, "refresh", refresh)
+
+        async def workers():
+            tasks = [asyncio.ensure_future(prewarm.scheduler()) for _ in "ab"]
+            await asyncio.sleep(0.35)
+            for task in tasks:
+                task.cancel()
+
+        asyncio.run(workers())
+        assert overlapping == [1]
+
+    def test_track(self, db, monkeypatch):
+        monkeypatch.setattr(process, "db", db)
+        process.track(["1", "2", "1"], "a=b", "type:node")
+        process.track([], "type:node")
+        assert db.zscore(prewarm.HOT, "1_a=b and type:node") == 2
+        assert db.zscore(prewarm.HOT, "2_a=b and type:node") == 1
@@ -0,0 +1,212 @@
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from server import codec, pool, process
+from server.lru import LRU
+from server.storage import DiskStorage, RedisStorage
+
+end = "2024-01-01T00:00:00Z"
+
+
+def ohsome_response(nodes, versions=3):
+    """Chunks of a synthetic ohsome response, node by node"""
+    yield b'{"type": "FeatureCollection", "features": ['
+    for node in range(nodes):
+        for version in range(1, versions + 1):
+            valid_to = (
+                end if version == versions else f"201{version}-01-01T00:00:00Z"
+            )
+            prefix = b"" if node == 0 and version == 1 else b","
+            yield (
+                prefix
+                + (
+                    '{"type": "Feature", "geometry": {"type": "Point", '
+                    f'"coordinates": [{9 + node * 1e-6}, '
+                    f"{45 + version * 1e-6}]"
+                    '}, "properties": {'
+                    f'"@osmId": "node/{node + 1}", '
+                    f'"@validFrom": "201{version - 1}-01-01T00:00:00Z", '
+                    f'"@validTo": "{valid_to}", '
+                    f'"@version": {version}'
+                    "}}"
+                ).encode()
+            )
+    yield b"]}"
+
+
+class ChunkReader:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+fixtures = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# the peak RSS is reset once the modules are imported, see proc(5)
+PEAK_RSS = """
+import os, resource, sys
+from server import process
+
+with open("/proc/self/clear_refs", "w") as clear_refs:
+    clear_refs.write("5")
+with open("/proc/self/statm") as statm:
+    before = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+with open(sys.argv[1], "rb") as resp:
+    process.stream_to_encoder(resp, sys.argv[2], lambda chunk: None)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - before)
+"""
+
+
+def recorded():
+    with open(os.path.join(fixtures, "elementsFullHistory.json")) as fixture:
+        return json.load(fixture)["features"]
+
+
+def write_response(path, repeat):
+    """The recorded response, its nodes repeated with other ids: returns
+    how many of them are current"""
+    features = recorded()
+    with open(path, "w") as resp:
+        resp.write('{"type": "FeatureCollection", "features": [')
+        for copy in range(repeat):
+            for index, feature in enumerate(features):
+                properties = feature["properties"]
+                osmid = int(properties["@osmId"].split("/")[1])
+                osmid += copy * 10**9
+                feature = {
+                    **feature,
+                    "properties": {**properties, "@osmId": f"node/{osmid}"},
+                }
+                prefix = "," if copy or index else ""
+                resp.write(prefix + json.dumps(feature))
+        resp.write("]}")
+    return repeat * len(current(features))
+
+
+def current(features):
+    """Ids of the nodes which have not been deleted"""
+    return {
+        int(feature["properties"]["@osmId"].split("/")[1])
+        for feature in features
+        if feature["properties"]["@validTo"] == end
+    }
+
+
+def peak_rss(path):
+    """Growth of the peak RSS of a fresh interpreter, in bytes, while it
+    streams the response at path"""
+    output = subprocess.run(
+        [sys.executable, "-c", PEAK_RSS, str(path), end],
+        capture_output=True,
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+    ).stdout
+    return int(output)
+
+
+class TestProcess:
+    def test_roundtrip(self):
+        sink = io.BytesIO()
+        features = process.stream_to_encoder(
+            ChunkReader(ohsome_response(1000)), end, sink.write
+        )
+        assert len(features) == 1000
+        assert (features["id"] == np.arange(1, 1001)).all()
+        assert (features["revisions"] == 3).all()
+        assert np.allclose(features["lat"], 45 + 3e-6)
+        assert features["creation"][0] == 1262304000
+        assert features["lastedit"][0] == 1325376000
+        decoded = codec.decode(sink.getvalue())
+        assert (decoded == features).all()
+
+    def test_fixture(self):
+        path = os.path.join(fixtures, "elementsFullHistory.json")
+        with open(path, "rb") as resp:
+            features = process.stream_to_encoder(resp, end, lambda chunk: None)
+        assert sorted(features["id"]) == sorted(current(recorded()))
+
+    @pytest.mark.skipif(
+        not os.path.exists("/proc/self/clear_refs"), reason="Linux only"
+    )
+    def test_constant_memory(self, tmp_path):
+        """Peak RSS grows with the compact rows, sorted before they are
+        written, not with the response"""
+        growth = []
+        for repeat in (1000, 2000):
+            path = tmp_path / f"{repeat}.json"
+            nodes = write_response(path, repeat)
+            growth.append((peak_rss(path), nodes))
+        (small, few), (large, many) = growth
+        per_node = (large - small) / (many - few)
+        assert per_node < 4 * codec.DTYPE.itemsize
+
+
+class TestWindow:
+    @pytest.fixture(params=["redis", "disk"])
+    def storage(self, request, monkeypatch, tmp_path):
+        if request.param == "redis":
+            fakeredis = pytest.importorskip("fakeredis")
+            storage = RedisStorage(fakeredis.FakeRedis())
+        else:
+            storage = DiskStorage(tmp_path, 2**30)
+        monkeypatch.setattr(process, "storage", storage)
+        monkeypatch.setattr(process, "tiles", LRU(2**24))
+        monkeypatch.setattr(pool, "PROCESS_WORKERS", 0)
+        return storage
+
+    def test_overlapping_blocks(self, storage, monkeypatch):
+        rng = np.random.default_rng(0)
+        features = np.zeros(codec.BLOCK_ROWS * 16, dtype=codec.DTYPE)
+        features["lon"] = rng.uniform(9.1, 9.2, len(features))
+        features["lat"] = rng.uniform(45.4, 45.5, len(features))
+        features["id"] = np.arange(len(features))
+        key = process.tile_cache_key("0", "start", end)
+        storage.set(f"tile:{key}", codec.encode(features), 60)
+
+        async def get_tile_data(*args, **kwargs):
+            raise AssertionError("the whole tile has been read")
+
+        monkeypatch.setattr(process, "get_tile_data", get_tile_data)
+        bounds = (9.1, 45.4, 9.12, 45.42)
+        window = asyncio.run(
+            process.get_tile_window("0", "start", end, bounds)
+        )
+        west, south, east, north = bounds
+        inside = (
+            (west <= features["lon"])
+            & (features["lon"] <= east)
+            & (south <= features["lat"])
+            & (features["lat"] <= north)
+        )
+        assert len(window) < len(features) // 4
+        assert set(features["id"][inside].tolist()) <= set(
+            window["id"].tolist()
+        )
+        again = asyncio.run(process.get_tile_window("0", "start", end, bounds))
+        assert (again == window).all()
+
+    def test_missing(self, storage, monkeypatch):
+        async def get_tile_data(*args, **kwargs):
+            return "fetched"
+
+        monkeypatch.setattr(process, "get_tile_data", get_tile_data)
+        window = process.get_tile_window("0", "start", end, (0, 0, 1, 1))
+        assert asyncio.run(window) == "fetched"
@@ -0,0 +1,79 @@
+import os
+import time
+
+import pytest
+
+from server import storage as module
+from server.storage import DiskStorage, RedisStorage
+
+
+@pytest.fixture(params=["redis", "disk"])
+def storage(request, tmp_path):
+    if request.param == "redis":
+        fakeredis = pytest.importorskip("fakeredis")
+        return RedisStorage(fakeredis.FakeRedis())
+    return DiskStorage(tmp_path, 2**20)
+
+
+class TestStorage:
+    def test_get_set(self, storage):
+        assert storage.get("a") is None
+        storage.set("a", b"value", 60)
+        assert storage.get("a") == b"value"
+        assert storage.exists(["a", "b"]) == [True, False]
+        storage.delete("a")
+        assert storage.get("a") is None
+
+    def test_ranges(self, storage):
+        storage.set("a", b"0123456789", 60)
+        ranges = [(0, 2), (-3, -1), (8, 20), (-20, 1), (5, 4), (20, 30)]
+        assert storage.getranges("a", ranges) == [
+            b"012",
+            b"789",
+            b"89",
+            b"01",
+            b"",
+            b"",
+        ]
+        assert storage.getranges("missing", [(0, -1)]) == [b""]
+
+    def test_writer(self, storage):
+        writer = storage.writer("a", 60)
+        writer.write(b"01")
+        writer.write(b"23")
+        assert storage.get("a") is None
+        writer.commit()
+        assert storage.get("a") == b"0123"
+        writer = storage.writer("a", 60)
+        writer.write(b"4")
+        writer.abort()
+        assert storage.get("a") == b"0123"
+
+
+class TestDiskStorage:
+    def test_expired(self, tmp_path):
+        storage = DiskStorage(tmp_path, 2**20)
+        storage.set("a", b"value", -1)
+        assert storage.get("a") is None
+        assert not os.path.exists(storage.path("a"))
+
+    def test_evict_least_recently_used(self, tmp_path):
+        storage = DiskStorage(tmp_path, 2**20)
+        size = 1000 - module.expiry.size
+        for age, key in enumerate("abcd"):
+            storage.set(key, bytes(size), 60)
+            past = time.time() - 100 + age
+            os.utime(storage.path(key), (past, past))
+        storage.get("a")
+        storage.capacity = 4 * 1000
+        storage.set("e", bytes(size), 60)
+        storage.evicting.join()
+        assert storage.exists("abcde") == [True, False, False, True, True]
+
+    def test_keep_files_being_written(self, tmp_path):
+        storage = DiskStorage(tmp_path, 0)
+        writer = storage.writer("a", 60)
+        writer.write(b"value")
+        storage.evict()
+        assert os.path.exists(writer.file.name)
+        writer.abort()
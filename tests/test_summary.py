@@ -0,0 +1,94 @@
+import pickle
+import statistics
+
+import mercantile
+import numpy as np
+import pytest
+import shapely.geometry
+from features import random_features
+
+from server import summary
+
+quadkey = mercantile.quadkey(mercantile.tile(9.19, 45.46, 12))
+bounds = mercantile.bounds(mercantile.quadkey_to_tile(quadkey))
+QUARTILES = ("1st quartile", "median", "3rd quartile")
+
+
+class TestSummary:
+    def test_exact_when_small(self):
+        values = np.random.default_rng(1).uniform(0, 100, 40)
+        _, counts, minimum, maximum, _, means, weights = summary.summarize(
+            values, np.zeros(len(values), dtype=np.int64)
+        )
+        sketch = summary.Summary(
+            counts[0], minimum[0], maximum[0], means, weights
+        )
+        expected = statistics.quantiles(values, n=4, method="inclusive")
+        for q, value in zip((0.25, 0.5, 0.75), expected):
+            assert np.isclose(summary.quantile(sketch, q), value)
+
+    def test_exact_timestamps(self):
+        features = random_features(30, bounds=bounds)
+        features["lastedit"] = features["creation"] + 7
+        pyramid = summary.Pyramid.build(quadkey, features)
+        root = pyramid.get(pyramid.root)
+        for metric in ("creation", "lastedit"):
+            expected = statistics.quantiles(
+                features[metric], n=4, method="inclusive"
+            )
+            stats = summary.statistics(root[metric])
+            quartiles = [stats[name] for name in QUARTILES]
+            assert quartiles == expected
+
+    def test_pyramid_root(self):
+        features = random_features(20000, bounds=bounds)
+        pyramid = summary.Pyramid.decode(
+            summary.Pyramid.build(quadkey, features).encode()
+        )
+        root = pyramid.get(pyramid.root)
+        for metric in summary.METRICS:
+            values = features[metric]
+            assert root[metric].count == len(values)
+            assert root[metric].min == values.min()
+            assert root[metric].max == values.max()
+            assert len(root[metric].means) <= summary.SKETCH_SIZE * 2
+
+    def test_invalid(self, monkeypatch):
+        pyramid = summary.Pyramid.build(
+            quadkey, random_features(100, bounds=bounds)
+        )
+        encoded = pyramid.encode()
+        monkeypatch.setattr(summary, "VERSION", 2)
+        for blob in (encoded, pickle.dumps(pyramid), b"", encoded[:100]):
+            with pytest.raises(ValueError):
+                summary.Pyramid.decode(blob)
+
+    def test_cover_and_scan(self):
+        features = random_features(20000, seed=2, bounds=bounds)
+        pyramid = summary.Pyramid.build(quadkey, features)
+        shape = shapely.geometry.Polygon(
+            [
+                (bounds.west, bounds.south),
+                (bounds.east, bounds.south),
+                (bounds.west, bounds.north),
+            ]
+        )
+        contained, boundary = pyramid.cover(shape)
+        assert contained and boundary
+        summaries = [*contained, pyramid.scan(features, shape, boundary)]
+        inside = features[
+            shapely.contains_xy(shape, features["lon"], features["lat"])
+        ]
+        for metric in summary.METRICS:
+            merged = summary.merge(
+                [summaries[metric] for summaries in summaries]
+            )
+            values = inside[metric]
+            assert abs(merged.count - len(values)) <= len(values) * 0.001
+            assert merged.min >= values.min()
+            assert merged.max <= values.max()
+            for q in (0.25, 0.5, 0.75):
+                estimate = summary.quantile(merged, q)
+                below = np.mean(values < estimate)
+                below_or_equal = np.mean(values <= estimate)
+                assert below - 0.02 <= q <= below_or_equal + 0.02
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import math
+import os
+import statistics
+
+import mercantile
+import numpy as np
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+from server import codec, pool, process, tile
+from server.tile import rasterize
+from server.utils import ensure_range
+
+fixtures = os.path.join(os.path.dirname(__file__), "fixtures")
+bbox = mercantile.Bbox(9.140625, 45.398449976304086, 9.228515625, 45.46013)
+
+
+def rasterize_reference(lon, lat, values, bbox, resolution, percentile):
+    subvalues = [[] for _ in range(resolution * resolution)]
+    for x, y, value in zip(lon, lat, values):
+        y_index = ensure_range(
+            math.floor(resolution * (bbox.top - y) / (bbox.top - bbox.bottom)),
+            value_max=resolution - 1,
+        )
+        x_index = ensure_range(
+            math.floor(
+                resolution * (x - bbox.left) / (bbox.right - bbox.left)
+            ),
+            value_max=resolution - 1,
+        )
+        subvalues[y_index * resolution + x_index].append(value)
+    colors = []
+    for values in subvalues:
+        if len(values) == 0:
+            colors.extend([255, 255, 255])
+            continue
+        elif len(values) == 1:
+            value = values[0]
+        else:
+            value = [
+                min(values),
+                *statistics.quantiles(values, n=100, method="inclusive"),
+                max(values),
+            ][percentile]
+        index = min(max(round(value * 255), 0), 255)
+        colors.extend(tile.VIRIDIS_LUT[index].tolist())
+    return colors
+
+
+class TestRasterize:
+    @pytest.mark.parametrize("resolution", [1, 8, 64])
+    @pytest.mark.parametrize("percentile", [0, 1, 33, 50, 99, 100])
+    def test_reference(self, resolution, percentile):
+        rng = np.random.default_rng(resolution * 101 + percentile)
+        size = 5000
+        lon = rng.uniform(bbox.left - 0.01, bbox.right + 0.01, size)
+        lat = rng.uniform(bbox.bottom - 0.01, bbox.top + 0.01, size)
+        values = rng.uniform(-0.2, 1.2, size)
+        values[::7] = np.round(values[::7], 1)  # ties
+        pixels = rasterize(lon, lat, values, bbox, resolution, percentile)
+        expected = rasterize_reference(
+            lon.tolist(),
+            lat.tolist(),
+            values.tolist(),
+            bbox,
+            resolution,
+            percentile,
+        )
+        assert pixels.ravel().tolist() == expected
+
+    def test_empty(self):
+        empty = np.empty(0)
+        pixels = rasterize(empty, empty, empty, bbox, 4, 50)
+        assert (pixels == 255).all()
+
+    def test_viridis(self):
+        """matplotlib's viridis with 256 colors, see server/colormap.py"""
+        with open(os.path.join(fixtures, "viridis.json")) as fixture:
+            expected = json.load(fixture)
+        assert tile.VIRIDIS_LUT.tolist() == expected
+
+
+class TestMetatile:
+    @pytest.mark.parametrize(
+        "z, size", [(11, 1), (12, 1), (13, 2), (14, 4), (18, 4)]
+    )
+    def test_block(self, z, size, monkeypatch):
+        monkeypatch.setattr(tile, "METATILE", 4)
+        requested = mercantile.tile(9.19, 45.46, z)
+        tiles = tile.metatile(requested)
+        assert len(tiles) == size * size
+        assert requested in tiles
+        parents = {
+            mercantile.parent(t, zoom=12) if z > 12 else t for t in tiles
+        }
+        assert len(parents) == 1
+
+    def test_render_matches_single_tiles(self, monkeypatch):
+        monkeypatch.setattr(pool, "PROCESS_WORKERS", 0)
+        monkeypatch.setattr(process, "track", lambda *args: None)
+        parent = mercantile.tile(9.19, 45.46, 12)
+        bounds = mercantile.bounds(parent)
+        rng = np.random.default_rng(0)
+        size = 20_000
+        features = np.zeros(size, dtype=codec.DTYPE)
+        features["lon"] = rng.uniform(bounds.west, bounds.east, size)
+        features["lat"] = rng.uniform(bounds.south, bounds.north, size)
+        # nodes on the borders of the tiles
+        children = mercantile.children(parent, zoom=14)
+        edges = np.array([mercantile.bounds(child) for child in children])
+        features["lon"][:16] = edges[:, 0]
+        features["lat"][16:32] = edges[:, 3]
+        features["creation"] = rng.uniform(1.2e9, 1.7e9, size)
+        features["lastedit"] = features["creation"] + 1e6
+        features["revisions"] = rng.integers(1, 20, size)
+        features["frequency"] = rng.exponential(50, size)
+
+        async def get_tile_data(quadkey, *args, **kwargs):
+            if quadkey == mercantile.quadkey(parent):
+                return features
+            return np.empty(0, codec.DTYPE)
+
+        async def get_tile_window(quadkey, start, end, bounds, *args, **kw):
+            return await get_tile_data(quadkey)
+
+        monkeypatch.setattr(process, "get_tile_data", get_tile_data)
+        monkeypatch.setattr(process, "get_tile_window", get_tile_window)
+        monkeypatch.setattr(
+            process, "plan_tiles", lambda bbox, tiles, _: tiles
+        )
+        monkeypatch.setattr(tile, "METATILE", 4)
+
+        def render(tiles):
+            return asyncio.run(
+                tile.render(
+                    tiles,
+                    tile.MODES,
+                    "2007-10-08T00:00:00Z",
+                    "2024-01-01T00:00:00Z",
+                    [None, "type:node"],
+                    {},
+                    None,
+                    None,
+                    50,
+                    16,
+                    16,
+                )
+            )
+
+        tiles = tile.metatile(children[0])
+        assert len(tiles) == 16
+        expected = [body for single in tiles for body in render([single])]
+        assert render(tiles) == expected
+
+
+class Cache(dict):
+    def set_many(self, values, timeout):
+        self.update(values)
+
+
+class TestCachedResponse:
+    def test_etag(self, monkeypatch):
+        monkeypatch.setattr(tile, "cache", Cache())
+        renders = []
+
+        async def render():
+            renders.append(1)
+            return {"a": b"first", "b": b"second"}
+
+        async def respond(etag=None):
+            headers = {"If-None-Match": f'"{etag}"'} if etag else {}
+            request = make_mocked_request("GET", "/", headers=headers)
+            return await tile.cached_response(request, "b", render, "x/y")
+
+        response = asyncio.run(respond())
+        assert response.status == 200
+        assert response.body == b"second"
+        assert response.headers["Cache-Control"].startswith("public")
+        assert tile.cache["a"][1] == b"first"
+        again = asyncio.run(respond(response.etag.value))
+        assert again.status == 304
+        assert again.etag == response.etag
+        assert len(renders) == 1
@@ -0,0 +1,27 @@
+import mercantile
+import numpy as np
+import shapely.geometry
+
+from server import utils
+
+bbox = mercantile.Bbox(9.1, 45.4, 9.3, 45.5)
+
+
+class TestMasks:
+    def test_bbox_inclusive(self):
+        lon = np.array([9.1, 9.2, 9.3, 9.0, 9.2])
+        lat = np.array([45.4, 45.45, 45.5, 45.45, 45.6])
+        mask = utils.bbox_mask(bbox, lon, lat)
+        assert mask.tolist() == [True, True, True, False, False]
+
+    def test_shape_matches_contains(self):
+        rng = np.random.default_rng(0)
+        shape = shapely.geometry.Point(9.2, 45.45).buffer(0.05)
+        shape = shape.difference(shapely.geometry.box(9.2, 45.45, 9.3, 45.5))
+        lon = np.r_[rng.uniform(9.1, 9.3, 1000), 9.2, 9.225]
+        lat = np.r_[rng.uniform(45.4, 45.5, 1000), 45.45, 45.46]
+        expected = [
+            shape.contains(shapely.geometry.Point(x, y))
+            for x, y in zip(lon, lat)
+        ]
+        assert utils.shape_mask(shape, lon, lat).tolist() == expected